@@ -1,14 +1,37 @@
+import asyncio
 import os
 import random
+import sys
+import threading
 import math
-from flask import Flask, render_template, jsonify, request
-import sqlite3
-from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, render_template, jsonify, request, send_from_directory
+from werkzeug.http import is_resource_modified
+from datetime import datetime, timezone
+from PIL import Image, ImageDraw
 import io
 import base64
-import requests
-from comfyui_run import queue_workflow_and_wait
+from asgi_bridge import AsgiApp, StreamingBody
+from async_http import get_async_client
+from chat_replies import IntentMatcher, ReplyCache, load_intents
+from chat_stream import completion_tokens, completion_tokens_async, relay, relay_async, replay
+from http_client import get_client
+from comfyui_run import get_pool, queue_workflow_and_wait, queue_workflow_and_wait_async, workflows
+from db import Database
+import deck as tarot
+from gen_cache import GenerationCache, cache_key
+from jobs import JobQueue, QueueFullError
+import metrics
+from metrics import (BACKEND_DOWNLOAD, DISK_WRITE, GENERATE_TOTAL, GENERATIONS_IN_FLIGHT, IMAGE_ENCODE,
+                     PIL_RENDER)
+from storage import Reconciler, Unlinker
+from thumbnails import ThumbnailStore
+import tracing
+from tracing import span, traced
+from workflow import WorkflowError
+import fonts
+from fonts import SYMBOL_FONTS, TEXT_FONTS, get_font, text_size
+from layers import LayerCache
+import effects
 try:
     import openai
 except Exception:
@@ -24,18 +47,25 @@ class PILImageGenerator:
             'fire': ['#FF4500', '#FF6347', '#DC143C', '#B22222'],
             'air': ['#F0F8FF', '#E6E6FA', '#D8BFD8', '#DDA0DD']
         }
+        # 边框、光晕、符号环等静态图层按尺寸缓存，只绘制一次
+        self.layers = LayerCache()
 
     def generate_tarot_image(self, card_name, meaning, width=512, height=768):
-        """生成塔罗牌风格的图像"""
+        """生成塔罗牌风格的图像（base64 data URL）"""
+        return self._image_to_base64(self.render_tarot_image(card_name, meaning, width, height))
+
+    @PIL_RENDER.time(kind='tarot')
+    def render_tarot_image(self, card_name, meaning, width=512, height=768, rng=random):
+        """生成塔罗牌风格的图像，返回 PIL 图像；传入固定种子的 rng 可得到可复现的牌面"""
         # 创建画布
-        image = Image.new('RGB', (width, height), color=self._get_background_color(card_name))
-        draw = ImageDraw.Draw(image)
+        image = Image.new('RGB', (width, height), color=self._get_background_color(card_name, rng))
 
         # 添加装饰性边框
-        self._draw_border(draw, width, height)
+        self.layers.composite(image, 'border', self._draw_border)
+        draw = ImageDraw.Draw(image)
 
         # 添加中心符号
-        self._draw_central_symbol(draw, card_name, width, height)
+        self._draw_central_symbol(draw, card_name, width, height, rng)
 
         # 添加卡片名称
         self._draw_text(draw, card_name, width, height // 4, is_title=True)
@@ -45,10 +75,14 @@ class PILImageGenerator:
         self._draw_text(draw, short_meaning, width, height * 3 // 4, is_title=False)
 
         # 添加神秘的光晕效果
-        self._draw_glow_effects(draw, width, height)
+        if effects.available:
+            self.layers.composite(image, 'glow', style='alpha', build_fn=self._build_glow_layer)
+        else:
+            self.layers.composite(image, 'glow', self._draw_glow_effects)
 
-        return self._image_to_base64(image)
+        return image
 
+    @PIL_RENDER.time(kind='crystal_ball')
     def generate_crystal_ball_image(self, prompt, width=512, height=512):
         """生成水晶球图像"""
         image = Image.new('RGB', (width, height), color='#2F1B4D')
@@ -63,38 +97,52 @@ class PILImageGenerator:
                       center_x + radius, center_y + radius],
                      fill='#4B0082', outline='#9370DB', width=3)
 
-        # 水晶球内圈（半透明效果）
+        # 闪光点位置
         inner_radius = radius - 10
-        for i in range(5):
-            r = inner_radius - i * 5
-            alpha = 100 - i * 20
-            color = self._adjust_alpha('#8A2BE2', alpha)
-            draw.ellipse([center_x - r, center_y - r, center_x + r, center_y + r],
-                         fill=color)
-
-        # 添加闪光点
+        sparkles = []
         for _ in range(20):
             x = center_x + random.randint(-inner_radius, inner_radius)
             y = center_y + random.randint(-inner_radius, inner_radius)
             if (x - center_x) ** 2 + (y - center_y) ** 2 <= inner_radius ** 2:
-                size = random.randint(2, 5)
+                sparkles.append((x, y, random.randint(2, 5)))
+
+        if effects.available:
+            # 真正的半透明：渐变和高光在 NumPy 中合成，按尺寸缓存，每次只需贴一次
+            box = inner_radius + 2
+            overlay = self.layers.get('crystal_ball', (2 * box, 2 * box), style='alpha',
+                                      build_fn=self._build_crystal_layer)
+            image.paste(overlay, (center_x - box, center_y - box), overlay)
+            for x, y, size in sparkles:
+                draw.ellipse([x - size, y - size, x + size, y + size], fill='white')
+        else:
+            # 水晶球内圈（半透明效果）
+            for i in range(5):
+                r = inner_radius - i * 5
+                alpha = 100 - i * 20
+                color = self._adjust_alpha('#8A2BE2', alpha)
+                draw.ellipse([center_x - r, center_y - r, center_x + r, center_y + r],
+                             fill=color)
+
+            # 添加闪光点
+            for x, y, size in sparkles:
                 draw.ellipse([x - size, y - size, x + size, y + size], fill='white')
 
         # 添加文字
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except:
-            font = ImageFont.load_default()
+        font = get_font(TEXT_FONTS, 20)
 
         text = f"🔮 {prompt[:40]}..."
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
+        text_width, _ = text_size(text, font)
         draw.text((width // 2 - text_width // 2, height - 40), text, fill='white', font=font)
 
         return self._image_to_base64(image)
 
+    @traced('generate_fortune_image')
     def generate_fortune_image(self, prompt, width=512, height=512):
-        """生成通用占卜图像"""
+        """生成通用占卜图像（base64 data URL）"""
+        return self._image_to_base64(self.render_fortune_image(prompt, width, height))
+
+    def render_fortune_image(self, prompt, width=512, height=512, workflow='base'):
+        """生成通用占卜图像，直接返回 PIL 图像，不做 base64 编码；workflow 为 ComfyUI 工作流名称"""
         # image = Image.new('RGB', (width, height), color='#1A1A2E')
         # draw = ImageDraw.Draw(image)
 
@@ -107,60 +155,47 @@ class PILImageGenerator:
         #     draw.ellipse([x, y, x + size, y + size], fill=(brightness, brightness, brightness))
 
         # use comfyui to generate the image 
-        image_url = queue_workflow_and_wait(prompt=prompt, width=width, height=height)
-        response = requests.get(image_url)
-        image = Image.open(io.BytesIO(response.content)).convert('RGB')
-        
+        image_url = queue_workflow_and_wait(prompt=prompt, width=width, height=height, workflow=workflow)
+        # 分块下载到临时文件，避免把整个响应体读入内存
+        with span('comfyui.download'), BACKEND_DOWNLOAD.time(backend='comfyui'), \
+                get_client().download_to_tempfile(image_url) as f:
+            image = Image.open(f).convert('RGB')
+        return self.decorate_fortune_image(image, prompt)
+
+    async def render_fortune_image_async(self, prompt, width=512, height=512, workflow='base'):
+        """render_fortune_image 的异步版本：等待 ComfyUI 与下载图像时不占用线程，解码与绘制在工作线程中执行"""
+        image_url = await queue_workflow_and_wait_async(prompt=prompt, width=width, height=height, workflow=workflow)
+        with span('comfyui.download'), BACKEND_DOWNLOAD.time(backend='comfyui'):
+            f = await get_async_client().download_to_tempfile(image_url)
+        with f:
+            image = await asyncio.to_thread(lambda: Image.open(f).convert('RGB'))
+        return await asyncio.to_thread(self.decorate_fortune_image, image, prompt)
+
+    def decorate_fortune_image(self, image, prompt):
+        """在 ComfyUI 生成的图像上绘制符号环与提示文字"""
         # Update width and height to match the actual generated image
         width, height = image.size
         
-        draw = ImageDraw.Draw(image)
-
-        # # 绘制神秘符号
-        center_x, center_y = width // 2, height // 2
-        symbols = ['✧', '✦', '✶', '✺', '✹']
-
-        try:
-            font = ImageFont.truetype("seguiemj.ttf", 60)
-        except:
-            try:
-                font = ImageFont.truetype("arial.ttf", 60)
-            except:
-                font = ImageFont.load_default()
-
-        for i, symbol in enumerate(symbols):
-            angle = i * (360 / len(symbols))
-            rad = math.radians(angle)
-            distance = 100
-            x = center_x + distance * math.cos(rad)
-            y = center_y + distance * math.sin(rad)
-
-            bbox = draw.textbbox((0, 0), symbol, font=font)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
+        with span('pil.render', kind='fortune'), PIL_RENDER.time(kind='fortune'):
+            # # 绘制神秘符号
+            self.layers.composite(image, 'symbol_ring', self._draw_symbol_ring)
+            draw = ImageDraw.Draw(image)
 
-            draw.text((x - text_width // 2, y - text_height // 2),
-                      symbol, fill='#E94560', font=font)
+            # 添加提示文字
+            small_font = get_font(TEXT_FONTS, 16)
 
-        # 添加提示文字
-        try:
-            small_font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            small_font = ImageFont.load_default()
+            text_lines = self._wrap_text(prompt, small_font, width - 40)
+            for i, line in enumerate(text_lines):
+                text_width, _ = text_size(line, small_font)
+                draw.text((width // 2 - text_width // 2, height - 60 - i * 20),
+                          line, fill='#FFFFFF', font=small_font)
 
-        text_lines = self._wrap_text(prompt, small_font, width - 40)
-        for i, line in enumerate(text_lines):
-            bbox = draw.textbbox((0, 0), line, font=small_font)
-            text_width = bbox[2] - bbox[0]
-            draw.text((width // 2 - text_width // 2, height - 60 - i * 20),
-                      line, fill='#FFFFFF', font=small_font)
-
-        return self._image_to_base64(image)
+        return image
 
-    def _get_background_color(self, card_name):
+    def _get_background_color(self, card_name, rng=random):
         """根据卡片名称获取背景颜色"""
         color_groups = list(self.colors.values())
-        return random.choice(random.choice(color_groups))
+        return rng.choice(rng.choice(color_groups))
 
     def _draw_border(self, draw, width, height):
         """绘制装饰性边框"""
@@ -173,77 +208,102 @@ class PILImageGenerator:
         draw.rectangle([inner_border, inner_border, width - inner_border, height - inner_border],
                        outline='silver', width=2)
 
-    def _draw_central_symbol(self, draw, card_name, width, height):
+    def _draw_central_symbol(self, draw, card_name, width, height, rng=random):
         """绘制中心符号"""
         center_x, center_y = width // 2, height // 2
         symbols = ['★', '☆', '☾', '☀', '♡', '◇', '♤', '♧']
-        symbol = random.choice(symbols)
+        symbol = rng.choice(symbols)
 
         # 绘制符号
-        try:
-            font = ImageFont.truetype("seguiemj.ttf", 80)
-        except:
-            try:
-                font = ImageFont.truetype("arial.ttf", 80)
-            except:
-                font = ImageFont.load_default()
-
-        bbox = draw.textbbox((0, 0), symbol, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+        font = get_font(SYMBOL_FONTS, 80)
+        text_width, text_height = text_size(symbol, font)
 
         draw.text((center_x - text_width // 2, center_y - text_height // 2),
                   symbol, fill='gold', font=font)
 
     def _draw_text(self, draw, text, width, y_pos, is_title=True):
         """绘制文本"""
-        try:
-            if is_title:
-                font = ImageFont.truetype("arial.ttf", 28)
-            else:
-                font = ImageFont.truetype("arial.ttf", 18)
-        except:
-            font = ImageFont.load_default()
-
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
+        font = get_font(TEXT_FONTS, 28 if is_title else 18)
+        text_width, _ = text_size(text, font)
 
         color = 'gold' if is_title else 'silver'
         draw.text((width // 2 - text_width // 2, y_pos), text, fill=color, font=font)
 
+    def _draw_symbol_ring(self, draw, width, height):
+        """绘制占卜图像中心的五个神秘符号"""
+        center_x, center_y = width // 2, height // 2
+        symbols = ['✧', '✦', '✶', '✺', '✹']
+
+        font = get_font(SYMBOL_FONTS, 60)
+
+        for i, symbol in enumerate(symbols):
+            angle = i * (360 / len(symbols))
+            rad = math.radians(angle)
+            distance = 100
+            x = center_x + distance * math.cos(rad)
+            y = center_y + distance * math.sin(rad)
+
+            text_width, text_height = text_size(symbol, font)
+
+            draw.text((x - text_width // 2, y - text_height // 2),
+                      symbol, fill='#E94560', font=font)
+
     def _draw_glow_effects(self, draw, width, height):
         """绘制光晕效果"""
+        for x, y, size, _ in self._glow_points(width, height):
+            draw.ellipse([x - size, y - size, x + size, y + size], fill='white')
+
+    def _glow_points(self, width, height):
+        """光晕的三圈光点：[(x, y, size, ring)]"""
         center_x, center_y = width // 2, height // 2
+        points = []
         for i in range(3):
             radius = 100 + i * 30
-            alpha = 30 - i * 10
             for angle in range(0, 360, 45):
                 rad = math.radians(angle)
-                x = center_x + radius * math.cos(rad)
-                y = center_y + radius * math.sin(rad)
-                size = 5 + i * 2
-                draw.ellipse([x - size, y - size, x + size, y + size], fill='white')
+                points.append((center_x + radius * math.cos(rad), center_y + radius * math.sin(rad), 5 + i * 2, i))
+        return points
+
+    def _build_glow_layer(self, width, height):
+        """光晕图层（真实 alpha）：每个光点是实心核心加柔和外晕，外圈逐渐变淡"""
+        points = self._glow_points(width, height)
+        centers = [(x, y) for x, y, _, _ in points]
+        layer = effects.canvas(width, height)
+        effects.glow(layer, centers, [size * 2 for _, _, size, _ in points], 'white',
+                     [0.6 - ring * 0.15 for _, _, _, ring in points])
+        effects.starfield(layer, centers, [size * 0.6 for _, _, size, _ in points], 'white', 0.9)
+        return effects.to_image(layer)
+
+    def _build_crystal_layer(self, width, height):
+        """水晶球内部图层：紫色径向渐变（中心更浓）加左上角的柔和高光"""
+        box = width // 2
+        inner_radius = box - 2
+        layer = effects.canvas(width, height)
+        effects.radial_gradient(layer, (box, box), inner_radius, '#8A2BE2', inner_alpha=0.75, outer_alpha=0.3)
+        effects.glow(layer, [(box - inner_radius / 3, box - inner_radius / 3)], inner_radius / 4, 'white', 0.35)
+        return effects.to_image(layer)
 
     def _adjust_alpha(self, color, alpha):
         """调整颜色透明度（模拟）"""
         return color
 
     def _wrap_text(self, text, font, max_width):
-        """将文本换行以适应宽度"""
+        """将文本换行以适应宽度（测量结果由 fonts.text_bbox 缓存）"""
         words = text.split()
         lines = []
         current_line = []
 
         for word in words:
             test_line = ' '.join(current_line + [word])
-            bbox = ImageDraw.Draw(Image.new('RGB', (1, 1))).textbbox((0, 0), test_line, font=font)
-            test_width = bbox[2] - bbox[0]
+            test_width, _ = text_size(test_line, font)
 
             if test_width <= max_width:
                 current_line.append(word)
             else:
                 if current_line:
                     lines.append(' '.join(current_line))
+                    if len(lines) == 3:
+                        return lines  # 后面的文字不会显示，不必再测量
                 current_line = [word]
 
         if current_line:
@@ -262,280 +322,692 @@ class PILImageGenerator:
 # 初始化图像生成器
 pil_generator = PILImageGenerator()
 
+# 预渲染牌面的标准尺寸（宽, 高）
+DECK_SIZES = ((256, 384), (512, 768))
+_deck_lock = threading.Lock()
+
+
+def deck_image_name(card, size):
+    return f"{card.slug}.{size[0]}x{size[1]}.png"
+
+
+def render_deck_card(card, size, out_dir):
+    """渲染一张牌并保存到 out_dir；牌面由牌名决定，重复渲染结果相同"""
+    path = os.path.join(out_dir, deck_image_name(card, size))
+    image = pil_generator.render_tarot_image(card.name, card.meaning, size[0], size[1],
+                                             rng=random.Random(card.name))
+    tmp = path + '.tmp'
+    image.save(tmp, format='PNG')
+    os.replace(tmp, path)
+    return path
+
+
+def render_deck(out_dir, sizes=DECK_SIZES, deck=tarot.CARDS):
+    """离线预渲染整副牌，返回生成的文件路径"""
+    os.makedirs(out_dir, exist_ok=True)
+    return [render_deck_card(card, size, out_dir) for card in deck for size in sizes]
+
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__, template_folder='templates', static_folder='static')
     # Database path for generated image metadata
-    app.config.setdefault('DATABASE', os.path.join(app.root_path, 'generated.db'))
+    app.config.setdefault('DATABASE', os.environ.get('DATABASE', os.path.join(app.root_path, 'generated.db')))
+    # 生成图像目录（仍以 /static/generated/ 提供）
+    app.config.setdefault('GENERATED_DIR', os.environ.get('GENERATED_DIR',
+                                                          os.path.join(app.static_folder, 'generated')))
+    # 异步生成队列：GENERATE_ASYNC=true 时 /api/generate 默认返回 job id
+    app.config.setdefault('GENERATE_ASYNC', os.environ.get('GENERATE_ASYNC', 'false').lower() == 'true')
+    app.config.setdefault('GENERATE_WORKERS', int(os.environ.get('GENERATE_WORKERS', 2)))
+    app.config.setdefault('GENERATE_QUEUE_SIZE', int(os.environ.get('GENERATE_QUEUE_SIZE', 32)))
+    # 相同参数的请求直接复用已保存的图像（工作流的种子是固定的，结果可复现）
+    app.config.setdefault('GENERATION_CACHE', os.environ.get('GENERATION_CACHE', 'true').lower() == 'true')
+    app.config.setdefault('GENERATION_CACHE_MAX_ENTRIES', int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', 1000)))
+    app.config.setdefault('GENERATION_CACHE_MAX_AGE', float(os.environ.get('GENERATION_CACHE_MAX_AGE', 7 * 24 * 3600)))
+    # 保存图像后在后台生成画廊缩略图（WebP）
+    app.config.setdefault('THUMBNAILS_ON_SAVE', os.environ.get('THUMBNAILS_ON_SAVE', 'true').lower() == 'true')
+    # 生成的图片与缩略图写入后不再改变（文件名带 uuid），浏览器可长期缓存（秒）
+    app.config.setdefault('GENERATED_MAX_AGE', int(os.environ.get('GENERATED_MAX_AGE', 365 * 24 * 3600)))
+    # 单次 /api/cards/batch 最多抽取的牌阵数
+    app.config.setdefault('CARDS_BATCH_MAX', int(os.environ.get('CARDS_BATCH_MAX', 10000)))
+    # 聊天补全的时限（秒）：建立连接、首个 token / 相邻 token 的间隔、整条回复
+    app.config.setdefault('CHAT_CONNECT_TIMEOUT', float(os.environ.get('CHAT_CONNECT_TIMEOUT', 3)))
+    app.config.setdefault('CHAT_READ_TIMEOUT', float(os.environ.get('CHAT_READ_TIMEOUT', 10)))
+    app.config.setdefault('CHAT_DEADLINE', float(os.environ.get('CHAT_DEADLINE', 30)))
+    # 上游聊天回复缓存（进程内存）
+    app.config.setdefault('CHAT_CACHE', os.environ.get('CHAT_CACHE', 'true').lower() == 'true')
+    app.config.setdefault('CHAT_CACHE_MAX_ENTRIES', int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', 1000)))
+    app.config.setdefault('CHAT_CACHE_MAX_AGE', float(os.environ.get('CHAT_CACHE_MAX_AGE', 3600)))
+    # 可选：本地回复的额外意图表（JSON 列表，见 chat_replies.py）
+    app.config.setdefault('CHAT_INTENTS_FILE', os.environ.get('CHAT_INTENTS_FILE') or None)
+    # 单次批量删除最多的 id 数
+    app.config.setdefault('GENERATED_DELETE_MAX', int(os.environ.get('GENERATED_DELETE_MAX', 500)))
+    # 存储对账：每 RECONCILE_INTERVAL 秒检查一块（0 关闭后台循环），RECONCILE_REPAIR 时顺带修复；
+    # 比 RECONCILE_MIN_AGE 秒新的文件不处理（可能正在保存）
+    app.config.setdefault('RECONCILE_INTERVAL', float(os.environ.get('RECONCILE_INTERVAL', 0)))
+    app.config.setdefault('RECONCILE_REPAIR', os.environ.get('RECONCILE_REPAIR', 'false').lower() == 'true')
+    app.config.setdefault('RECONCILE_MIN_AGE', float(os.environ.get('RECONCILE_MIN_AGE', 3600)))
+    if test_config:
+        app.config.update(test_config)
+
+    db = Database(app.config['DATABASE'])
+    app.extensions['db'] = db
+    # 请求 id、分段耗时日志、可选的 Server-Timing 响应头与按请求 cProfile（tracing.py）
+    tracing.init_app(app)
 
     def init_db():
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('''
-                  CREATE TABLE IF NOT EXISTS generated
-                  (
-                      id
-                      INTEGER
-                      PRIMARY
-                      KEY
-                      AUTOINCREMENT,
-                      filename
-                      TEXT
-                      NOT
-                      NULL,
-                      prompt
-                      TEXT,
-                      crystal
-                      TEXT,
-                      created_at
-                      TEXT
-                  )
-                  ''')
-        conn.commit()
-        conn.close()
+        with db.transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                      CREATE TABLE IF NOT EXISTS generated
+                      (
+                          id
+                          INTEGER
+                          PRIMARY
+                          KEY
+                          AUTOINCREMENT,
+                          filename
+                          TEXT
+                          NOT
+                          NULL,
+                          prompt
+                          TEXT,
+                          crystal
+                          TEXT,
+                          created_at
+                          TEXT
+                      )
+                      ''')
+            # indexes backing the paginated / filtered gallery listing
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_crystal_id ON generated (crystal, id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_created_at ON generated (created_at)')
+            # 存储对账按文件名查行
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_filename ON generated (filename)')
 
     init_db()
+    gen_cache = GenerationCache(db,
+                                max_entries=app.config['GENERATION_CACHE_MAX_ENTRIES'],
+                                max_age_s=app.config['GENERATION_CACHE_MAX_AGE'])
 
     # 确保生成的图片目录存在
-    generated_dir = os.path.join(app.static_folder, 'generated')
+    generated_dir = app.config['GENERATED_DIR']
     os.makedirs(generated_dir, exist_ok=True)
+    thumbs = ThumbnailStore(db, generated_dir)
+    # 画廊 API 的 ETag / Last-Modified 来自这两张表的版本号（由触发器维护）
+    db.track_versions('generated', 'generated_thumbs')
+
+    # 已删除记录的图片文件由后台线程删除
+    unlinker = Unlinker()
+    app.extensions['unlinker'] = unlinker
+
+    def delete_generated_ids(ids):
+        """在一个事务里删除多张画廊图片，返回 (已删除的 id, 删除文件的 future)"""
+        rows = db.delete_generated(ids)
+        deleted = [gid for gid, _ in rows]
+        if not deleted:
+            return [], None
+        gen_cache.forget_generated(*deleted)
+        paths = thumbs.delete_many(deleted) + [os.path.join(generated_dir, fname) for _, fname in rows]
+        return deleted, unlinker.submit(paths)
+
+    # 找出没有记录的图片文件和文件已丢失的记录（storage.py）
+    reconciler = Reconciler(db, generated_dir, delete_generated_ids, unlinker,
+                            min_age_s=app.config['RECONCILE_MIN_AGE'])
+    app.extensions['reconciler'] = reconciler
+    if app.config['RECONCILE_INTERVAL'] > 0:
+        reconciler.start(app.config['RECONCILE_INTERVAL'], repair=app.config['RECONCILE_REPAIR'])
+    deck_dir = os.path.join(app.static_folder, 'deck')
 
-    # Minimal in-memory deck (major arcana subset for demo)
-    DECK = [
-        {"name": "The Fool", "meaning": "New beginnings, spontaneity, a leap of faith.",
-         "image": "/static/images/cards/the_fool.svg"},
-        {"name": "The Magician", "meaning": "Skill, resourcefulness, the power to manifest.",
-         "image": "/static/images/cards/the_magician.svg"},
-        {"name": "The High Priestess", "meaning": "Intuition, inner knowledge, mystery.",
-         "image": "/static/images/cards/the_high_priestess.svg"},
-        {"name": "The Empress", "meaning": "Fertility, creativity, abundance.",
-         "image": "/static/images/cards/the_empress.svg"},
-        {"name": "The Emperor", "meaning": "Structure, authority, leadership.",
-         "image": "/static/images/cards/the_emperor.svg"},
-        {"name": "The Hierophant", "meaning": "Tradition, learning, spiritual guidance."},
-        {"name": "The Lovers", "meaning": "Relationships, choices, harmony."},
-        {"name": "The Chariot", "meaning": "Willpower, success through determination."},
-        {"name": "Strength", "meaning": "Courage, patience, inner strength."},
-        {"name": "The Hermit", "meaning": "Solitude, inner search, wisdom."},
-        {"name": "Wheel of Fortune", "meaning": "Cycles, destiny, turning points."},
-        {"name": "Justice", "meaning": "Fairness, truth, law."},
-        {"name": "The Hanged Man", "meaning": "Surrender, new perspective."},
-        {"name": "Death", "meaning": "Transformation, endings and beginnings."},
-        {"name": "Temperance", "meaning": "Balance, moderation, healing."},
-        {"name": "The Devil", "meaning": "Attachments, shadow, temptation."},
-        {"name": "The Tower", "meaning": "Disruption, sudden change, revelation."},
-        {"name": "The Star", "meaning": "Hope, inspiration, renewal."},
-        {"name": "The Moon", "meaning": "Illusion, subconscious, emotions."},
-        {"name": "The Sun", "meaning": "Joy, success, vitality."},
-        {"name": "Judgement", "meaning": "Awakening, rebirth, evaluation."},
-        {"name": "The World", "meaning": "Completion, wholeness, travel."},
-    ]
 
     @app.route('/')
     def index():
         return render_template('index.html')
 
+    def draw_seed(data):
+        """请求中可选的整数 "seed"；不是非负整数时抛出 ValueError"""
+        seed = data.get('seed')
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or seed < 0):
+            raise ValueError('seed must be a non-negative integer')
+        return seed
+
     @app.route('/api/cards', methods=['POST'])
     def cards():
+        """抽一组牌；把返回的 "seed" 传回即可得到同样的牌阵"""
         data = request.json or {}
         reading = data.get('reading', 'single')
         crystal = data.get('crystal')
+        try:
+            seed = draw_seed(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        counts = {'single': 1, 'three': 3, 'five': 5}
-        num = counts.get(reading, 1)
-        picked = random.sample(DECK, k=num)
-
-        # add reversed randomly for flavor
-        for c in picked:
-            c['reversed'] = random.choice([False, False, True])
+        # 牌组不可变：每张抽到的牌都是本次请求独有的视图（位置、正逆位）
+        seed, picked = tarot.draw(reading if reading in tarot.SPREADS else 'single', seed)
 
         response = {
             'crystal': crystal,
             'reading': reading,
-            'cards': picked,
+            'seed': seed,
+            'cards': [dict(tarot.as_dict(c), deck_image=f"/api/cards/{c.card.slug}/image") for c in picked],
             'message': f'A {reading} card reading using {crystal or "your chosen crystal"}.'
         }
         return jsonify(response)
 
+    @app.route('/api/cards/batch', methods=['POST'])
+    def cards_batch():
+        """一次抽取大量牌阵，供模拟与统计分析使用
+
+        请求体：{"reading": "three", "count": 1000, "seed": 42}。返回每组牌阵的
+        牌索引（"draws"，对应 "deck" 中的牌名）与正逆位，以及每张牌出现的次数。
+        """
+        data = request.json or {}
+        reading = data.get('reading', 'single')
+        count = data.get('count', 1)
+        if reading not in tarot.SPREADS:
+            return jsonify({'error': 'unknown reading', 'readings': list(tarot.SPREADS)}), 400
+        if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= app.config['CARDS_BATCH_MAX']:
+            return jsonify({'error': f"count must be an integer from 1 to {app.config['CARDS_BATCH_MAX']}"}), 400
+        try:
+            seed = draw_seed(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        with span('cards.draw_batch', count=count):
+            seed, indices, reversed_ = tarot.draw_batch(reading, count, seed)
+        return jsonify({
+            'reading': reading,
+            'count': count,
+            'seed': seed,
+            'positions': list(tarot.SPREADS[reading]),
+            'deck': [c.name for c in tarot.CARDS],
+            'draws': tarot.to_lists(indices),
+            'reversed': tarot.to_lists(reversed_),
+            'frequencies': tarot.frequencies(indices),
+        })
+
+    @app.route('/api/cards/<slug>/image', methods=['GET'])
+    def card_image(slug):
+        """返回预渲染的牌面（?size=512x768）；缺失时渲染一次并保存，之后直接读取文件"""
+        card = tarot.BY_SLUG.get(slug)
+        if card is None:
+            return jsonify({'error': 'unknown card'}), 404
+        size = request.args.get('size', '%dx%d' % DECK_SIZES[-1])
+        sizes = {'%dx%d' % s: s for s in DECK_SIZES}
+        if size not in sizes:
+            return jsonify({'error': 'unsupported size', 'sizes': list(sizes)}), 404
+        fname = deck_image_name(card, sizes[size])
+        if not os.path.exists(os.path.join(deck_dir, fname)):
+            with _deck_lock:
+                if not os.path.exists(os.path.join(deck_dir, fname)):
+                    os.makedirs(deck_dir, exist_ok=True)
+                    render_deck_card(card, sizes[size], deck_dir)
+        return send_from_directory(deck_dir, fname)
+
     @app.route('/generated')
     def gallery():
         return render_template('generated.html')
 
+    def generated_filters(args):
+        """Build the WHERE clause shared by the gallery listing and count.
+
+        Supported query args: crystal, since, until (ISO timestamps, compared
+        against created_at). Raises ValueError on malformed input.
+        """
+        clauses, params = [], []
+        crystal = args.get('crystal')
+        if crystal:
+            clauses.append('crystal = ?')
+            params.append(crystal)
+        for arg, op in (('since', '>='), ('until', '<')):
+            value = args.get(arg)
+            if value:
+                datetime.fromisoformat(value)
+                clauses.append(f'created_at {op} ?')
+                params.append(value)
+        return clauses, params
+
+    def gallery_validators():
+        """ETag and Last-Modified of the gallery API, from the table version counters."""
+        versions = db.versions('generated', 'generated_thumbs')
+        etag = 'gallery-%d-%d' % (versions['generated'][0], versions['generated_thumbs'][0])
+        last_modified = datetime.fromtimestamp(int(max(v[1] for v in versions.values())), timezone.utc)
+        return etag, last_modified
+
+    def revalidate(response, etag, last_modified):
+        """Let clients keep the response but check it with a conditional GET (304 when unchanged)."""
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    @app.route('/static/generated/<path:filename>')
+    def generated_file(filename):
+        """从 GENERATED_DIR 提供生成的图像与缩略图（URL 不变）"""
+        return send_from_directory(generated_dir, filename)
+
+    @app.after_request
+    def cache_generated_assets(response):
+        # 生成的图片、缩略图文件名带 uuid，id 也不会复用：内容永不改变
+        if response.status_code in (200, 304) and (request.path.startswith('/static/generated/')
+                                                    or request.endpoint == 'generated_thumb'):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['GENERATED_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+
     @app.route('/api/generated', methods=['GET'])
     def list_generated():
-        # return list of generated images from DB
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT id, filename, prompt, crystal, created_at FROM generated ORDER BY id DESC')
-        rows = c.fetchall()
-        conn.close()
+        """Keyset-paginated list of generated images, newest first.
+
+        ?limit=N (default 50, max 200) and ?cursor=<next_cursor from the previous page>,
+        plus the crystal/since/until filters. Answers 304 to a conditional GET while the
+        gallery tables are unchanged.
+        """
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+            cursor = request.args.get('cursor', type=int)
+            clauses, params = generated_filters(request.args)
+        except ValueError as e:
+            return jsonify({'error': f'invalid query: {e}'}), 400
+        etag, last_modified = gallery_validators()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return revalidate(app.response_class(status=304), etag, last_modified)
+        if cursor is not None:
+            clauses.append('id < ?')
+            params.append(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        # fetch one extra row to know whether another page exists
+        rows = db.query(f'SELECT id, filename, prompt, crystal, created_at FROM generated {where} ORDER BY id DESC LIMIT ?',
+                        params + [limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        thumb_urls = thumbs.urls_for(r[0] for r in rows)
         items = []
         for r in rows:
-            items.append(
-                {'id': r[0], 'image': '/static/generated/' + r[1], 'prompt': r[2], 'crystal': r[3], 'created_at': r[4]})
-        return jsonify({'items': items})
+            items.append({'id': r[0], 'image': '/static/generated/' + r[1], 'prompt': r[2], 'crystal': r[3], 'created_at': r[4],
+                          'thumbnails': thumb_urls[r[0]]})
+        return revalidate(jsonify({'items': items, 'next_cursor': rows[-1][0] if has_more else None}),
+                          etag, last_modified)
 
-    @app.route('/api/generated/<int:gid>', methods=['DELETE'])
-    def delete_generated(gid):
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT filename FROM generated WHERE id=?', (gid,))
-        row = c.fetchone()
+    @app.route('/api/generated/count', methods=['GET'])
+    def count_generated():
+        try:
+            clauses, params = generated_filters(request.args)
+        except ValueError as e:
+            return jsonify({'error': f'invalid query: {e}'}), 400
+        etag, last_modified = gallery_validators()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return revalidate(app.response_class(status=304), etag, last_modified)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        count = db.query_one(f'SELECT COUNT(*) FROM generated {where}', params)[0]
+        return revalidate(jsonify({'count': count}), etag, last_modified)
+
+
+    @app.route('/api/generated/<int:gid>/thumb/<int:width>', methods=['GET'])
+    def generated_thumb(gid, width):
+        """返回缩略图，首次请求时生成并记录到数据库"""
+        if width not in thumbs.sizes:
+            return jsonify({'error': 'unsupported size', 'sizes': list(thumbs.sizes)}), 404
+        row = db.query_one('SELECT filename FROM generated WHERE id=?', (gid,))
         if not row:
-            conn.close()
             return jsonify({'error': 'not found'}), 404
-        filename = row[0]
-        c.execute('DELETE FROM generated WHERE id=?', (gid,))
-        conn.commit()
-        conn.close()
-        # remove file
-        path = os.path.join(app.static_folder, 'generated', filename)
         try:
-            if os.path.exists(path):
-                os.remove(path)
-        except Exception:
-            pass
+            fname = thumbs.ensure(gid, row[0]).get(width)
+        except OSError:
+            fname = None
+        if not fname:
+            return jsonify({'error': 'image file missing'}), 404
+        return send_from_directory(thumbs.thumbs_dir, fname)
+
+    @app.route('/api/generated/<int:gid>', methods=['DELETE'])
+    def delete_generated(gid):
+        deleted, removal = delete_generated_ids([gid])
+        if not deleted:
+            return jsonify({'error': 'not found'}), 404
+        # 单张删除等文件删完再返回
+        removal.result()
         return jsonify({'deleted': gid})
 
+    @app.route('/api/generated/delete', methods=['POST'])
+    def delete_generated_bulk():
+        """批量删除画廊图片
+
+        请求体：{"ids": [1, 2, 3]}。记录在一个事务里删除，文件由后台删除；
+        返回已删除的 id 和不存在的 id。
+        """
+        ids = (request.json or {}).get('ids')
+        if (not isinstance(ids, list) or len(ids) > app.config['GENERATED_DELETE_MAX']
+                or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+            return jsonify({'error': f"ids must be a list of at most {app.config['GENERATED_DELETE_MAX']} integers"}), 400
+        with span('generated.delete_bulk', count=len(ids)):
+            deleted, _ = delete_generated_ids(set(ids))
+        return jsonify({'deleted': sorted(deleted), 'missing': sorted(set(ids) - set(deleted))})
+
+    @app.route('/api/generated/reconcile', methods=['POST'])
+    def reconcile_generated():
+        """报告没有记录的图片文件和文件已丢失的记录；{"repair": true} 时一并清理"""
+        repair = (request.get_json(silent=True) or {}).get('repair') is True
+        with span('generated.reconcile', repair=repair):
+            return jsonify(reconciler.run(repair=repair))
+
+    @app.route('/api/db/stats', methods=['GET'])
+    def db_stats():
+        """SQLite 语句耗时统计（次数 / 总计 / 平均 / 最大，毫秒）"""
+        return jsonify({'statements': db.stats()})
+
+    @app.route('/api/backends', methods=['GET'])
+    def backends():
+        """ComfyUI 节点池状态（健康、熔断、进行中的请求、队列深度、延迟）"""
+        return jsonify({'comfyui': get_pool().stats()})
+
+    # 无 API key（或调用失败）时使用的本地规则回复：意图表启动时编译为一个匹配器（chat_replies.py）
+    intents = IntentMatcher(load_intents(app.config['CHAT_INTENTS_FILE']))
+    # 重复问题直接复用上游回复，按规范化后的 (message, crystal) 缓存
+    chat_cache = ReplyCache(max_entries=app.config['CHAT_CACHE_MAX_ENTRIES'] if app.config['CHAT_CACHE'] else 0,
+                            max_age_s=app.config['CHAT_CACHE_MAX_AGE'])
+    app.extensions['chat_cache'] = chat_cache
+
+    def chat_prompt(msg):
+        # small prompt that keeps things light and mystical
+        return (
+            "You are a friendly fortune-teller bot. Respond helpfully and briefly. "
+            f"User message: {msg}"
+        )
+
+    def fallback_reply(msg):
+        return intents.reply(msg)
+
+    def completions_url():
+        return os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/') + '/completions'
+
+    def completion_payload(msg):
+        return {
+            'model': os.environ.get('OPENAI_ENGINE', 'text-daventi-003'),
+            'prompt': chat_prompt(msg),
+            'max_tokens': 150,
+            'temperature': 0.9,
+        }
+
+    def event_stream(events):
+        # no-cache / X-Accel-Buffering 防止代理缓冲 token
+        return Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     @app.route('/api/chat', methods=['POST'])
     def chat():
+        """回复聊天消息；传入 "stream": true 时以 Server-Sent Events 逐个转发 token（见 chat_stream.py）"""
         data = request.json or {}
         msg = data.get('message', '')
         crystal = data.get('crystal')
+        openai_key = os.environ.get('OPENAI_API_KEY')
+
+        if data.get('stream'):
+            tokens = None
+            if openai_key:
+                cached = chat_cache.get(msg, crystal)
+                if cached is not None:
+                    return event_stream(replay(cached))
+                tokens = completion_tokens(get_client(), completions_url(), openai_key, completion_payload(msg),
+                                           connect_timeout=app.config['CHAT_CONNECT_TIMEOUT'],
+                                           read_timeout=app.config['CHAT_READ_TIMEOUT'],
+                                           deadline=app.config['CHAT_DEADLINE'])
+            return event_stream(relay(tokens, lambda: fallback_reply(msg),
+                                      on_reply=lambda reply: chat_cache.put(msg, crystal, reply)))
 
         # If OpenAI key is available and openai package is installed, use it.
-        openai_key = os.environ.get('OPENAI_API_KEY')
         if openai and openai_key:
+            cached = chat_cache.get(msg, crystal)
+            if cached is not None:
+                return jsonify({'reply': cached})
             try:
                 openai.api_key = openai_key
-                # small prompt that keeps things light and mystical
-                prompt = (
-                    "You are a friendly fortune-teller bot. Respond helpfully and briefly. "
-                    f"User message: {msg}"
-                )
                 completion = openai.Completion.create(
                     engine=os.environ.get('OPENAI_ENGINE', 'text-daventi-003'),
-                    prompt=prompt,
+                    prompt=chat_prompt(msg),
                     max_tokens=150,
                     temperature=0.9,
+                    request_timeout=(app.config['CHAT_CONNECT_TIMEOUT'], app.config['CHAT_DEADLINE']),
                 )
                 text = completion.choices[0].text.strip()
+                chat_cache.put(msg, crystal, text)
                 return jsonify({'reply': text})
             except Exception as e:
                 # fall through to local responder
                 print('OpenAI call failed:', e)
 
-        # Local simple rule-based reply when no API key
-        fallback_replies = [
-            "I sense a change approaching — be open and stay curious.",
-            "Follow your intuition today; a small choice will lead somewhere meaningful.",
-            "The crystal's glow points to new connections shortly.",
-            "Take a breath. A clear head will reveal the right next step.",
-            "Trust the small signals — they add up to big answers.",
-        ]
-
-        # sprinkle in parts of the user's message for perceived relevance
-        if msg:
-            if 'love' in msg.lower():
-                reply = "Love is in flux — honest communication will guide you."
-            elif 'work' in msg.lower() or 'career' in msg.lower():
-                reply = "At work, steady focus wins. Consider which task needs your clarity."
-            else:
-                reply = random.choice(fallback_replies)
-        else:
-            reply = random.choice(fallback_replies)
-
-        return jsonify({'reply': reply})
+        return jsonify({'reply': fallback_reply(msg)})
 
-    def save_base64_image(b64data, prefix='pil'):
-        """保存base64图像到文件系统"""
-        # 移除data:image/png;base64,前缀
-        if b64data.startswith('data:image'):
-            b64data = b64data.split(',', 1)[1]
-
-        try:
-            image_binary = base64.b64decode(b64data)
-        except Exception as e:
-            print(f"Base64解码失败: {e}")
-            return None
+    def save_image(image, prefix='pil'):
+        """保存 PIL 图像或原始 PNG 字节到文件系统并写入数据库，返回公开 URL
 
+        生成流程直接把 PIL 图像交给这里，避免 PNG -> base64 -> PNG 的多次拷贝。
+        """
         # 生成唯一文件名
         import uuid
         fname = f"{prefix}-{uuid.uuid4().hex[:12]}.png"
-        out_path = os.path.join(app.static_folder, 'generated', fname)
+        out_path = os.path.join(generated_dir, fname)
 
         # 确保目录存在
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-        # 保存图像文件
-        with open(out_path, 'wb') as f:
-            f.write(image_binary)
+        # 保存图像文件：PIL 图像直接编码写入文件（不在内存中保留整张 PNG），编码与写盘合计一次计时
+        if isinstance(image, Image.Image):
+            with span('image.encode'), IMAGE_ENCODE.time():
+                image.save(out_path, format='PNG')
+        else:
+            with span('disk_write', bytes=len(image)), DISK_WRITE.time(), open(out_path, 'wb') as f:
+                f.write(image)
 
         # 插入元数据到数据库
         try:
-            conn = sqlite3.connect(app.config['DATABASE'])
-            c = conn.cursor()
-            c.execute('INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)',
-                      (fname, "Generated Image", "default", datetime.utcnow().isoformat()))
-            conn.commit()
-            conn.close()
+            with span('db.insert'):
+                gid = db.insert_generated(fname, "Generated Image", "default", datetime.utcnow().isoformat())
             print(f"✅ 图像保存成功: {fname}")
+            if app.config['THUMBNAILS_ON_SAVE']:
+                thumbs.schedule(gid, fname)
         except Exception as e:
             print(f"数据库保存失败: {e}")
 
         return f'/static/generated/{fname}'
 
-    @app.route('/api/generate', methods=['POST'])
-    def generate():
-        """Generate an image using PIL"""
-        data = request.json or {}
-        prompt = data.get('prompt', 'A mystical vision')
-        crystal = data.get('crystal', 'default')
-        width = data.get('width', 512)
-        height = data.get('height', 1080)
+    @traced('save_base64_image')
+    def save_base64_image(b64data, prefix='pil'):
+        """保存base64图像到文件系统"""
+        # 移除data:image/png;base64,前缀
+        if b64data.startswith('data:image'):
+            b64data = b64data.split(',', 1)[1]
+
+        try:
+            image_binary = base64.b64decode(b64data)
+        except Exception as e:
+            print(f"Base64解码失败: {e}")
+            return None
 
+        return save_image(image_binary, prefix=prefix)
+
+    def inline_image_data(url):
+        """读取已保存的图像并编码为 data URL（仅在客户端请求 inline 时使用）"""
+        path = os.path.join(generated_dir, url.rsplit('/', 1)[-1])
+        with open(path, 'rb') as f:
+            return 'data:image/png;base64,' + base64.b64encode(f.read()).decode()
+
+    job_queue = JobQueue(max_workers=app.config['GENERATE_WORKERS'],
+                         max_pending=app.config['GENERATE_QUEUE_SIZE'])
+    app.extensions['job_queue'] = job_queue
+
+    def generation_key(prompt, width, height, workflow):
+        return cache_key({'backend': 'comfyui', 'workflow': workflows.get(workflow).fingerprint,
+                          'prompt': prompt, 'width': width, 'height': height})
+
+    def lookup_cache(key):
+        with span('cache.lookup') as attrs:
+            hit = gen_cache.get(key)
+            attrs['hit'] = bool(hit)
+        return hit
+
+    def cached_response(hit, prompt):
+        print(f"♻️ 命中生成缓存: {hit['images'][0]}")
+        return {
+            'image': hit['images'][0],
+            'prompt': prompt,
+            'note': 'Served from generation cache',
+            'type': 'pil_generated',
+            'cached': True,
+            'success': True
+        }, 200
+
+    def saved_response(url, prompt):
+        if url:
+            print(f"✅ 图像生成成功: {url}")
+            return {
+                'image': url,
+                'prompt': prompt,
+                'note': 'Generated with PIL Image Generator',
+                'type': 'pil_generated',
+                'success': True
+            }, 200
+        else:
+            print("❌ 图像保存失败")
+            return {
+                'image': '/static/images/card-back.png',
+                'prompt': prompt,
+                'note': 'Failed to save generated image',
+                'success': False
+            }, 200
+
+    def failed_response(e, prompt):
+        print(f"❌ PIL图像生成失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'image': '/static/images/card-back.png',
+            'prompt': prompt,
+            'note': f'Image generation failed: {str(e)}',
+            'success': False
+        }, 500
+
+    def run_generation(prompt, crystal, width, height, use_cache=True, workflow='base'):
+        """执行一次生成，返回 (响应字典, HTTP 状态码)
+
+        相同 (prompt, 尺寸, 工作流) 的请求命中缓存时直接返回已有图像；
+        并发的相同请求只会调用一次 ComfyUI。
+        """
+        if not (use_cache and app.config['GENERATION_CACHE']):
+            return generate_and_save(prompt, width, height, workflow)
+
+        key = generation_key(prompt, width, height, workflow)
+        hit = lookup_cache(key)
+        if hit:
+            return cached_response(hit, prompt)
+
+        def generate_and_cache():
+            body, status = generate_and_save(prompt, width, height, workflow)
+            if body.get('success'):
+                gen_cache.put(key, [body['image']])
+            return body, status
+
+        (body, status), shared = gen_cache.flight.do(key, generate_and_cache)
+        if shared:
+            body = dict(body, cached=True)
+        return body, status
+
+    def generate_and_save(prompt, width, height, workflow='base'):
+        """生成并保存一张图像；统计进行中的生成数和成功 / 失败次数（/metrics）"""
+        with GENERATIONS_IN_FLIGHT.track_inprogress():
+            body, status = render_and_save(prompt, width, height, workflow)
+        GENERATE_TOTAL.inc(result='success' if body.get('success') else 'failure')
+        return body, status
+
+    def render_and_save(prompt, width, height, workflow):
         print(f"🎨 收到生成请求: {prompt}")
 
         # 使用PIL生成图像
         try:
             # 强制使用 ComfyUI 生成通用占卜图像
             print("✨ 生成通用占卜图像 (ComfyUI)")
-            image_data = pil_generator.generate_fortune_image(prompt, width, height)
+            with span('render_fortune_image', workflow=workflow):
+                image = pil_generator.render_fortune_image(prompt, width, height, workflow=workflow)
 
             # 保存图像到文件系统
-            url = save_base64_image(image_data)
-
-            if url:
-                print(f"✅ 图像生成成功: {url}")
-                return jsonify({
-                    'image': url,
-                    'prompt': prompt,
-                    'note': 'Generated with PIL Image Generator',
-                    'type': 'pil_generated',
-                    'success': True
-                })
-            else:
-                print("❌ 图像保存失败")
-                return jsonify({
-                    'image': '/static/images/card-back.png',
-                    'prompt': prompt,
-                    'note': 'Failed to save generated image',
-                    'success': False
-                })
+            with span('save_image'):
+                url = save_image(image)
+            return saved_response(url, prompt)
 
         except Exception as e:
-            print(f"❌ PIL图像生成失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({
-                'image': '/static/images/card-back.png',
-                'prompt': prompt,
-                'note': f'Image generation failed: {str(e)}',
+            return failed_response(e, prompt)
+
+    def generate_params(data):
+        """解析 /api/generate 请求体，返回 (参数, 错误响应体)；工作流不存在时错误响应体不为空"""
+        params = {
+            'prompt': data.get('prompt', 'A mystical vision'),
+            'crystal': data.get('crystal', 'default'),
+            'width': data.get('width', 512),
+            'height': data.get('height', 1080),
+            # 可选：使用 workflows/<name>.json 中的命名工作流
+            'workflow': data.get('workflow') or 'base',
+            'use_cache': data.get('cache', True),
+        }
+        try:
+            workflows.get(params['workflow'])
+        except (WorkflowError, OSError, ValueError) as e:
+            return params, {'prompt': params['prompt'], 'note': f'Invalid workflow: {e}', 'success': False}
+        return params, None
+
+    def submit_job(params):
+        """把生成任务放入后台队列，返回 (响应字典, HTTP 状态码)"""
+        try:
+            # 后台任务沿用本请求的 request id 记录分段日志
+            job_id = job_queue.submit(tracing.bind(run_generation), **params)
+        except QueueFullError as e:
+            return {
+                'prompt': params['prompt'],
+                'note': f'Generation queue is full: {e}',
                 'success': False
-            }), 500
+            }, 503
+        return {
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': f'/api/jobs/{job_id}',
+            'prompt': params['prompt']
+        }, 202
+
+    @app.route('/api/generate', methods=['POST'])
+    def generate():
+        """Generate an image using PIL
+
+        传入 "async": true（或设置 GENERATE_ASYNC=true）时立即返回 job id，
+        由后台线程池执行生成，客户端轮询 /api/jobs/<job_id> 获取结果。
+        传入 "inline": true 时额外返回 base64 图像数据 (image_data)。
+        """
+        data = request.json or {}
+        params, error = generate_params(data)
+        if error:
+            return jsonify(error), 400
+
+        if not data.get('async', app.config['GENERATE_ASYNC']):
+            body, status = run_generation(**params)
+            if data.get('inline') and body.get('success'):
+                body = dict(body, image_data=inline_image_data(body['image']))
+            return jsonify(body), status
+
+        body, status = submit_job(params)
+        return jsonify(body), status
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        """查询异步生成任务的状态与结果（?inline=1 时附带 base64 图像数据）"""
+        job = job_queue.get(job_id)
+        if not job:
+            return jsonify({'error': 'not found'}), 404
+        out = {'job_id': job_id, 'status': job['status']}
+        if job['status'] == 'done':
+            out['result'], _ = job['result']
+            if request.args.get('inline') and out['result'].get('success'):
+                out['result'] = dict(out['result'], image_data=inline_image_data(out['result']['image']))
+        elif job['status'] == 'failed':
+            out['error'] = job['error']
+        return jsonify(out)
 
     @app.route('/api/test_pil_generation')
     def test_pil_generation():
@@ -562,7 +1034,9 @@ def create_app():
                 'message': 'PIL image generation is working',
                 'tarot_sample': tarot_image[:100] + '...' if tarot_image else None,
                 'crystal_sample': crystal_image[:100] + '...' if crystal_image else None,
-                'fortune_sample': fortune_image[:100] + '...' if fortune_image else None
+                'fortune_sample': fortune_image[:100] + '...' if fortune_image else None,
+                'font_cache': fonts.cache_info(),
+                'layer_cache': pil_generator.layers.info()
             })
         except Exception as e:
             return jsonify({
@@ -570,6 +1044,11 @@ def create_app():
                 'message': f'PIL generation failed: {str(e)}'
             }), 500
 
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """Prometheus 指标：生成各阶段耗时直方图、SQLite 语句耗时、生成计数"""
+        return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
     @app.route('/api/health')
     def health_check():
         """健康检查端点"""
@@ -579,10 +1058,121 @@ def create_app():
             'timestamp': datetime.utcnow().isoformat()
         })
 
+    # 异步服务模式（create_asgi_app）：/api/generate 与 /api/chat 以协程运行，
+    # 通过 asyncio HTTP 客户端等待 ComfyUI / OpenAI，其余路由仍由 Flask 处理；
+    # 磁盘、SQLite 与 PIL 操作放到工作线程执行
+    asgi = AsgiApp(app)
+    app.extensions['asgi'] = asgi
+
+    async def run_generation_async(prompt, crystal, width, height, use_cache=True, workflow='base'):
+        """run_generation 的异步版本：缓存与单飞逻辑相同，等待 ComfyUI 时不占用线程"""
+        if not (use_cache and app.config['GENERATION_CACHE']):
+            return await generate_and_save_async(prompt, width, height, workflow)
+
+        key = generation_key(prompt, width, height, workflow)
+        hit = await asyncio.to_thread(lookup_cache, key)
+        if hit:
+            return cached_response(hit, prompt)
+
+        async def generate_and_cache():
+            body, status = await generate_and_save_async(prompt, width, height, workflow)
+            if body.get('success'):
+                await asyncio.to_thread(gen_cache.put, key, [body['image']])
+            return body, status
+
+        (body, status), shared = await gen_cache.async_flight.do(key, generate_and_cache)
+        if shared:
+            body = dict(body, cached=True)
+        return body, status
+
+    async def generate_and_save_async(prompt, width, height, workflow='base'):
+        with GENERATIONS_IN_FLIGHT.track_inprogress():
+            body, status = await render_and_save_async(prompt, width, height, workflow)
+        GENERATE_TOTAL.inc(result='success' if body.get('success') else 'failure')
+        return body, status
+
+    async def render_and_save_async(prompt, width, height, workflow):
+        print(f"🎨 收到生成请求: {prompt}")
+        try:
+            print("✨ 生成通用占卜图像 (ComfyUI)")
+            with span('render_fortune_image', workflow=workflow):
+                image = await pil_generator.render_fortune_image_async(prompt, width, height, workflow=workflow)
+            with span('save_image'):
+                url = await asyncio.to_thread(save_image, image)
+            return saved_response(url, prompt)
+        except Exception as e:
+            return failed_response(e, prompt)
+
+    @asgi.route('/api/generate')
+    async def generate_async(req):
+        """/api/generate 的异步版本，请求与响应 JSON 与 Flask 视图一致"""
+        data = req.json or {}
+        params, error = generate_params(data)
+        if error:
+            return error, 400
+
+        if not data.get('async', app.config['GENERATE_ASYNC']):
+            body, status = await run_generation_async(**params)
+            if data.get('inline') and body.get('success'):
+                body = dict(body, image_data=await asyncio.to_thread(inline_image_data, body['image']))
+            return body, status
+
+        # "async": true 的任务仍交给后台线程池（job id 与 /api/jobs 轮询接口不变）
+        return submit_job(params)
+
+    @asgi.route('/api/chat')
+    async def chat_async(req):
+        """/api/chat 的异步版本：通过 OpenAI REST 接口（OPENAI_API_BASE）异步请求补全"""
+        data = req.json or {}
+        msg = data.get('message', '')
+        crystal = data.get('crystal')
+        openai_key = os.environ.get('OPENAI_API_KEY')
+        cached = chat_cache.get(msg, crystal) if openai_key else None
+
+        if data.get('stream'):
+            tokens = None
+            if cached is not None:
+                return StreamingBody(replay(cached)), 200
+            if openai_key:
+                tokens = completion_tokens_async(get_async_client(), completions_url(), openai_key,
+                                                 completion_payload(msg),
+                                                 read_timeout=app.config['CHAT_READ_TIMEOUT'],
+                                                 deadline=app.config['CHAT_DEADLINE'])
+            return StreamingBody(relay_async(tokens, lambda: fallback_reply(msg),
+                                             on_reply=lambda reply: chat_cache.put(msg, crystal, reply))), 200
+
+        if cached is not None:
+            return {'reply': cached}, 200
+        if openai_key:
+            try:
+                r = await get_async_client().post(completions_url(), json=completion_payload(msg),
+                                                  headers={'Authorization': f'Bearer {openai_key}'},
+                                                  timeout=app.config['CHAT_DEADLINE'])
+                r.raise_for_status()
+                text = r.json()['choices'][0]['text'].strip()
+                chat_cache.put(msg, crystal, text)
+                return {'reply': text}, 200
+            except Exception as e:
+                # fall through to local responder
+                print('OpenAI call failed:', e)
+
+        return {'reply': fallback_reply(msg)}, 200
+
     return app
 
 
+def create_asgi_app(test_config=None):
+    """异步服务模式入口：uvicorn app:create_asgi_app --factory（见 asgi_bridge.py）"""
+    return create_app(test_config).extensions['asgi']
+
+
 if __name__ == '__main__':
+    if '--render-deck' in sys.argv:
+        # 离线预渲染整副牌到 static/deck/，请求时直接返回文件
+        out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'deck')
+        paths = render_deck(out_dir)
+        print(f"✅ 已预渲染 {len(paths)} 张牌面到 {out_dir}")
+        sys.exit(0)
     app = create_app()
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
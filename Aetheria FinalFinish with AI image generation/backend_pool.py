@@ -0,0 +1,284 @@
+"""Pool of interchangeable generation backends (several SD / ComfyUI boxes).
+
+- least-outstanding-requests routing: a call goes to the available node with
+  the fewest requests in flight (then the shortest probed queue, ties
+  round-robin)
+- a circuit breaker per node: ``failure_threshold`` consecutive failures
+  (connection errors, timeouts, 5xx) eject the node for ``reset_timeout_s``;
+  afterwards a single trial request decides whether it rejoins the pool
+- only failures before the request was sent (:data:`RETRYABLE`) are retried
+  on another node; a timeout after it was accepted is counted but never
+  resubmitted, so a slow render is not run twice
+- optional health probes in a background thread: a GET on ``health_path``
+  marks the node up or down and can report its queue depth
+- per-node stats (requests, errors, latency, in flight, queue depth)
+"""
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+from async_http import ConnectError
+from http_client import get_client
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+# the request never reached the node, so it is safe to send it to another one
+# (requests.ConnectTimeout is a requests.ConnectionError; a ReadTimeout is not)
+RETRYABLE = (requests.ConnectionError, ConnectError, ConnectionRefusedError)
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class BackendNode:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.state = CLOSED
+        self.failures = 0           # consecutive
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.ewma_ms = None
+        self.queue_depth = None
+        self.last_error = None
+        self.last_probe = None
+
+    def snapshot(self) -> dict:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'queue_depth': self.queue_depth,
+            'requests': self.requests,
+            'errors': self.errors,
+            'consecutive_failures': self.failures,
+            'avg_ms': round(self.total_ms / self.requests, 1) if self.requests else None,
+            'ewma_ms': round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+            'max_ms': round(self.max_ms, 1),
+            'last_error': self.last_error,
+            'last_probe': self.last_probe,
+        }
+
+
+class Lease:
+    """The node picked for one call; ``failed()`` counts a non-exception failure (e.g. a 5xx)."""
+
+    def __init__(self, node: BackendNode, trial: bool = False):
+        self.node = node
+        self.url = node.url
+        self.trial = trial  # the single request let through to a half-open node
+        self.error = None
+
+    def failed(self, reason: str):
+        self.error = reason
+
+
+class BackendPool:
+    def __init__(self, urls, health_path: str = None, depth_fn=None, probe_interval_s: float = 10.0,
+                 probe_timeout_s: float = 2.0, failure_threshold: int = 3, reset_timeout_s: float = 30.0):
+        """``urls`` are the per-node endpoints callers use; probes hit ``health_path`` on each
+        node's origin and ``depth_fn(json)`` may extract its queue depth."""
+        if not urls:
+            raise ValueError('BackendPool needs at least one url')
+        self.nodes = [BackendNode(u) for u in urls]
+        self.health_path = health_path
+        self.depth_fn = depth_fn
+        self.probe_interval_s = probe_interval_s
+        self.probe_timeout_s = probe_timeout_s
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._prober = None
+        self._stop = threading.Event()
+
+    # routing -------------------------------------------------------------
+
+    def acquire(self, exclude=(), url: str = None) -> Lease:
+        """Pick a node and count the call as in flight; pair with :meth:`release`.
+
+        ``url`` pins the call to that node whatever its state, for follow-ups
+        to work it already accepted (e.g. downloading the images it rendered).
+        """
+        self._ensure_prober()
+        now = time.monotonic()
+        with self._lock:
+            if url is not None:
+                node = next((n for n in self.nodes if n.url == url), None)
+                if node is None:
+                    raise NoBackendAvailable(f'{url} is not in the pool')
+                node.outstanding += 1
+                return Lease(node)
+            candidates = [n for n in self.nodes if n not in exclude and self._available(n, now)]
+            if not candidates:
+                raise NoBackendAvailable(f'no healthy backend among {[n.url for n in self.nodes]}')
+            # rotate so ties are spread round-robin
+            self._turn = (self._turn + 1) % len(self.nodes)
+            order = {n: (i - self._turn) % len(self.nodes) for i, n in enumerate(self.nodes)}
+            node = min(candidates, key=lambda n: (n.outstanding, n.queue_depth or 0, order[n]))
+            if node.state == OPEN:
+                node.state = HALF_OPEN
+            trial = node.state == HALF_OPEN
+            if trial:
+                node.trial_in_flight = True
+            node.outstanding += 1
+        return Lease(node, trial)
+
+    def release(self, lease: Lease, elapsed_s: float, error=None, neutral: bool = False):
+        """Record the outcome; ``neutral`` calls (caller bugs, bad input) leave the breaker alone."""
+        node = lease.node
+        error = error or lease.error
+        ms = elapsed_s * 1000
+        with self._lock:
+            node.outstanding -= 1
+            if lease.trial:
+                node.trial_in_flight = False
+            if neutral and error is None:
+                return
+            node.requests += 1
+            node.total_ms += ms
+            node.max_ms = max(node.max_ms, ms)
+            node.ewma_ms = ms if node.ewma_ms is None else 0.8 * node.ewma_ms + 0.2 * ms
+            if error is None:
+                node.failures = 0
+                node.state = CLOSED
+                return
+            node.errors += 1
+            node.failures += 1
+            node.last_error = str(error)[:200]
+            if node.state == HALF_OPEN or node.failures >= self.failure_threshold:
+                if node.state != OPEN:
+                    logger.warning('Ejecting backend %s after %d failures: %s', node.url, node.failures, error)
+                node.state = OPEN
+                node.opened_at = time.monotonic()
+
+    @contextmanager
+    def attempt(self, exclude=(), url: str = None):
+        """``with pool.attempt() as lease:`` -- connection errors and timeouts (``OSError``)
+        raised inside, or ``lease.failed()``, count against the node's breaker."""
+        lease = self.acquire(exclude, url)
+        start = time.monotonic()
+        try:
+            yield lease
+        except OSError as e:
+            self.release(lease, time.monotonic() - start, e)
+            raise
+        except BaseException:
+            self.release(lease, time.monotonic() - start, neutral=True)
+            raise
+        else:
+            self.release(lease, time.monotonic() - start)
+
+    def call(self, fn, retries: int = 1):
+        """Run ``fn(lease)`` on a node, retrying on another node if it could not be reached (:data:`RETRYABLE`)."""
+        tried = []
+        while True:
+            try:
+                with self.attempt(exclude=tried) as lease:
+                    return fn(lease)
+            except RETRYABLE:
+                tried.append(lease.node)
+                if len(tried) > retries or len(tried) == len(self.nodes):
+                    raise
+
+    @asynccontextmanager
+    async def attempt_async(self, exclude=(), url: str = None):
+        """:meth:`attempt` for coroutines; routing and bookkeeping are the same."""
+        lease = self.acquire(exclude, url)
+        start = time.monotonic()
+        try:
+            yield lease
+        except OSError as e:
+            self.release(lease, time.monotonic() - start, e)
+            raise
+        except BaseException:
+            self.release(lease, time.monotonic() - start, neutral=True)
+            raise
+        else:
+            self.release(lease, time.monotonic() - start)
+
+    async def call_async(self, fn, retries: int = 1):
+        """Await ``fn(lease)`` on a node, retrying on another node if it could not be reached (:data:`RETRYABLE`)."""
+        tried = []
+        while True:
+            try:
+                async with self.attempt_async(exclude=tried) as lease:
+                    return await fn(lease)
+            except RETRYABLE:
+                tried.append(lease.node)
+                if len(tried) > retries or len(tried) == len(self.nodes):
+                    raise
+
+    def _available(self, node, now):
+        if not node.healthy:
+            return False
+        if node.state == CLOSED:
+            return True
+        if node.state == OPEN:
+            return now - node.opened_at >= self.reset_timeout_s
+        return not node.trial_in_flight  # HALF_OPEN: one trial at a time
+
+    # health probes -------------------------------------------------------
+
+    def probe_once(self):
+        """Probe every node now (also used by the background prober)."""
+        for node in self.nodes:
+            parts = urlsplit(node.url)
+            url = f'{parts.scheme}://{parts.netloc}{self.health_path}'
+            depth, healthy, error = None, False, None
+            try:
+                r = get_client().get(url, timeout=self.probe_timeout_s)
+                healthy = r.status_code == 200
+                if healthy and self.depth_fn is not None:
+                    depth = self.depth_fn(r.json())
+                elif not healthy:
+                    error = f'health status {r.status_code}'
+            except Exception as e:
+                error = e
+            with self._lock:
+                if node.healthy != healthy:
+                    logger.warning('Backend %s is %s%s', node.url, 'up' if healthy else 'down',
+                                   f': {error}' if error else '')
+                node.healthy = healthy
+                node.queue_depth = depth
+                node.last_probe = time.time()
+                if error is not None:
+                    node.last_error = str(error)[:200]
+
+    def _ensure_prober(self):
+        if not self.health_path or self.probe_interval_s <= 0:
+            return
+        with self._lock:
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(target=self._probe_loop, name='backend-prober', daemon=True)
+                self._prober.start()
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval_s):
+            self.probe_once()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'nodes': [n.snapshot() for n in self.nodes]}
+
+
+def urls_from_env(value: str, default: str) -> list:
+    """Split a comma-separated list of endpoints (``default`` when empty)."""
+    urls = [u.strip() for u in (value or '').split(',') if u.strip()]
+    return urls or [default]
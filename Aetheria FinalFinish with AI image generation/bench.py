@@ -0,0 +1,142 @@
+"""Offline load and latency benchmark.
+
+Runs the app on a local threaded server with a throwaway database, backed by
+fake ComfyUI servers (``fake_backends.py``) with configurable latency and
+failure rate, and drives ``/api/cards``, ``/api/chat``, ``/api/generate``
+and ``/api/generated`` at the given concurrency. Prints p50/p95/p99 latency,
+throughput and peak RSS per endpoint; ``--out`` saves the JSON report and
+``--compare`` diffs it against an earlier one::
+
+    python bench.py --concurrency 8 --requests 200 --out bench-new.json --compare bench-old.json
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import comfyui_run
+import loadgen
+from app import create_app
+from fake_backends import FakeComfyUI
+
+SCENARIOS = ('cards', 'chat', 'generate', 'generated')
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def scenario_calls(base: str, args) -> dict:
+    """One ``call(session, i)`` per scenario (see :func:`loadgen.run_scenario`)."""
+    # every generate request gets a new prompt, warm-up included, so none is served from the cache
+    prompt_ids = itertools.count()
+    return {
+        'cards': lambda s, i: s.post(f'{base}/api/cards', json={'reading': 'three', 'crystal': 'amethyst'},
+                                     timeout=args.timeout),
+        'chat': lambda s, i: s.post(f'{base}/api/chat', json={'message': 'Will I find love this year?',
+                                                              'crystal': 'rose quartz'}, timeout=args.timeout),
+        'generate': lambda s, i: s.post(f'{base}/api/generate',
+                                        json={'prompt': f'benchmark crystal ball {next(prompt_ids)}',
+                                              'width': args.width, 'height': args.height},
+                                        timeout=args.timeout),
+        'generated': lambda s, i: s.get(f'{base}/api/generated', params={'limit': 50}, timeout=args.timeout),
+    }
+
+
+def run(args) -> dict:
+    backends = [FakeComfyUI(latency_s=args.latency, jitter_s=args.jitter, failure_rate=args.failure_rate,
+                            seed=args.seed + n) for n in range(args.backends)]
+    env = {'COMFYUI_URLS': ','.join(b.url for b in backends), 'OPENAI_API_KEY': None}
+    saved = {k: os.environ.get(k) for k in env}
+    _set_env(env)
+    tmp = tempfile.mkdtemp(prefix='aetheria-bench-')
+    try:
+        app = create_app({'DATABASE': os.path.join(tmp, 'bench.db')})
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            calls = scenario_calls(f'http://127.0.0.1:{server.server_port}', args)
+            results = {}
+            for name in args.scenarios:
+                if args.warmup:
+                    loadgen.run_scenario(calls[name], args.warmup, args.concurrency)
+                results[name] = loadgen.run_scenario(calls[name], args.requests, args.concurrency)
+                print(f'{name}: {results[name]["requests"]} requests, {results[name]["errors"]} errors',
+                      file=sys.stderr)
+        finally:
+            server.shutdown()
+            comfyui_run.get_pool().stop()
+            _delete_generated(app)
+        config = {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}
+        return loadgen.report('Aetheria FinalFinish', config, results,
+                              {'comfyui': [dict(b.stats(), url=f'comfyui{n}') for n, b in enumerate(backends)]})
+    finally:
+        _set_env(saved)
+        for b in backends:
+            b.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _set_env(values):
+    for key, value in values.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+def _delete_generated(app):
+    """Remove the images the run saved into static/generated."""
+    client = app.test_client()
+    for (gid,) in app.extensions['db'].query('SELECT id FROM generated'):
+        client.delete(f'/api/generated/{gid}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load and latency benchmark with fake ComfyUI backends.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        type=lambda s: [name for name in s.split(',') if name],
+                        help=f'comma-separated subset of {",".join(SCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests before each scenario')
+    parser.add_argument('--backends', type=int, default=1, help='number of fake ComfyUI servers')
+    parser.add_argument('--latency', type=float, default=0.2, help='fake render time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='extra random render time, up to this')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of renders answered with 500')
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--timeout', type=float, default=120.0, help='client timeout per request')
+    parser.add_argument('--seed', type=int, default=0, help='seed for fake latency jitter and failures')
+    parser.add_argument('--out', help='write the JSON report here')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {sorted(unknown)}')
+    return args
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    doc = run(args)
+    print(loadgen.format_table(doc))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(loadgen.dumps(doc) + '\n')
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print()
+            print(loadgen.compare(json.load(f), doc))
+    return doc
+
+
+if __name__ == '__main__':
+    main()
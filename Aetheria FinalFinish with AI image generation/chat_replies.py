@@ -0,0 +1,158 @@
+"""Chat reply cache and the local rule-based responder.
+
+:class:`ReplyCache` keeps upstream LLM replies in memory, keyed on the
+normalised ``(message, crystal)`` pair, so a repeated question is answered
+without another completion call. Entries expire after ``max_age_s`` and the
+least recently used one is dropped beyond ``max_entries``.
+
+:class:`IntentMatcher` answers when there is no LLM. The intents are data:
+a name, trigger phrases and candidate replies (:data:`DEFAULT_INTENTS`,
+optionally extended from a JSON file with :func:`load_intents`). All phrases
+are compiled once into a single Aho-Corasick automaton over words, so
+matching a message costs one pass over its words however many intents and
+phrases there are. When several intents match, the first one in the table
+wins.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+_WORD = re.compile(r"\w+")
+
+# Replies when no intent matches
+DEFAULT_REPLIES = (
+    "I sense a change approaching — be open and stay curious.",
+    "Follow your intuition today; a small choice will lead somewhere meaningful.",
+    "The crystal's glow points to new connections shortly.",
+    "Take a breath. A clear head will reveal the right next step.",
+    "Trust the small signals — they add up to big answers.",
+)
+
+DEFAULT_INTENTS = (
+    {'name': 'love',
+     'phrases': ('love', 'loves', 'loved', 'loving', 'lover', 'romance', 'relationship', 'soulmate',
+                 'crush', 'partner', 'marriage', 'love life'),
+     'replies': ("Love is in flux — honest communication will guide you.",)},
+    {'name': 'work',
+     'phrases': ('work', 'works', 'working', 'career', 'careers', 'job', 'jobs', 'boss', 'promotion',
+                 'interview', 'office'),
+     'replies': ("At work, steady focus wins. Consider which task needs your clarity.",)},
+)
+
+
+def words(text: str) -> list:
+    """Case-folded words of ``text`` in any script; punctuation and spacing are ignored."""
+    return _WORD.findall((text or '').casefold())
+
+
+def normalize(text: str) -> str:
+    return ' '.join(words(text))
+
+
+def load_intents(path: str = None) -> list:
+    """:data:`DEFAULT_INTENTS` followed by the intents in the JSON file at ``path`` (a list of objects)."""
+    intents = list(DEFAULT_INTENTS)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            intents.extend(json.load(f))
+    return intents
+
+
+class IntentMatcher:
+    def __init__(self, intents, default_replies=DEFAULT_REPLIES):
+        self.intents = [dict(intent, replies=tuple(intent['replies'])) for intent in intents]
+        self.default_replies = tuple(default_replies)
+        # Aho-Corasick automaton over words: goto edges, failure links and, per
+        # state, the best (lowest) intent index ending there or on its suffixes
+        self._goto = [{}]
+        self._best = [None]
+        for index, intent in enumerate(self.intents):
+            for phrase in intent['phrases']:
+                state = 0
+                for word in words(phrase):
+                    nxt = self._goto[state].get(word)
+                    if nxt is None:
+                        nxt = self._goto[state][word] = len(self._goto)
+                        self._goto.append({})
+                        self._best.append(None)
+                    state = nxt
+                if state and (self._best[state] is None or index < self._best[state]):
+                    self._best[state] = index
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and word not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(word, 0)
+                inherited = self._best[self._fail[nxt]]
+                if inherited is not None and (self._best[nxt] is None or inherited < self._best[nxt]):
+                    self._best[nxt] = inherited
+
+    def match(self, text: str):
+        """The highest-priority intent with a phrase in ``text``, or None."""
+        best = None
+        state = 0
+        for word in words(text):
+            while state and word not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(word, 0)
+            found = self._best[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return None if best is None else self.intents[best]
+
+    def reply(self, text: str, rng=random) -> str:
+        intent = self.match(text)
+        return rng.choice(intent['replies'] if intent else self.default_replies)
+
+
+class ReplyCache:
+    def __init__(self, max_entries: int = 1000, max_age_s: float = 3600):
+        self.max_entries = max_entries
+        self.max_age_s = max_age_s
+        self._replies = OrderedDict()  # key -> (stored_at, reply)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(message: str, crystal: str = None) -> tuple:
+        return normalize(message), (crystal or '').strip().lower()
+
+    def get(self, message: str, crystal: str = None):
+        """The cached reply for the question, or None (also when it has expired)."""
+        key = self.key(message, crystal)
+        with self._lock:
+            # a message without words (only punctuation or emoji) says nothing to match on
+            entry = self._replies.get(key) if key[0] else None
+            if entry is not None and entry[0] >= time.monotonic() - self.max_age_s:
+                self._replies.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._replies[key]
+            self.misses += 1
+            return None
+
+    def put(self, message: str, crystal: str, reply: str):
+        key = self.key(message, crystal)
+        if self.max_entries <= 0 or not reply or not key[0]:
+            return
+        with self._lock:
+            self._replies[key] = (time.monotonic(), reply)
+            self._replies.move_to_end(key)
+            while len(self._replies) > self.max_entries:
+                self._replies.popitem(last=False)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._replies), 'hits': self.hits, 'misses': self.misses}
@@ -1,9 +1,27 @@
+import asyncio
 import requests
 import json
-import time
 import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from async_http import get_async_client
+from backend_pool import BackendPool, urls_from_env
+from http_client import get_client
+from metrics import BACKEND_SUBMIT, BACKEND_WAIT, COMFYUI_POLLS
+from tracing import span, traced
+from workflow import WorkflowRegistry
+
+try:
+    import websocket  # websocket-client, optional
+except Exception:
+    websocket = None
 
-# ComfyUI server address
+# ComfyUI server address (default node; COMFYUI_URLS lists several, comma-separated)
 server_address = "127.0.0.1:8188"
 base_url = f"http://{server_address}"
 
@@ -11,64 +29,405 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-# Load the API-formatted workflow
-with open("base_workflow.json", "r") as f:
-    workflow_prompt = json.load(f)
+# API-formatted workflows: base_workflow.json is "base", workflows/<name>.json adds named ones.
+# Each is parsed once; requests render their own copy (see workflow.py).
+_here = os.path.dirname(os.path.abspath(__file__))
+workflows = WorkflowRegistry(os.path.join(_here, "base_workflow.json"), os.path.join(_here, "workflows"))
 
+# Identifies the base workflow (model, seed, sampler...) for result caching
+workflow_fingerprint = workflows.get("base").fingerprint
 
-def queue_workflow_and_wait(prompt: str, width: int = 512, height: int = 512, max_attempts: int = 30, sleep_s: float = 1.0) -> str:
-    """Post a workflow to ComfyUI and wait until an output image is available.
 
-    Returns the generated image URL on success. Raises Exception on failure or timeout.
+class CompletionWatcher:
+    """Shared watcher that resolves outstanding ComfyUI prompt_ids as they finish.
+
+    One background thread serves every caller. When ``websocket-client`` is
+    installed it listens to ComfyUI's ``/ws`` execution events and fetches
+    ``/history/{prompt_id}`` only once the prompt is done; otherwise (or if the
+    socket drops) it polls the history of all pending prompts with a backoff
+    that resets whenever something completes or a new prompt is watched.
     """
-    print(workflow_prompt)
-    workflow_prompt["6"]["inputs"]["text"] = prompt
-    
-    # Update latent image dimensions (Node 5 is EmptyLatentImage)
-    if "5" in workflow_prompt and "inputs" in workflow_prompt["5"]:
-        workflow_prompt["5"]["inputs"]["width"] = width
-        workflow_prompt["5"]["inputs"]["height"] = height
-        
-    resp = requests.post(f"{base_url}/prompt", json={"prompt": workflow_prompt})
-    if resp.status_code != 200:
-        raise Exception(f"Error sending prompt: {resp.status_code} - {resp.text}")
-
-    data = resp.json()
-    prompt_id = data.get("prompt_id")
-    if not prompt_id:
-        raise Exception(f"No prompt_id returned from server: {data}")
-
-    logger.info(f"Queued workflow with prompt_id: {prompt_id}")
-    print(max_attempts)
-
-    for attempt in range(max_attempts):
-        history = requests.get(f"{base_url}/history/{prompt_id}")
-        # Some servers may return non-200 during processing; raise or continue accordingly
+
+    def __init__(self, base_url: str, client_id: str = None, use_websocket: bool = True,
+                 min_poll_s: float = 0.1, max_poll_s: float = 2.0, backoff: float = 1.5):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id or uuid.uuid4().hex
+        self.use_websocket = use_websocket and websocket is not None
+        self.min_poll_s = min_poll_s
+        self.max_poll_s = max_poll_s
+        self.backoff = backoff
+        self.poll_count = 0
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, prompt_id: str) -> Future:
+        """Return a Future resolved with the prompt's history outputs."""
+        with self._cond:
+            future = self._pending.get(prompt_id)
+            if future is None:
+                future = self._pending[prompt_id] = Future()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="comfyui-watcher", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return future
+
+    def wait(self, prompt_id: str, timeout: float = None) -> dict:
+        future = self.watch(prompt_id)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            with self._cond:
+                if self._pending.get(prompt_id) is future:
+                    del self._pending[prompt_id]
+            raise TimeoutError(f"Workflow {prompt_id} didn't complete within {timeout} seconds")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            if self.use_websocket:
+                try:
+                    self._listen()
+                    continue
+                except Exception as e:
+                    logger.warning("ComfyUI websocket unavailable, falling back to polling: %s", e)
+            self._poll_until_idle()
+
+    def _listen(self):
+        ws_url = self.base_url.replace("http", "ws", 1) + f"/ws?clientId={self.client_id}"
+        ws = websocket.create_connection(ws_url, timeout=self.max_poll_s)
+        try:
+            # catch prompts that finished before the socket was up
+            self._poll_once()
+            last_sweep = time.monotonic()
+            while self._has_pending():
+                # safety net for events sent before a prompt was watched
+                if time.monotonic() - last_sweep >= self.max_poll_s:
+                    self._poll_once()
+                    last_sweep = time.monotonic()
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not isinstance(message, str):
+                    continue  # binary preview frames
+                event = json.loads(message)
+                data = event.get("data") or {}
+                prompt_id = data.get("prompt_id")
+                if event.get("type") == "executing" and data.get("node") is None and prompt_id:
+                    self._check(prompt_id)
+                elif event.get("type") == "execution_success" and prompt_id:
+                    self._check(prompt_id)
+                elif event.get("type") == "execution_error" and prompt_id:
+                    self._resolve(prompt_id, error=Exception(
+                        f"Workflow {prompt_id} failed: {data.get('exception_message', data)}"))
+        finally:
+            ws.close()
+
+    def _poll_until_idle(self):
+        delay = self.min_poll_s
+        while self._has_pending():
+            if self._poll_once():
+                delay = self.min_poll_s
+            else:
+                delay = min(delay * self.backoff, self.max_poll_s)
+            with self._cond:
+                # a newly watched prompt wakes us up early and resets the backoff
+                if self._cond.wait(timeout=delay):
+                    delay = self.min_poll_s
+
+    def _poll_once(self) -> bool:
+        with self._cond:
+            prompt_ids = list(self._pending)
+        return any([self._check(prompt_id) for prompt_id in prompt_ids])
+
+    def _check(self, prompt_id: str) -> bool:
+        with self._cond:
+            if prompt_id not in self._pending:
+                return False
+        self.poll_count += 1
+        COMFYUI_POLLS.inc()
+        try:
+            history = get_client().get(f"{self.base_url}/history/{prompt_id}")
+        except requests.RequestException as e:
+            logger.debug("History check for %s failed: %s", prompt_id, e)
+            return False
+        # Some servers may return non-200 during processing
         if history.status_code != 200:
             logger.debug(f"History check returned status {history.status_code}: {history.text}")
-            time.sleep(sleep_s)
-            continue
+            return False
+        entry = history.json().get(prompt_id)
+        if not entry:
+            return False
+        self._resolve(prompt_id, outputs=entry.get("outputs", {}))
+        return True
+
+    def _resolve(self, prompt_id, outputs=None, error=None):
+        with self._cond:
+            future = self._pending.pop(prompt_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(outputs)
+
+    def _has_pending(self) -> bool:
+        with self._cond:
+            return bool(self._pending)
+
+
+_watchers = {}
+_watcher_lock = threading.Lock()
+
+
+def get_watcher(url: str = None) -> CompletionWatcher:
+    """Return the process-wide watcher for a ComfyUI node (``base_url`` by default)."""
+    url = (url or base_url).rstrip("/")
+    with _watcher_lock:
+        if url not in _watchers:
+            _watchers[url] = CompletionWatcher(url)
+        return _watchers[url]
+
+
+class AsyncCompletionWatcher:
+    """:class:`CompletionWatcher` for the async serving mode.
+
+    One task on the event loop polls the history of every pending prompt of
+    a node, with the same backoff, and resolves asyncio futures; waiting
+    callers hold neither a thread nor a polling loop of their own. Like the
+    client of ``async_http.py`` it is bound to the loop it was created on.
+    """
+
+    def __init__(self, base_url: str, client_id: str = None,
+                 min_poll_s: float = 0.1, max_poll_s: float = 2.0, backoff: float = 1.5):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id or uuid.uuid4().hex
+        self.min_poll_s = min_poll_s
+        self.max_poll_s = max_poll_s
+        self.backoff = backoff
+        self.poll_count = 0
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def watch(self, prompt_id: str) -> asyncio.Future:
+        """Return a future resolved with the prompt's history outputs."""
+        future = self._pending.get(prompt_id)
+        if future is None:
+            future = self._pending[prompt_id] = asyncio.get_running_loop().create_future()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="comfyui-async-watcher")
+        self._wakeup.set()
+        return future
+
+    async def wait(self, prompt_id: str, timeout: float = None) -> dict:
+        future = self.watch(prompt_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if self._pending.get(prompt_id) is future:
+                del self._pending[prompt_id]
+            raise TimeoutError(f"Workflow {prompt_id} didn't complete within {timeout} seconds") from None
+
+    async def _run(self):
+        delay = self.min_poll_s
+        while self._pending:
+            self._wakeup.clear()
+            if await self._poll_once():
+                delay = self.min_poll_s
+            else:
+                delay = min(delay * self.backoff, self.max_poll_s)
+            try:
+                # a newly watched prompt wakes us up early and resets the backoff
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+                delay = self.min_poll_s
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll_once(self) -> bool:
+        done = await asyncio.gather(*(self._check(prompt_id) for prompt_id in list(self._pending)))
+        return any(done)
+
+    async def _check(self, prompt_id: str) -> bool:
+        if prompt_id not in self._pending:
+            return False
+        self.poll_count += 1
+        COMFYUI_POLLS.inc()
+        try:
+            history = await get_async_client().get(f"{self.base_url}/history/{prompt_id}")
+        except OSError as e:
+            logger.debug("History check for %s failed: %s", prompt_id, e)
+            return False
+        entry = history.json().get(prompt_id) if history.status_code == 200 else None
+        if not entry:
+            return False
+        future = self._pending.pop(prompt_id, None)
+        if future is not None and not future.done():
+            future.set_result(entry.get("outputs", {}))
+        return True
+
+
+_async_watchers = weakref.WeakKeyDictionary()
+
+
+def get_async_watcher(url: str = None) -> AsyncCompletionWatcher:
+    """Return the running loop's watcher for a ComfyUI node (``base_url`` by default)."""
+    url = (url or base_url).rstrip("/")
+    watchers = _async_watchers.setdefault(asyncio.get_running_loop(), {})
+    if url not in watchers:
+        watchers[url] = AsyncCompletionWatcher(url)
+    return watchers[url]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> BackendPool:
+    """Return the pool of ComfyUI nodes from ``COMFYUI_URLS`` (default: ``base_url`` only).
+
+    Probes ``/queue`` every ``COMFYUI_PROBE_INTERVAL`` seconds (default 10) and
+    reports its running + pending prompts as the node's queue depth.
+    """
+    global _pool
+    urls = urls_from_env(os.environ.get("COMFYUI_URLS"), base_url)
+    with _pool_lock:
+        if _pool is None or [n.url for n in _pool.nodes] != urls:
+            if _pool is not None:
+                _pool.stop()
+            _pool = BackendPool(
+                urls, health_path="/queue",
+                depth_fn=lambda q: len(q.get("queue_running", [])) + len(q.get("queue_pending", [])),
+                probe_interval_s=float(os.environ.get("COMFYUI_PROBE_INTERVAL", 10)),
+                failure_threshold=int(os.environ.get("COMFYUI_FAILURE_THRESHOLD", 3)),
+                reset_timeout_s=float(os.environ.get("COMFYUI_RESET_TIMEOUT", 30)),
+            )
+        return _pool
+
+
+def image_url_from_outputs(outputs: dict, url: str = None) -> str:
+    image_node = next((nid for nid, out in outputs.items() if "images" in out), None)
+    if not image_node:
+        raise Exception(f"No output node with images found: {outputs}")
+    image_filename = outputs[image_node]["images"][0]["filename"]
+    return f"{(url or base_url).rstrip('/')}/view?filename={image_filename}&subfolder=&type=output"
+
+
+@traced("queue_workflow_and_wait")
+def queue_workflow_and_wait(prompt: str, width: int = 512, height: int = 512, max_attempts: int = 30,
+                            sleep_s: float = 1.0, workflow: str = "base", **params) -> str:
+    """Post a workflow to ComfyUI and wait until an output image is available.
+
+    ``workflow`` names a template from :data:`workflows`; ``params`` fills its
+    other slots (negative, seed, steps, batch_size). The node is picked by
+    :func:`get_pool` (fewest prompts in flight); completion is reported by
+    that node's shared :class:`CompletionWatcher`; the overall deadline is
+    still ``max_attempts * sleep_s`` seconds.
+    Returns the generated image URL on success. Raises Exception on failure or timeout.
+    """
+    with span("workflow.render", workflow=workflow):
+        graph = workflows.get(workflow).render(prompt=prompt, width=width, height=height, **params)
+    logger.debug("Rendered workflow %s: %s", workflow, graph)
+
+    def run(lease):
+        watcher = get_watcher(lease.url)
+        with span("comfyui.submit", node=lease.url), BACKEND_SUBMIT.time(backend="comfyui"):
+            resp = get_client().post(f"{lease.url}/prompt", json={"prompt": graph, "client_id": watcher.client_id})
+        if resp.status_code != 200:
+            if resp.status_code >= 500:
+                lease.failed(f"status {resp.status_code}")
+            raise Exception(f"Error sending prompt: {resp.status_code} - {resp.text}")
+
+        data = resp.json()
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            raise Exception(f"No prompt_id returned from server: {data}")
+
+        logger.info(f"Queued workflow with prompt_id: {prompt_id} on {lease.url}")
+
+        with span("comfyui.wait", prompt_id=prompt_id), BACKEND_WAIT.time(backend="comfyui"):
+            outputs = watcher.wait(prompt_id, timeout=max_attempts * sleep_s)
+        logger.info("Workflow outputs: %s", json.dumps(outputs, indent=2))
+        return image_url_from_outputs(outputs, lease.url)
+
+    # the lease is held until the image is ready, so "outstanding" is the node's queue depth
+    image_url = get_pool().call(run)
+    logger.info(f"Generated image URL: {image_url}")
+    return image_url
+
+
+async def wait_for_outputs_async(url: str, prompt_id: str, timeout: float, min_poll_s: float = 0.1,
+                                 max_poll_s: float = 2.0, backoff: float = 1.5) -> dict:
+    """Poll ``/history/{prompt_id}`` with asyncio sleeps until the prompt is done; returns its outputs.
+
+    Backs off like :class:`CompletionWatcher` but blocks no thread while waiting.
+    A fallback for one-off waits: it polls once per prompt, so the serving path
+    uses the node's shared :class:`AsyncCompletionWatcher` instead.
+    """
+    deadline = time.monotonic() + timeout
+    delay = min_poll_s
+    while True:
+        COMFYUI_POLLS.inc()
+        try:
+            history = await get_async_client().get(f"{url.rstrip('/')}/history/{prompt_id}")
+        except OSError as e:
+            logger.debug("History check for %s failed: %s", prompt_id, e)
+        else:
+            entry = history.json().get(prompt_id) if history.status_code == 200 else None
+            if entry:
+                return entry.get("outputs", {})
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Workflow {prompt_id} didn't complete within {timeout} seconds")
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * backoff, max_poll_s)
+
+
+@traced("queue_workflow_and_wait")
+async def queue_workflow_and_wait_async(prompt: str, width: int = 512, height: int = 512, max_attempts: int = 30,
+                                        sleep_s: float = 1.0, workflow: str = "base", **params) -> str:
+    """:func:`queue_workflow_and_wait` for the async serving mode.
+
+    Same workflow rendering, node selection and deadline, but the submit is
+    awaited with the asyncio client and completion comes from the node's
+    shared :class:`AsyncCompletionWatcher` instead of a thread.
+    """
+    with span("workflow.render", workflow=workflow):
+        graph = workflows.get(workflow).render(prompt=prompt, width=width, height=height, **params)
+
+    async def run(lease):
+        watcher = get_async_watcher(lease.url)
+        with span("comfyui.submit", node=lease.url), BACKEND_SUBMIT.time(backend="comfyui"):
+            resp = await get_async_client().post(f"{lease.url}/prompt", json={"prompt": graph,
+                                                                              "client_id": watcher.client_id})
+        if resp.status_code != 200:
+            if resp.status_code >= 500:
+                lease.failed(f"status {resp.status_code}")
+            raise Exception(f"Error sending prompt: {resp.status_code} - {resp.text}")
+
+        data = resp.json()
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            raise Exception(f"No prompt_id returned from server: {data}")
 
-        history_json = history.json()
-        if history_json.get(prompt_id):
-            outputs = history_json[prompt_id].get("outputs", {})
-            logger.info("Workflow outputs: %s", json.dumps(outputs, indent=2))
-            image_node = next((nid for nid, out in outputs.items() if "images" in out), None)
-            if not image_node:
-                raise Exception(f"No output node with images found: {outputs}")
-            image_filename = outputs[image_node]["images"][0]["filename"]
-            image_url = f"{base_url}/view?filename={image_filename}&subfolder=&type=output"
-            logger.info(f"Generated image URL: {image_url}")
-            return image_url
+        logger.info(f"Queued workflow with prompt_id: {prompt_id} on {lease.url}")
 
-        time.sleep(sleep_s)
+        with span("comfyui.wait", prompt_id=prompt_id), BACKEND_WAIT.time(backend="comfyui"):
+            outputs = await watcher.wait(prompt_id, timeout=max_attempts * sleep_s)
+        return image_url_from_outputs(outputs, lease.url)
 
-    raise Exception(f"Workflow {prompt_id} didn't complete within {max_attempts * sleep_s} seconds")
+    image_url = await get_pool().call_async(run)
+    logger.info(f"Generated image URL: {image_url}")
+    return image_url
 
 
 if __name__ == "__main__":
     try:
-        image_url = queue_workflow_and_wait(workflow_prompt)
+        image_url = queue_workflow_and_wait("beautiful scenery nature glass bottle landscape, purple galaxy bottle")
         print(f"Generated image URL: {image_url}")
     except Exception as e:
         logger.error("Failed: %s", e)
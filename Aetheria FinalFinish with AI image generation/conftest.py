@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+TRACKED_GENERATED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'generated')
+
+
+def _listing(directory):
+    try:
+        return sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+
+
+@pytest.fixture(autouse=True)
+def _tmp_storage(tmp_path, monkeypatch):
+    """Apps created in tests keep their database and images under tmp_path, never the tracked
+    generated.db and static/generated."""
+    monkeypatch.setenv('DATABASE', str(tmp_path / 'generated.db'))
+    monkeypatch.setenv('GENERATED_DIR', str(tmp_path / 'generated'))
+    before = _listing(TRACKED_GENERATED)
+    yield
+    assert _listing(TRACKED_GENERATED) == before, 'a test wrote to or deleted from static/generated'
@@ -0,0 +1,115 @@
+"""Vectorized image effects with real alpha: radial gradients, soft glows, starfields.
+
+Effects are composited onto a float ``(height, width, 4)`` RGBA array
+(premultiplied alpha, 0..1) with whole-array NumPy operations restricted to
+the bounding box they touch; the result is converted to a PIL image once
+with :func:`to_image`. Glows and stars are
+splatted for all points at once: every point gets a same-sized window,
+their coverages are computed as one ``(n, k, k)`` array and accumulated
+with ``np.add.at``.
+
+NumPy is optional; when it is missing ``available`` is False and callers
+keep their plain PIL drawing.
+"""
+from PIL import Image, ImageColor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+available = np is not None
+
+
+def canvas(width: int, height: int):
+    """A fully transparent RGBA layer."""
+    return np.zeros((height, width, 4), dtype=np.float32)
+
+
+def to_image(layer) -> Image.Image:
+    """Un-premultiply and convert to an 8-bit PIL RGBA image."""
+    alpha = layer[..., 3:4]
+    rgba = np.concatenate([layer[..., :3] / np.maximum(alpha, 1e-6), alpha], axis=2)
+    return Image.fromarray((np.clip(rgba, 0, 1) * 255 + 0.5).astype(np.uint8), 'RGBA')
+
+
+def over(layer, color, alpha, box=None):
+    """Composite a solid ``color`` with per-pixel ``alpha`` over ``layer`` in place.
+
+    ``box`` is the ``(top, left)`` of ``alpha`` inside the layer when it only
+    covers part of it.
+    """
+    top, left = box or (0, 0)
+    region = layer[top:top + alpha.shape[0], left:left + alpha.shape[1]]
+    alpha = alpha.astype(np.float32, copy=False)[..., None]
+    region *= 1 - alpha
+    region += np.asarray(_rgb(color) + [1.0], dtype=np.float32) * alpha
+    return layer
+
+
+def radial_gradient(layer, center, radius, color, inner_alpha=1.0, outer_alpha=0.0):
+    """Disc of ``color`` whose alpha goes linearly from ``inner_alpha`` at the
+    center to ``outer_alpha`` at ``radius`` (anti-aliased edge)."""
+    h, w = layer.shape[:2]
+    top, left = max(int(center[1] - radius) - 1, 0), max(int(center[0] - radius) - 1, 0)
+    bottom, right = min(int(center[1] + radius) + 2, h), min(int(center[0] + radius) + 2, w)
+    d = _distance((bottom - top, right - left), (center[0] - left, center[1] - top))
+    t = np.clip(d / radius, 0, 1)
+    alpha = (inner_alpha + (outer_alpha - inner_alpha) * t) * np.clip(radius + 0.5 - d, 0, 1)
+    return over(layer, color, alpha, (top, left))
+
+
+def glow(layer, centers, radii, color, alphas):
+    """Soft Gaussian spots: peak ``alphas`` at ``centers``, falling off over ``radii``."""
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float32), (len(centers),))
+    alphas = np.broadcast_to(np.asarray(alphas, dtype=np.float32), (len(centers),))
+    reach = int(np.ceil(radii.max() * 3))
+    offsets, d = _windows(centers, reach)
+    coverage = alphas[:, None, None] * np.exp(-(d / radii[:, None, None]) ** 2)
+    return _splat(layer, offsets, coverage, color)
+
+
+def starfield(layer, centers, radii, color='white', alpha=1.0):
+    """Anti-aliased solid discs (sparkles, stars) of the given radii."""
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float32), (len(centers),))
+    reach = int(np.ceil(radii.max())) + 1
+    offsets, d = _windows(centers, reach)
+    coverage = alpha * np.clip(radii[:, None, None] + 0.5 - d, 0, 1)
+    return _splat(layer, offsets, coverage, color)
+
+
+def _rgb(color):
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    return [c / 255 for c in color[:3]]
+
+
+def _distance(shape, center):
+    ys, xs = np.ogrid[:shape[0], :shape[1]]
+    return np.hypot(xs - np.float32(center[0]), ys - np.float32(center[1])).astype(np.float32)
+
+
+def _windows(centers, reach):
+    """Pixel coordinates of a (2*reach+1)^2 window around each center, and their distances."""
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+    base = np.round(centers).astype(np.int64)
+    step = np.arange(-reach, reach + 1)
+    xs = base[:, 0, None, None] + step[None, None, :]
+    ys = base[:, 1, None, None] + step[None, :, None]
+    d = np.hypot(xs - centers[:, 0, None, None], ys - centers[:, 1, None, None])
+    xs, ys = np.broadcast_arrays(xs, ys)
+    return (ys, xs), d
+
+
+def _splat(layer, offsets, coverage, color):
+    """Combine overlapping coverages (1 - prod(1 - a)) and composite them once."""
+    ys, xs = offsets
+    h, w = layer.shape[:2]
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w) & (coverage > 1e-3)
+    ys, xs = ys[inside], xs[inside]
+    if not len(ys):
+        return layer
+    top, left = ys.min(), xs.min()
+    transmit = np.zeros((ys.max() - top + 1, xs.max() - left + 1), dtype=np.float32)
+    np.add.at(transmit, (ys - top, xs - left), np.log1p(-np.minimum(coverage[inside], 0.999)))
+    return over(layer, color, 1 - np.exp(transmit), (top, left))
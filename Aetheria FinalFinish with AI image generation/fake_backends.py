@@ -0,0 +1,290 @@
+"""In-process fake generation backends for offline benchmarks and the tests.
+
+- :class:`FakeSD`: AUTOMATIC1111-style ``POST /sdapi/v1/txt2img`` (PNG
+  ``images`` sized like the payload, ``info`` JSON) and ``GET
+  /sdapi/v1/progress`` for health probes; the tests also use it for batch
+  grids, extension images and ComfyUI-style image references
+- :class:`FakeComfyUI`: ``POST /prompt``, ``GET /history/<id>`` (empty until
+  the prompt is done), ``GET /queue`` and ``GET /view``
+- :class:`FakeCompletions`: OpenAI-style ``POST /v1/completions``, answered
+  whole or, with ``"stream": true``, as Server-Sent Events one word at a time
+
+Each runs a ``ThreadingHTTPServer`` on a free local port. ``latency_s`` (plus
+up to ``jitter_s``) is the render time and ``failure_rate`` the share of
+submissions answered with HTTP 500. ``seed`` makes the jitter and failures
+reproducible between runs.
+"""
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+_png_cache = {}
+_png_lock = threading.Lock()
+
+
+def png_bytes(width: int, height: int) -> bytes:
+    """A solid PNG of the given size (cached, so the fakes cost next to no CPU)."""
+    key = (int(width), int(height))
+    with _png_lock:
+        data = _png_cache.get(key)
+        if data is None:
+            buf = io.BytesIO()
+            Image.new('RGB', key, (70, 30, 120)).save(buf, format='PNG')
+            data = _png_cache[key] = buf.getvalue()
+        return data
+
+
+class _FakeBackend:
+    def __init__(self, latency_s=0.0, jitter_s=0.0, failure_rate=0.0, seed=None):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body, content_type='application/json'):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_json(self):
+                return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+            def do_GET(self):
+                fake.handle_get(self, urlsplit(self.path))
+
+            def do_POST(self):
+                fake.handle_post(self, urlsplit(self.path))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.origin = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _submit(self) -> tuple:
+        """Count a submission; returns ``(render_seconds, fail)``."""
+        with self._lock:
+            self.requests += 1
+            fail = self._rng.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+            return self.latency_s + self._rng.uniform(0, self.jitter_s), fail
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'failures': self.failures, 'max_in_flight': self.max_in_flight}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_get(self, handler, url):
+        handler.send(404, {'error': 'not found'})
+
+    def handle_post(self, handler, url):
+        handler.send(404, {'error': 'not found'})
+
+
+class FakeSD(_FakeBackend):
+    """AUTOMATIC1111 txt2img stand-in; ``url`` is the txt2img endpoint.
+
+    ``images`` come back per batch item, as PNGs sized like the payload or,
+    with ``image_bytes``, as one fixed :attr:`png` of about that size. ``grid``
+    puts a batch grid first (``index_of_first_image`` in ``info``) and
+    ``extras`` appends images after the batch, like ControlNet's detect maps.
+    With ``comfyui`` the response is in ComfyUI's history schema instead and
+    the images it references are served from ``/view`` (answered with
+    ``view_status`` instead when that is not 200). Received payloads are kept
+    in :attr:`payloads`.
+    """
+
+    def __init__(self, images=1, image_bytes=None, grid=False, extras=0, comfyui=False, view_status=200, **kwargs):
+        super().__init__(**kwargs)
+        self.url = f'{self.origin}/sdapi/v1/txt2img'
+        self.images = images
+        self.png = b'\x89PNG\r\n\x1a\n' + b'\x00' * image_bytes if image_bytes else None
+        self.grid = grid
+        self.extras = extras
+        self.comfyui = comfyui
+        self.view_status = view_status
+        self.payloads = []
+        self.views = 0
+
+    def image(self, width, height) -> bytes:
+        return self.png or png_bytes(width, height)
+
+    def handle_post(self, handler, url):
+        payload = handler.read_json()
+        with self._lock:
+            self.payloads.append(payload)
+        render_s, fail = self._submit()
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(render_s)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        if fail:
+            handler.send(500, {'error': 'injected failure'})
+            return
+        width, height = payload.get('width', 512), payload.get('height', 512)
+        count = self.images * int(payload.get('batch_size', 1)) * int(payload.get('n_iter', 1))
+        if self.comfyui:
+            ref = {'filename': f'{width}x{height}.png', 'subfolder': '', 'type': 'output'}
+            handler.send(200, {'p1': {'prompt': [0, 'p1', {}], 'outputs': {'9': {'images': [ref] * count}}}})
+            return
+        first = 1 if self.grid and count > 1 else 0
+        png = base64.b64encode(self.image(width, height)).decode()
+        images = ([base64.b64encode(b'grid').decode()] * first + [png] * count
+                  + [base64.b64encode(b'detect map').decode()] * self.extras)
+        seed = payload.get('seed', -1)
+        if seed in (None, -1):
+            seed = self._rng.randrange(2 ** 32)
+        handler.send(200, {'images': images, 'parameters': payload,
+                           'info': json.dumps({'seed': seed, 'steps': payload.get('steps'),
+                                               'index_of_first_image': first})})
+
+    def handle_get(self, handler, url):
+        if url.path == '/view':
+            size = parse_qs(url.query).get('filename', [''])[0].rsplit('.', 1)[0]
+            with self._lock:
+                self.views += 1
+            if self.view_status != 200:
+                handler.send(self.view_status, {'error': 'injected failure'})
+                return
+            handler.send(200, self.image(*(int(n) for n in size.split('x'))), 'image/png')
+            return
+        with self._lock:
+            state = {'job_count': self.in_flight}
+        handler.send(200, {'progress': 0, 'state': state})
+
+
+class FakeComfyUI(_FakeBackend):
+    """ComfyUI stand-in; ``url`` is the server origin (like ``COMFYUI_URLS`` entries)."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.url = self.origin
+        self._prompts = {}  # prompt_id -> (done_at, (width, height))
+
+    def handle_post(self, handler, url):
+        graph = handler.read_json().get('prompt') or {}
+        render_s, fail = self._submit()
+        if fail:
+            handler.send(500, {'error': 'injected failure'})
+            return
+        size = next(((n['inputs'].get('width', 512), n['inputs'].get('height', 512)) for n in graph.values()
+                     if n.get('class_type') == 'EmptyLatentImage'), (512, 512))
+        prompt_id = uuid.uuid4().hex
+        with self._lock:
+            self._prompts[prompt_id] = (time.monotonic() + render_s, size)
+            self.in_flight = self._running()
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        handler.send(200, {'prompt_id': prompt_id, 'number': self.requests})
+
+    def handle_get(self, handler, url):
+        if url.path.startswith('/history/'):
+            prompt_id = url.path.rsplit('/', 1)[1]
+            with self._lock:
+                done_at, _ = self._prompts.get(prompt_id, (float('inf'), None))
+            body = {}
+            if time.monotonic() >= done_at:
+                body = {prompt_id: {'outputs': {'9': {'images': [
+                    {'filename': f'{prompt_id}.png', 'subfolder': '', 'type': 'output'}]}}}}
+            handler.send(200, body)
+        elif url.path == '/queue':
+            now = time.monotonic()
+            with self._lock:
+                running = [[0, pid] for pid, (done_at, _) in self._prompts.items() if done_at > now]
+            handler.send(200, {'queue_running': running, 'queue_pending': []})
+        elif url.path == '/view':
+            prompt_id = parse_qs(url.query).get('filename', [''])[0].rsplit('.', 1)[0]
+            with self._lock:
+                entry = self._prompts.pop(prompt_id, None)
+            if entry is None:
+                handler.send(404, {'error': 'unknown image'})
+            else:
+                handler.send(200, png_bytes(*entry[1]), 'image/png')
+        else:
+            super().handle_get(handler, url)
+
+    def _running(self) -> int:
+        now = time.monotonic()
+        return sum(1 for done_at, _ in self._prompts.values() if done_at > now)
+
+
+class FakeCompletions(_FakeBackend):
+    """OpenAI completions stand-in; ``url`` is the API base (like ``OPENAI_API_BASE``).
+
+    ``latency_s`` is the time to the first token and ``token_delay_s`` the gap
+    between tokens. ``stall_after`` tokens into a stream the server stops
+    sending for ``stall_s`` seconds, to exercise client deadlines.
+    """
+
+    def __init__(self, reply='The stars lean your way tonight.', token_delay_s=0.0,
+                 stall_after=None, stall_s=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.url = f'{self.origin}/v1'
+        self.reply = reply
+        self.token_delay_s = token_delay_s
+        self.stall_after = stall_after
+        self.stall_s = stall_s
+        self.payloads = []
+
+    def handle_post(self, handler, url):
+        if url.path != '/v1/completions':
+            super().handle_post(handler, url)
+            return
+        payload = handler.read_json()
+        self.payloads.append(dict(payload, authorization=handler.headers.get('Authorization')))
+        first_token_s, fail = self._submit()
+        if fail:
+            handler.send(500, {'error': 'injected failure'})
+            return
+        time.sleep(first_token_s)
+        if not payload.get('stream'):
+            handler.send(200, {'choices': [{'text': self.reply, 'index': 0}]})
+            return
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        events = [{'choices': [{'text': token, 'index': 0}]} for token in re.findall(r'\s*\S+', self.reply)]
+        try:
+            for n, event in enumerate(events + ['[DONE]']):
+                if n and self.token_delay_s:
+                    time.sleep(self.token_delay_s)
+                if n == self.stall_after:
+                    time.sleep(self.stall_s)
+                data = event if isinstance(event, str) else json.dumps(event)
+                chunk = f'data: {data}\n\n'.encode()
+                handler.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                handler.wfile.flush()
+            handler.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            handler.close_connection = True  # the client gave up (deadline)
@@ -0,0 +1,48 @@
+"""Process-wide font registry and text-measurement cache for the PIL renderer.
+
+``ImageFont.truetype`` parses the font file on every call, and a miss (no
+``seguiemj.ttf`` outside Windows) costs a filesystem search before falling
+back. :func:`get_font` resolves each (fallback chain, size) once and hands
+out the same font object afterwards; :func:`text_bbox` memoizes bounding
+boxes of the strings the cards keep measuring (symbols, titles, wrapped
+prompt lines) on a single scratch ``ImageDraw``.
+"""
+import threading
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+# fallback chains, tried in order before PIL's built-in bitmap font
+SYMBOL_FONTS = ('seguiemj.ttf', 'arial.ttf')
+TEXT_FONTS = ('arial.ttf',)
+
+_measure_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+_measure_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_font(candidates: tuple, size: int):
+    """Return the first of ``candidates`` that loads at ``size``, else the default font."""
+    for name in candidates:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=4096)
+def text_bbox(text: str, font) -> tuple:
+    """``textbbox((0, 0), text)`` for ``font``; fonts from :func:`get_font` hit the cache."""
+    with _measure_lock:
+        return _measure_draw.textbbox((0, 0), text, font=font)
+
+
+def text_size(text: str, font) -> tuple:
+    """``(width, height)`` of ``text`` rendered with ``font``."""
+    left, top, right, bottom = text_bbox(text, font)
+    return right - left, bottom - top
+
+
+def cache_info() -> dict:
+    return {'fonts': get_font.cache_info()._asdict(), 'bboxes': text_bbox.cache_info()._asdict()}
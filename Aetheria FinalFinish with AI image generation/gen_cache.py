@@ -0,0 +1,175 @@
+"""Content-addressed cache of generation results.
+
+A request is keyed on a canonical hash of its effective backend payload.
+Deterministic requests (fixed seed, fixed workflow) whose key is already in
+the ``generation_cache`` table are answered with the previously saved images
+instead of re-running the backend. Entries point at rows of the
+``generated`` table, so deleting an image from the gallery also drops it
+from the cache. Concurrent identical requests are collapsed into a single
+backend call with :class:`SingleFlight` (:class:`AsyncSingleFlight` in the
+async serving mode).
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+
+def cache_key(payload: dict) -> str:
+    """Stable sha256 over a JSON-serialisable payload (key order independent)."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_deterministic(payload: dict) -> bool:
+    """True when the payload pins its seed (A1111 treats -1 as "random")."""
+    seed = payload.get('seed')
+    return seed is not None and str(seed).strip() not in ('', '-1')
+
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its outcome."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return ``(result, shared)``; ``shared`` is True for callers that waited on another's call."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+class AsyncSingleFlight:
+    """:class:`SingleFlight` for coroutines on one event loop."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        """Await ``fn()`` once per key; returns ``(result, shared)`` like :meth:`SingleFlight.do`."""
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # followers may be gone; do not warn about an unretrieved exception
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+
+class GenerationCache:
+    def __init__(self, db, max_entries: int = 1000, max_age_s: float = 7 * 24 * 3600):
+        """``db`` is the app's :class:`db.Database`."""
+        self.db = db
+        self.max_entries = max_entries
+        self.max_age_s = max_age_s
+        self.flight = SingleFlight()
+        self.async_flight = AsyncSingleFlight()
+        self.init_db()
+
+    def init_db(self):
+        with self.db.transaction():
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS generation_cache (
+                    key TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    generated_id INTEGER NOT NULL,
+                    meta TEXT,
+                    created_at REAL NOT NULL,
+                    last_hit REAL NOT NULL,
+                    PRIMARY KEY (key, idx)
+                )
+            ''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS idx_generation_cache_generated ON generation_cache (generated_id)')
+
+    def get(self, key: str):
+        """Return ``{'images': [url, ...], 'meta': {...}}`` for a live entry, else None."""
+        now = time.time()
+        rows = self.db.query('''
+            SELECT c.idx, c.meta, c.created_at, g.filename
+            FROM generation_cache c LEFT JOIN generated g ON g.id = c.generated_id
+            WHERE c.key = ? ORDER BY c.idx
+        ''', (key,))
+        if not rows:
+            return None
+        with self.db.transaction():
+            if any(r[3] is None for r in rows) or rows[0][2] < now - self.max_age_s:
+                # an image was deleted from the gallery or the entry is stale
+                self.db.execute('DELETE FROM generation_cache WHERE key = ?', (key,))
+                return None
+            self.db.execute('UPDATE generation_cache SET last_hit = ? WHERE key = ?', (now, key))
+        return {
+            'images': ['/static/generated/' + r[3] for r in rows],
+            'meta': json.loads(rows[0][1]) if rows[0][1] else {},
+        }
+
+    def put(self, key: str, urls, meta=None):
+        """Record the saved image urls (``/static/generated/<file>``) for ``key``."""
+        filenames = [u.rsplit('/', 1)[-1] for u in urls if u]
+        if not filenames:
+            return
+        now = time.time()
+        ids = []
+        for fname in filenames:
+            row = self.db.query_one('SELECT id FROM generated WHERE filename = ?', (fname,))
+            if row is None:
+                return
+            ids.append(row[0])
+        meta_json = json.dumps(meta or {}, default=str)
+        with self.db.transaction():
+            self.db.execute('DELETE FROM generation_cache WHERE key = ?', (key,))
+            self.db.executemany(
+                'INSERT INTO generation_cache (key, idx, generated_id, meta, created_at, last_hit) VALUES (?,?,?,?,?,?)',
+                [(key, idx, gid, meta_json, now, now) for idx, gid in enumerate(ids)])
+            self._evict(now)
+
+    def forget_generated(self, *generated_ids: int):
+        """Drop every entry that references one of the deleted ``generated`` rows."""
+        marks = ','.join('?' * len(generated_ids))
+        with self.db.transaction():
+            self.db.execute(f'''
+                DELETE FROM generation_cache WHERE key IN
+                    (SELECT key FROM generation_cache WHERE generated_id IN ({marks}))
+            ''', generated_ids)
+
+    def evict(self):
+        with self.db.transaction():
+            self._evict(time.time())
+
+    def _evict(self, now):
+        self.db.execute('DELETE FROM generation_cache WHERE created_at < ?', (now - self.max_age_s,))
+        self.db.execute('''
+            DELETE FROM generation_cache WHERE key IN
+                (SELECT DISTINCT c.key FROM generation_cache c LEFT JOIN generated g ON g.id = c.generated_id
+                 WHERE g.id IS NULL)
+        ''')
+        self.db.execute('''
+            DELETE FROM generation_cache WHERE key NOT IN
+                (SELECT key FROM generation_cache GROUP BY key ORDER BY MAX(last_hit) DESC LIMIT ?)
+        ''', (self.max_entries,))
@@ -0,0 +1,87 @@
+"""Shared keep-alive HTTP client for the image backends.
+
+Every outbound call to Stable Diffusion / ComfyUI goes through one
+``requests.Session`` so connections are pooled per host and reused across
+requests instead of paying a new TCP handshake per call.
+
+Configuration (environment variables, read on first use):
+
+- ``HTTP_POOL_HOSTS``: number of per-host pools to keep (default 10)
+- ``HTTP_POOL_SIZE``: keep-alive connections per host (default 20)
+- ``HTTP_CONNECT_TIMEOUT`` / ``HTTP_READ_TIMEOUT``: default timeouts in seconds
+"""
+import os
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    def __init__(self, pool_hosts: int = 10, pool_size: int = 20,
+                 connect_timeout: float = 5.0, read_timeout: float = 60.0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+        """Send a request on the pooled session; ``timeout`` overrides the default per call."""
+        return self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def download_to_tempfile(self, url: str, chunk_size: int = 64 * 1024, **kwargs):
+        """Stream a response body into an anonymous temp file and return it rewound.
+
+        Memory stays at one chunk regardless of the body size; the file is
+        deleted when closed.
+        """
+        with self.get(url, stream=True, **kwargs) as response:
+            response.raise_for_status()
+            f = tempfile.TemporaryFile()
+            try:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                raise
+        f.seek(0)
+        return f
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HTTPClient:
+    """Return the process-wide client, creating it from the environment on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient(
+                pool_hosts=int(os.environ.get("HTTP_POOL_HOSTS", 10)),
+                pool_size=int(os.environ.get("HTTP_POOL_SIZE", 20)),
+                connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5.0)),
+                read_timeout=float(os.environ.get("HTTP_READ_TIMEOUT", 60.0)),
+            )
+        return _client
+
+
+def configure(**kwargs) -> HTTPClient:
+    """Replace the shared client (e.g. with a different pool size) and return it."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HTTPClient(**kwargs)
+        return _client
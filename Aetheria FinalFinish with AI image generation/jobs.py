@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds ``max_pending`` unfinished jobs."""
+
+
+class JobQueue:
+    """Bounded worker pool for long-running generations.
+
+    ``submit`` returns a job id immediately; the callable runs on one of
+    ``max_workers`` threads and its return value (or error) is kept for
+    ``ttl_s`` seconds so clients can poll ``get`` for the result.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 32, ttl_s: float = 3600.0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl_s = ttl_s
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generate")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> str:
+        with self._lock:
+            self._expire_locked()
+            pending = sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{pending} jobs already pending")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def get(self, job_id: str):
+        """Return a snapshot of the job, or None if it is unknown or expired."""
+        with self._lock:
+            self._expire_locked()
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+        counts["workers"] = self.max_workers
+        return counts
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+        else:
+            self._update(job_id, status="done", result=result, finished_at=time.time())
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.ttl_s
+        expired = [jid for jid, job in self._jobs.items()
+                   if job["finished_at"] is not None and job["finished_at"] < cutoff]
+        for jid in expired:
+            del self._jobs[jid]
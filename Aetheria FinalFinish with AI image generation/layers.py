@@ -0,0 +1,53 @@
+"""Cache of static RGBA overlay layers for the procedural renderer.
+
+Borders, glow rings and the fortune symbol ring only depend on the output
+size (and a style name), yet they used to be redrawn shape by shape for
+every image. :class:`LayerCache` draws each one once on a transparent
+canvas and composites the cached layer afterwards, which is a single
+masked paste.
+"""
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+
+class LayerCache:
+    def __init__(self, max_layers: int = 64):
+        self.max_layers = max_layers
+        self._layers = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str, size: tuple, draw_fn=None, style=None, build_fn=None) -> Image.Image:
+        """Return the RGBA layer for ``(name, size, style)``, drawing it with
+        ``draw_fn(draw, width, height)`` on first use, or taking the image
+        returned by ``build_fn(width, height)``. Treat it as read-only."""
+        key = (name, tuple(size), style)
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+                self.hits += 1
+                return layer
+        if build_fn is not None:
+            layer = build_fn(*size)
+        else:
+            layer = Image.new('RGBA', tuple(size), (0, 0, 0, 0))
+            draw_fn(ImageDraw.Draw(layer), *size)
+        with self._lock:
+            self.misses += 1
+            self._layers[key] = layer
+            while len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+        return layer
+
+    def composite(self, image: Image.Image, name: str, draw_fn=None, style=None, build_fn=None):
+        """Paste the cached layer over ``image`` in place."""
+        layer = self.get(name, image.size, draw_fn, style, build_fn)
+        image.paste(layer, (0, 0), layer)
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'layers': len(self._layers), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,208 @@
+"""Process-wide counters, gauges and histograms in Prometheus text format.
+
+A dependency-free subset of the Prometheus client model: metrics are
+registered once (by name) in :data:`REGISTRY`, updated from any thread, and
+:func:`render` produces the text exposition format (version 0.0.4) served
+on ``/metrics``. Labels are passed as keyword arguments::
+
+    SUBMIT = histogram('aetheria_backend_submit_seconds', 'Backend submit time.', ('backend',))
+    with SUBMIT.time(backend='sd'):
+        ...
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds; spans cache hits (ms) to slow renders (minutes)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._values[()] = self._initial()  # exported as 0 before the first update
+
+    def _initial(self):
+        return 0
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key, extra=()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value) -> list:
+        return [f'{self.name}{self._labels(key)} {_number(value)}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        return {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._initial()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels) -> dict:
+        """``{'count', 'sum'}`` observed so far for these labels."""
+        with self._lock:
+            state = self._values.get(self._key(labels)) or {'sum': 0.0, 'count': 0}
+            return {'count': state['count'], 'sum': state['sum']}
+
+    def _samples(self, key, state) -> list:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self._labels(key, [("le", _number(bound))])} {cumulative}')
+        lines.append(f'{self.name}_bucket{self._labels(key, [("le", "+Inf")])} {state["count"]}')
+        lines.append(f'{self.name}_sum{self._labels(key)} {_number(state["sum"])}')
+        lines.append(f'{self.name}_count{self._labels(key)} {state["count"]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'metric {name} already registered as {metric.type} {metric.labelnames}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return '\n'.join(line for m in metrics for line in m.render()) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# stages of /api/generate, shared by the SD and ComfyUI pipelines --------------
+
+BACKEND_SUBMIT = histogram('aetheria_backend_submit_seconds',
+                           'Time to submit a job to a generation backend (SD txt2img: until the response arrives).',
+                           ('backend',))
+BACKEND_WAIT = histogram('aetheria_backend_wait_seconds',
+                         'Time waiting for a queued backend job to finish.', ('backend',))
+BACKEND_DOWNLOAD = histogram('aetheria_backend_download_seconds',
+                             'Time reading and decoding generated images from the backend.', ('backend',))
+COMFYUI_POLLS = counter('aetheria_comfyui_history_polls_total',
+                        'ComfyUI /history requests made while waiting for prompts.')
+PIL_RENDER = histogram('aetheria_pil_render_seconds', 'PIL drawing time per image.', ('kind',))
+IMAGE_ENCODE = histogram('aetheria_image_encode_seconds', 'Time encoding one image as PNG straight into its file.')
+DISK_WRITE = histogram('aetheria_disk_write_seconds', 'Time writing one generated image to disk.')
+SQLITE_STATEMENT = histogram('aetheria_sqlite_statement_seconds', 'SQLite statement time by statement type.',
+                             ('op',), buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+GENERATE_TOTAL = counter('aetheria_generate_total', 'Image generations by result (success, failure).', ('result',))
+GENERATIONS_IN_FLIGHT = gauge('aetheria_generations_in_flight', 'Image generations currently running.')
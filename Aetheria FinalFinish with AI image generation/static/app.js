@@ -383,22 +383,42 @@ async function sendChatMessage(event) {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Accept': 'text/event-stream',
             },
             body: JSON.stringify({
                 message: message,
-                crystal: selectedCrystal
+                crystal: selectedCrystal,
+                stream: true
             })
         });
 
-        const data = await response.json();
-
-        // 隐藏输入指示器
-        if (typingIndicator) {
-            typingIndicator.style.display = 'none';
+        if (!(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+            const data = await response.json();
+            if (typingIndicator) {
+                typingIndicator.style.display = 'none';
+            }
+            addChatMessage(data.reply, 'bot');
+            return;
         }
 
-        // 添加机器人回复
-        addChatMessage(data.reply, 'bot');
+        // 逐个显示到达的 token；最后的 done 事件携带完整回复
+        let bubble = null;
+        let text = '';
+        await readEvents(response, (name, data) => {
+            if (!bubble) {
+                // 隐藏输入指示器
+                if (typingIndicator) {
+                    typingIndicator.style.display = 'none';
+                }
+                bubble = addChatMessage('', 'bot');
+            }
+            text = name === 'done' ? data.reply : text + data.token;
+            bubble.textContent = text;
+            chatLog.scrollTop = chatLog.scrollHeight;
+        });
+        if (!bubble) {
+            throw new Error('empty chat stream');
+        }
 
     } catch (error) {
         console.error('Chat error:', error);
@@ -428,6 +448,31 @@ function addChatMessage(message, sender) {
 
     chatLog.appendChild(messageDiv);
     chatLog.scrollTop = chatLog.scrollHeight;
+    return messageDiv.querySelector('.message-bubble');
+}
+
+// 读取 text/event-stream 响应，每个事件调用一次 onEvent(事件名, 数据)
+async function readEvents(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let end;
+        while ((end = buffer.indexOf('\n\n')) >= 0) {
+            const raw = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            let name = 'message';
+            let data = '';
+            for (const line of raw.split('\n')) {
+                if (line.startsWith('event:')) name = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            }
+            if (data) onEvent(name, JSON.parse(data));
+        }
+    }
 }
 
 // 处理键盘事件
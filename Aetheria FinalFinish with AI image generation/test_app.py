@@ -1,4 +1,7 @@
 import json
+
+import pytest
+
 from app import create_app
 
 
@@ -21,3 +24,503 @@ def test_chat_endpoint():
     assert resp.status_code == 200
     data = resp.get_json()
     assert 'reply' in data
+
+
+def test_generate_async_job(tmp_path, monkeypatch):
+    import time
+    import app as app_module
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (4, 4)))
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = app.test_client()
+
+    resp = client.post('/api/generate', json={'prompt': 'stars', 'async': True})
+    assert resp.status_code == 202
+    job_id = resp.get_json()['job_id']
+
+    for _ in range(100):
+        job = client.get(f'/api/jobs/{job_id}').get_json()
+        if job['status'] in ('done', 'failed'):
+            break
+        time.sleep(0.05)
+    assert job['status'] == 'done'
+    assert job['result']['success'] is True
+
+    gid = client.get('/api/generated').get_json()['items'][0]['id']
+    assert client.delete(f'/api/generated/{gid}').status_code == 200
+    assert client.get('/api/jobs/missing').status_code == 404
+    assert client.post('/api/generate', json={'prompt': 'stars', 'workflow': 'missing'}).status_code == 400
+
+
+def test_generate_reuses_cached_image(tmp_path, monkeypatch):
+    import app as app_module
+
+    calls = []
+
+    def fake_render(prompt, width, height, workflow='base'):
+        calls.append(prompt)
+        return app_module.Image.new('RGB', (4, 4))
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image', fake_render)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = app.test_client()
+
+    first = client.post('/api/generate', json={'prompt': 'moon', 'width': 64, 'height': 64}).get_json()
+    second = client.post('/api/generate', json={'prompt': 'moon', 'width': 64, 'height': 64}).get_json()
+    assert calls == ['moon']
+    assert second['cached'] is True
+    assert second['image'] == first['image']
+
+    # deleting the image from the gallery invalidates the cache entry
+    gid = client.get('/api/generated').get_json()['items'][0]['id']
+    client.delete(f'/api/generated/{gid}')
+    third = client.post('/api/generate', json={'prompt': 'moon', 'width': 64, 'height': 64}).get_json()
+    assert calls == ['moon', 'moon']
+    assert 'cached' not in third
+    gid = client.get('/api/generated').get_json()['items'][0]['id']
+    client.delete(f'/api/generated/{gid}')
+
+
+def test_generated_listing_is_cursor_paginated(tmp_path):
+    import sqlite3
+
+    db_path = str(tmp_path / 'test.db')
+    app = create_app({'DATABASE': db_path})
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)',
+                     [(f'img-{i}.png', f'p{i}', 'ruby' if i % 2 else 'jade', f'2025-01-{i + 1:02d}T00:00:00')
+                      for i in range(7)])
+    conn.commit()
+    conn.close()
+    client = app.test_client()
+
+    page = client.get('/api/generated?limit=3').get_json()
+    assert [it['id'] for it in page['items']] == [7, 6, 5]
+    page = client.get(f"/api/generated?limit=3&cursor={page['next_cursor']}").get_json()
+    assert [it['id'] for it in page['items']] == [4, 3, 2]
+    page = client.get(f"/api/generated?limit=3&cursor={page['next_cursor']}").get_json()
+    assert [it['id'] for it in page['items']] == [1]
+    assert page['next_cursor'] is None
+
+    ruby = client.get('/api/generated?crystal=ruby&since=2025-01-03').get_json()
+    assert [it['id'] for it in ruby['items']] == [6, 4]
+    assert client.get('/api/generated/count?crystal=ruby').get_json() == {'count': 3}
+    assert client.get('/api/generated?since=yesterday').status_code == 400
+
+
+def test_database_batches_concurrent_inserts(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    db = app.extensions['db']
+    with ThreadPoolExecutor(8) as pool:
+        ids = list(pool.map(lambda i: db.insert_generated(f'img-{i}.png', 'p', 'ruby', '2025-01-01T00:00:00'),
+                            range(40)))
+    assert sorted(ids) == list(range(1, 41))
+    assert db.query_one('PRAGMA journal_mode')[0] == 'wal'
+
+    client = app.test_client()
+    assert client.get('/api/generated/count').get_json() == {'count': 40}
+    stats = client.get('/api/db/stats').get_json()['statements']
+    insert = stats['INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)']
+    assert insert['count'] == 40
+
+
+def test_generate_saves_without_base64_unless_inline(tmp_path, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (4, 4), 'red'))
+    monkeypatch.setattr(app_module.pil_generator, '_image_to_base64',
+                        lambda image: pytest.fail('generation path must not base64-encode'))
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'GENERATION_CACHE': False})
+    client = app.test_client()
+
+    plain = client.post('/api/generate', json={'prompt': 'sun'}).get_json()
+    assert plain['success'] and 'image_data' not in plain
+    inline = client.post('/api/generate', json={'prompt': 'sun', 'inline': True}).get_json()
+    assert inline['image_data'].startswith('data:image/png;base64,')
+
+    for item in client.get('/api/generated').get_json()['items']:
+        client.delete(f"/api/generated/{item['id']}")
+
+
+def test_generated_images_get_thumbnails_on_save(tmp_path, monkeypatch):
+    import os
+    import time
+    import app as app_module
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (width, height), 'purple'))
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'GENERATION_CACHE': False})
+    client = app.test_client()
+    client.post('/api/generate', json={'prompt': 'moon', 'width': 512, 'height': 768})
+
+    deadline = time.time() + 5
+    while True:
+        item = client.get('/api/generated').get_json()['items'][0]
+        urls = [t['url'] for t in item['thumbnails']]
+        if all(u.startswith('/static/generated/thumbs/') for u in urls) or time.time() > deadline:
+            break
+        time.sleep(0.05)
+    assert [t['width'] for t in item['thumbnails']] == [160, 320, 640]
+    assert all(u.startswith('/static/generated/thumbs/') for u in urls)
+    paths = [os.path.join(app.config['GENERATED_DIR'], u.split('/static/generated/', 1)[1]) for u in urls]
+    assert all(os.path.exists(p) for p in paths)
+    assert client.get(f"/api/generated/{item['id']}/thumb/160").status_code == 200
+
+    client.delete(f"/api/generated/{item['id']}")
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_gallery_api_is_revalidated_with_etags(tmp_path):
+    import os
+    import uuid
+    from PIL import Image
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    first = client.get('/api/generated')
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'no-cache' and first.headers['Last-Modified']
+    assert client.get('/api/generated', headers={'If-None-Match': etag}).status_code == 304
+    count_etag = client.get('/api/generated/count').headers['ETag']
+    assert client.get('/api/generated/count', headers={'If-None-Match': count_etag}).status_code == 304
+
+    fname = f'test-{uuid.uuid4().hex}.png'
+    Image.new('RGB', (200, 300), (90, 40, 160)).save(os.path.join(app.config['GENERATED_DIR'], fname))
+    gid = app.extensions['db'].insert_generated(fname, 'p', 'ruby', '2025-01-01T00:00:00')
+    changed = client.get('/api/generated', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.get_json()['items'][0]['id'] == gid
+
+    # generated files are immutable; building thumbnails changes the listing again
+    thumb = client.get(f'/api/generated/{gid}/thumb/160')
+    assert thumb.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert client.get('/api/generated', headers={'If-None-Match': changed.headers['ETag']}).status_code == 200
+    image = client.get(f'/static/generated/{fname}')
+    assert image.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    thumb.close()
+    image.close()
+    client.delete(f'/api/generated/{gid}')
+
+
+def test_card_images_are_rendered_once_then_served(tmp_path, monkeypatch):
+    import os
+    import app as app_module
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = app.test_client()
+    deck_dir = os.path.join(app.static_folder, 'deck')
+    path = os.path.join(deck_dir, 'the_hanged_man.256x384.png')
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        first = client.get('/api/cards/the_hanged_man/image?size=256x384')
+        assert first.status_code == 200 and os.path.exists(path)
+        monkeypatch.setattr(app_module, 'render_deck_card', lambda *a: pytest.fail('should be served from disk'))
+        assert client.get('/api/cards/the_hanged_man/image?size=256x384').data == first.data
+        monkeypatch.undo()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    assert client.get('/api/cards/the_hanged_man/image?size=1x1').status_code == 404
+    assert client.get('/api/cards/nope/image').status_code == 404
+
+    out = client.post('/api/cards', json={'reading': 'three'}).get_json()
+    assert all(c['deck_image'].startswith('/api/cards/') for c in out['cards'])
+
+    rendered = app_module.render_deck(str(tmp_path / 'deck'), sizes=((64, 96),), deck=app_module.tarot.CARDS[:3])
+    assert len(rendered) == 3 and all(os.path.exists(p) for p in rendered)
+
+
+def test_metrics_cover_generate_stages(tmp_path, monkeypatch):
+    import app as app_module
+    from metrics import GENERATE_TOTAL, IMAGE_ENCODE
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (8, 8)))
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'GENERATION_CACHE': False})
+    client = app.test_client()
+    succeeded = GENERATE_TOTAL.value(result='success')
+    encoded = IMAGE_ENCODE.snapshot()['count']
+    assert client.post('/api/generate', json={'prompt': 'metrics'}).get_json()['success'] is True
+    resp = client.get('/metrics')
+    assert resp.content_type == 'text/plain; version=0.0.4; charset=utf-8'
+    text = resp.get_data(as_text=True)
+    for sample in ('aetheria_disk_write_seconds_count', 'aetheria_sqlite_statement_seconds_count{op="insert"}',
+                   'aetheria_generations_in_flight 0', '# TYPE aetheria_backend_wait_seconds histogram'):
+        assert sample in text
+    assert GENERATE_TOTAL.value(result='success') == succeeded + 1
+    assert IMAGE_ENCODE.snapshot()['count'] == encoded + 1
+    gid = client.get('/api/generated').get_json()['items'][0]['id']
+    client.delete(f'/api/generated/{gid}')
+
+
+def test_generate_reports_stage_spans(tmp_path, monkeypatch, caplog):
+    import json
+    import logging
+    import time
+    import app as app_module
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (8, 8)))
+    caplog.set_level(logging.INFO, logger='aetheria.trace')
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'GENERATION_CACHE': False, 'SERVER_TIMING': True})
+    client = app.test_client()
+    resp = client.post('/api/generate', json={'prompt': 'spans'})
+    stages = [entry.split(';')[0] for entry in resp.headers['Server-Timing'].split(', ')]
+    for stage in ('render_fortune_image', 'image.encode', 'db.insert', 'save_image', 'request'):
+        assert stage in stages
+
+    # 异步任务的分段日志沿用提交请求的 request id
+    resp = client.post('/api/generate', json={'prompt': 'spans', 'async': True}, headers={'X-Request-ID': 'job-1'})
+    status_url = resp.get_json()['status_url']
+    for _ in range(100):
+        if client.get(status_url).get_json()['status'] == 'done':
+            break
+        time.sleep(0.02)
+    spans = [json.loads(r.getMessage()) for r in caplog.records]
+    assert {'render_fortune_image', 'save_image'} <= {s['span'] for s in spans if s['request_id'] == 'job-1'}
+    for item in client.get('/api/generated').get_json()['items']:
+        client.delete(f"/api/generated/{item['id']}")
+
+
+def test_async_generate_keeps_the_json_contract(tmp_path, monkeypatch):
+    import asyncio
+    import time
+    import app as app_module
+    from app import create_asgi_app
+    from asgi_bridge import request
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image',
+                        lambda prompt, width, height, workflow='base': app_module.Image.new('RGB', (4, 4)))
+    calls = []
+
+    async def fake_render(prompt, width, height, workflow='base'):
+        calls.append(prompt)
+        await asyncio.sleep(0.3)
+        return app_module.Image.new('RGB', (4, 4))
+
+    monkeypatch.setattr(app_module.pil_generator, 'render_fortune_image_async', fake_render)
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = asgi.flask_app.test_client()
+    sync_body = client.post('/api/generate', json={'prompt': 'sync', 'cache': False}).get_json()
+
+    async def run():
+        start = time.perf_counter()
+        # 五个不同提示词在同一事件循环上并发等待，另有两个相同请求合并为一次生成
+        prompts = ['a', 'b', 'c', 'd', 'e', 'moon', 'moon']
+        responses = await asyncio.gather(*(request(asgi, 'POST', '/api/generate', json={'prompt': p})
+                                           for p in prompts))
+        elapsed = time.perf_counter() - start
+        cached = await request(asgi, 'POST', '/api/generate', json={'prompt': 'moon'})
+        invalid = await request(asgi, 'POST', '/api/generate', json={'prompt': 'moon', 'workflow': 'missing'})
+        listing = await request(asgi, 'GET', '/api/generated/count')  # 由 Flask 处理
+        return responses, elapsed, cached, invalid, listing
+
+    responses, elapsed, cached, invalid, listing = asyncio.run(run())
+    status, headers, body = responses[0]
+    body = json.loads(body)
+    assert status == 200 and headers['content-type'] == 'application/json' and 'x-request-id' in headers
+    assert sorted(body) == sorted(sync_body) and body['success'] is True
+    assert sorted(calls) == ['a', 'b', 'c', 'd', 'e', 'moon'] and elapsed < 0.9
+    assert json.loads(responses[-1][2])['image'] == json.loads(responses[-2][2])['image']
+    assert json.loads(cached[2])['cached'] is True
+    assert invalid[0] == 400
+    assert json.loads(listing[2])['count'] == 7
+    for item in client.get('/api/generated?limit=50').get_json()['items']:
+        client.delete(f"/api/generated/{item['id']}")
+
+
+def test_async_chat_awaits_the_completion_api(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from app import create_asgi_app
+    from asgi_bridge import request
+
+    calls = []
+
+    class Completions(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            calls.append((self.path, self.headers['Authorization'],
+                          json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+            body = json.dumps({'choices': [{'text': '  The stars lean your way.  '}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Completions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_BASE', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db')})
+    try:
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'Will I travel?'}))
+        assert status == 200 and json.loads(body) == {'reply': 'The stars lean your way.'}
+        path, auth, payload = calls[0]
+        assert path == '/v1/completions' and auth == 'Bearer sk-test' and 'Will I travel?' in payload['prompt']
+    finally:
+        server.shutdown()
+        server.server_close()
+    # API 不可用时由本地回复兜底
+    status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'love?'}))
+    assert json.loads(body) == {'reply': 'Love is in flux — honest communication will guide you.'}
+
+
+def test_card_readings_are_seeded_and_batched(tmp_path):
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'CARDS_BATCH_MAX': 5000})
+    client = app.test_client()
+
+    first = client.post('/api/cards', json={'reading': 'three', 'seed': 11}).get_json()
+    again = client.post('/api/cards', json={'reading': 'three', 'seed': 11}).get_json()
+    assert first['seed'] == 11 and first['cards'] == again['cards']
+    assert [c['position'] for c in first['cards']] == ['Past', 'Present', 'Future']
+    assert all(c['deck_image'] == f"/api/cards/{c['name'].lower().replace(' ', '_')}/image" for c in first['cards'])
+    assert client.post('/api/cards', json={'seed': 'x'}).status_code == 400
+
+    resp = client.post('/api/cards/batch', json={'reading': 'five', 'count': 5000, 'seed': 1})
+    body = resp.get_json()
+    assert resp.status_code == 200 and len(body['draws']) == 5000 and len(body['reversed'][0]) == 5
+    assert len(body['deck']) == 78 and sum(body['frequencies']) == 25000
+    assert client.post('/api/cards/batch', json={'reading': 'five', 'count': 5001}).status_code == 400
+    assert client.post('/api/cards/batch', json={'reading': 'nope'}).status_code == 400
+
+
+def _sse_events(body):
+    events = []
+    for raw in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in raw.split('\n'))
+        events.append((lines.get('event', 'message'), json.loads(lines['data'])))
+    return events
+
+
+def test_chat_streams_tokens_with_deadlines(tmp_path, monkeypatch):
+    import asyncio
+    import time
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from fake_backends import FakeCompletions
+
+    slow_tokens = FakeCompletions(token_delay_s=0.1)
+    no_first_token = FakeCompletions(latency_s=2.0)
+    stalls = FakeCompletions(stall_after=2, stall_s=2.0)
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db'), 'CHAT_READ_TIMEOUT': 0.3})
+    client = asgi.flask_app.test_client()
+    try:
+        # 首个 token 在整条补全生成完之前就已发出
+        monkeypatch.setenv('OPENAI_API_BASE', slow_tokens.url)
+        start = time.perf_counter()
+        resp = client.post('/api/chat', json={'message': 'Will I travel?', 'stream': True}, buffered=False)
+        chunks = resp.response
+        first = next(chunks)
+        first_byte = time.perf_counter() - start
+        body = (first + b''.join(chunks)).decode()
+        total = time.perf_counter() - start
+        assert resp.mimetype == 'text/event-stream'
+        assert first_byte < 0.1 < 0.4 < total
+        events = _sse_events(body)
+        assert ''.join(e['token'] for _, e in events[:-1]) == 'The stars lean your way tonight.'
+        assert events[-1] == ('done', {'reply': 'The stars lean your way tonight.', 'source': 'openai'})
+        assert slow_tokens.payloads[0]['stream'] is True and slow_tokens.payloads[0]['authorization'] == 'Bearer sk-test'
+
+        # CHAT_READ_TIMEOUT 内没有首个 token：由本地回复兜底
+        monkeypatch.setenv('OPENAI_API_BASE', no_first_token.url)
+        start = time.perf_counter()
+        events = _sse_events(client.post('/api/chat', json={'message': 'love?', 'stream': True}).get_data(as_text=True))
+        assert time.perf_counter() - start < 1.0
+        assert events[-1] == ('done', {'reply': 'Love is in flux — honest communication will guide you.',
+                                       'source': 'local'})
+
+        # 上游中途停顿：保留已收到的部分并标记 truncated
+        monkeypatch.setenv('OPENAI_API_BASE', stalls.url)
+        events = _sse_events(client.post('/api/chat', json={'message': 'x', 'stream': True}).get_data(as_text=True))
+        assert events[-1] == ('done', {'reply': 'The stars', 'source': 'openai', 'truncated': True})
+
+        # 异步服务模式发送相同的事件
+        monkeypatch.setenv('OPENAI_API_BASE', slow_tokens.url)
+        status, headers, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'x', 'stream': True}))
+        assert status == 200 and headers['content-type'] == 'text/event-stream'
+        assert _sse_events(body.decode())[-1] == ('done', {'reply': 'The stars lean your way tonight.',
+                                                           'source': 'openai'})
+        monkeypatch.setenv('OPENAI_API_BASE', no_first_token.url)
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'love?', 'stream': True}))
+        assert _sse_events(body.decode())[-1][1]['source'] == 'local'
+    finally:
+        for fake in (slow_tokens, no_first_token, stalls):
+            fake.close()
+
+
+def test_repeated_questions_are_served_from_the_reply_cache(tmp_path, monkeypatch):
+    import asyncio
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from fake_backends import FakeCompletions
+
+    fake = FakeCompletions()
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_BASE', fake.url)
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = asgi.flask_app.test_client()
+    try:
+        first = client.post('/api/chat', json={'message': 'Will I travel?', 'crystal': 'Amethyst', 'stream': True})
+        assert _sse_events(first.get_data(as_text=True))[-1][1]['source'] == 'openai'
+        # 流式回复完成后写入缓存
+        again = client.post('/api/chat', json={'message': 'will i TRAVEL', 'crystal': 'amethyst', 'stream': True})
+        assert _sse_events(again.get_data(as_text=True))[-1] == (
+            'done', {'reply': 'The stars lean your way tonight.', 'source': 'cache'})
+        # 异步处理函数共用同一缓存
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat',
+                                              json={'message': 'Will I travel', 'crystal': 'amethyst'}))
+        assert json.loads(body) == {'reply': 'The stars lean your way tonight.'}
+        assert fake.requests == 1
+        # 换一个水晶就是另一个问题
+        client.post('/api/chat', json={'message': 'Will I travel?', 'crystal': 'rose', 'stream': True}).get_data()
+        assert fake.requests == 2
+        assert asgi.flask_app.extensions['chat_cache'].info()['entries'] == 2
+    finally:
+        fake.close()
+
+
+def test_generated_images_are_deleted_in_bulk_and_reconciled(tmp_path):
+    import os
+    import time
+    import uuid
+    from PIL import Image
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    db = app.extensions['db']
+    generated_dir = app.config['GENERATED_DIR']
+    assert generated_dir.startswith(str(tmp_path))  # 不是仓库里的 static/generated
+    paths, ids = [], []
+    for _ in range(3):
+        fname = f'test-{uuid.uuid4().hex}.png'
+        paths.append(os.path.join(generated_dir, fname))
+        Image.new('RGB', (200, 300), (90, 40, 160)).save(paths[-1])
+        ids.append(db.insert_generated(fname, 'p', 'ruby', '2025-01-01T00:00:00'))
+    assert client.get(f'/api/generated/{ids[0]}/thumb/160').status_code == 200
+    thumb_paths = [os.path.join(generated_dir, 'thumbs', f) for (f,) in db.query('SELECT filename FROM generated_thumbs')]
+
+    assert client.post('/api/generated/delete', json={'ids': 'all'}).status_code == 400
+    resp = client.post('/api/generated/delete', json={'ids': [ids[0], ids[1], 424242]})
+    assert resp.get_json() == {'deleted': [ids[0], ids[1]], 'missing': [424242]}
+    app.extensions['unlinker'].submit(()).result()  # 后台按提交顺序删除
+    assert [os.path.exists(p) for p in paths] == [False, False, True]
+    assert thumb_paths and not any(os.path.exists(p) for p in thumb_paths)
+
+    # 没写入记录的图片（足够旧，不是正在保存的）和图片已丢失的记录
+    orphan = os.path.join(generated_dir, f'test-{uuid.uuid4().hex}.png')
+    Image.new('RGB', (8, 8)).save(orphan)
+    os.utime(orphan, (time.time() - 7200,) * 2)
+    os.remove(paths[2])
+    report = client.post('/api/generated/reconcile').get_json()
+    assert report['orphan_files'] == [os.path.basename(orphan)] and report['missing_files'] == [ids[2]]
+    assert report['repaired'] is False and os.path.exists(orphan)
+    assert client.delete(f'/api/generated/{ids[2]}').get_json() == {'deleted': ids[2]}
@@ -0,0 +1,26 @@
+import json
+
+import bench
+import loadgen
+
+
+def test_percentile_and_compare():
+    values = list(range(1, 101))
+    assert [loadgen.percentile(values, q) for q in (50, 95, 99, 100)] == [50, 95, 99, 100]
+    assert loadgen.percentile([], 50) == 0.0
+    old = {'scenarios': {'cards': {'p50_ms': 10.0, 'errors': 0}}}
+    new = {'scenarios': {'cards': {'p50_ms': 12.5, 'errors': 0}}}
+    assert '+25.0%' in loadgen.compare(old, new)
+
+
+def test_benchmark_runs_offline(tmp_path):
+    out = tmp_path / 'bench.json'
+    doc = bench.main(['--requests', '6', '--concurrency', '3', '--warmup', '0', '--latency', '0',
+                      '--jitter', '0', '--backends', '2', '--width', '64', '--height', '64', '--out', str(out)])
+    assert json.loads(out.read_text()) == json.loads(loadgen.dumps(doc))
+    assert list(doc['scenarios']) == list(bench.SCENARIOS)
+    for result in doc['scenarios'].values():
+        assert result['requests'] == 6 and result['errors'] == 0
+        assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'] <= result['max_ms']
+    backends = next(iter(doc['backends'].values()))
+    assert sum(b['requests'] for b in backends) == 6
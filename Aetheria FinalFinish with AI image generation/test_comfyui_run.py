@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import comfyui_run
+
+
+class FakeComfyUI:
+    """Minimal ComfyUI stand-in: /prompt, /history/<id>, /queue and /view."""
+
+    def __init__(self, render_s=0.2):
+        self.render_s = render_s
+        self.queued = {}
+        self.graphs = []
+        self.history_requests = 0
+        self.client_ports = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json'):
+                fake.client_ports.add(self.client_address[1])
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                fake.graphs.append(json.loads(self.rfile.read(length))['prompt'])
+                prompt_id = uuid.uuid4().hex
+                fake.queued[prompt_id] = time.monotonic() + fake.render_s
+                self._send(200, json.dumps({'prompt_id': prompt_id}).encode())
+
+            def do_GET(self):
+                if self.path.startswith('/history/'):
+                    fake.history_requests += 1
+                    prompt_id = self.path.rsplit('/', 1)[1]
+                    body = {}
+                    if time.monotonic() >= fake.queued.get(prompt_id, float('inf')):
+                        body = {prompt_id: {'outputs': {'9': {'images': [{'filename': f'{prompt_id}.png'}]}}}}
+                    self._send(200, json.dumps(body).encode())
+                elif self.path == '/queue':
+                    now = time.monotonic()
+                    running = [[0, pid] for pid, done in fake.queued.items() if done > now]
+                    self._send(200, json.dumps({'queue_running': running, 'queue_pending': []}).encode())
+                else:
+                    self._send(200, b'\x89PNG', 'image/png')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_comfyui(monkeypatch):
+    fake = FakeComfyUI()
+    monkeypatch.setattr(comfyui_run, 'base_url', fake.url)
+    monkeypatch.setattr(comfyui_run, '_watchers', {})
+    monkeypatch.setattr(comfyui_run, '_pool', None)
+    monkeypatch.delenv('COMFYUI_URLS', raising=False)
+    yield fake
+    fake.close()
+
+
+def test_queue_workflow_and_wait_returns_view_url(fake_comfyui):
+    from metrics import BACKEND_WAIT, COMFYUI_POLLS
+
+    waited, polls = BACKEND_WAIT.snapshot(backend='comfyui')['count'], COMFYUI_POLLS.value()
+    url = comfyui_run.queue_workflow_and_wait('a crystal ball', width=64, height=64)
+    assert BACKEND_WAIT.snapshot(backend='comfyui')['count'] == waited + 1
+    assert COMFYUI_POLLS.value() > polls
+    assert url.startswith(f'{fake_comfyui.url}/view?filename=')
+    # submit and every history poll share pooled keep-alive connections
+    assert len(fake_comfyui.client_ports) < fake_comfyui.history_requests + 1
+    graph, = fake_comfyui.graphs
+    assert graph['6']['inputs']['text'] == 'a crystal ball'
+    assert graph['5']['inputs']['width'] == graph['5']['inputs']['height'] == 64
+    # the shared template is left untouched
+    assert comfyui_run.workflows.get('base').defaults()['width'] == 512
+
+
+def test_watcher_multiplexes_pending_prompts(fake_comfyui):
+    watcher = comfyui_run.CompletionWatcher(fake_comfyui.url, use_websocket=False, max_poll_s=0.5)
+    fake_comfyui.queued['slow'] = time.monotonic() + 0.6
+    fake_comfyui.queued['fast'] = time.monotonic() + 0.1
+
+    slow, fast = watcher.watch('slow'), watcher.watch('fast')
+    assert fast.result(timeout=5)['9']['images'][0]['filename'] == 'fast.png'
+    assert not slow.done()
+    assert slow.result(timeout=5)['9']['images'][0]['filename'] == 'slow.png'
+    # backoff keeps the request count well below a fixed 10ms poll
+    assert fake_comfyui.history_requests < 30
+
+
+def test_watcher_times_out(fake_comfyui):
+    watcher = comfyui_run.CompletionWatcher(fake_comfyui.url, use_websocket=False)
+    with pytest.raises(TimeoutError):
+        watcher.wait('never-queued', timeout=0.3)
+
+
+def test_prompts_are_spread_over_comfyui_nodes(fake_comfyui, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    other = FakeComfyUI()
+    monkeypatch.setenv('COMFYUI_URLS', f'{fake_comfyui.url},{other.url}')
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            urls = list(pool.map(lambda i: comfyui_run.queue_workflow_and_wait(f'p{i}', 64, 64), range(4)))
+        # each node gets two of the four concurrent prompts and serves its own /view urls
+        assert len(fake_comfyui.queued) == len(other.queued) == 2
+        assert sum(u.startswith(other.url) for u in urls) == 2
+
+        pool = comfyui_run.get_pool()
+        other.queued['busy'] = time.monotonic() + 60
+        pool.probe_once()
+        depths = {n['url']: n['queue_depth'] for n in pool.stats()['nodes']}
+        assert depths == {fake_comfyui.url: 0, other.url: 1}
+    finally:
+        other.close()
+
+
+def test_async_queue_workflow_and_wait_polls_without_threads(fake_comfyui):
+    import asyncio
+    from async_http import aclose_client
+
+    async def run():
+        try:
+            urls = await asyncio.gather(*(comfyui_run.queue_workflow_and_wait_async(f'orb {n}', width=64, height=64)
+                                          for n in range(10)))
+            return urls, comfyui_run.get_async_watcher(fake_comfyui.url)
+        finally:
+            await aclose_client()
+
+    urls, watcher = asyncio.run(run())
+    assert all(url.startswith(f'{fake_comfyui.url}/view?filename=') for url in urls) and len(set(urls)) == 10
+    assert sorted(g['6']['inputs']['text'] for g in fake_comfyui.graphs) == sorted(f'orb {n}' for n in range(10))
+    # the prompts were waited on by the loop's one watcher task, not by a watcher thread
+    assert comfyui_run._watchers == {}
+    assert watcher.poll_count == fake_comfyui.history_requests and not watcher._pending
+    with pytest.raises(TimeoutError):
+        asyncio.run(comfyui_run.wait_for_outputs_async(fake_comfyui.url, 'never-queued', timeout=0.3))
+
+
+def test_async_watcher_multiplexes_pending_prompts(fake_comfyui):
+    import asyncio
+    from async_http import aclose_client
+
+    async def run():
+        watcher = comfyui_run.AsyncCompletionWatcher(fake_comfyui.url, max_poll_s=0.5)
+        fake_comfyui.queued['slow'] = time.monotonic() + 0.6
+        fake_comfyui.queued['fast'] = time.monotonic() + 0.1
+        try:
+            slow, fast = watcher.watch('slow'), watcher.watch('fast')
+            assert (await asyncio.wait_for(fast, 5))['9']['images'][0]['filename'] == 'fast.png'
+            assert not slow.done()
+            assert (await asyncio.wait_for(slow, 5))['9']['images'][0]['filename'] == 'slow.png'
+            with pytest.raises(TimeoutError):
+                await watcher.wait('never-queued', timeout=0.3)
+            assert not watcher._pending
+        finally:
+            await aclose_client()
+
+    asyncio.run(run())
+    # one task polls both prompts with backoff, well below a fixed 10ms poll
+    assert fake_comfyui.history_requests < 30
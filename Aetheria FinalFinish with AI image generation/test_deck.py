@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import deck
+
+
+def test_full_deck_is_immutable_and_indexed():
+    assert len(deck.CARDS) == 78
+    assert [c.index for c in deck.CARDS] == list(range(78))
+    assert sum(c.arcana == 'major' for c in deck.CARDS) == 22
+    assert {c.suit for c in deck.CARDS if c.arcana == 'minor'} == {'wands', 'cups', 'swords', 'pentacles'}
+    assert deck.BY_SLUG['queen_of_cups'].rank == 13
+    with pytest.raises(AttributeError):
+        deck.CARDS[0].reversed = True
+
+
+def test_seeded_draws_are_reproducible_views():
+    seed, first = deck.draw('celtic_cross', 7)
+    assert seed == 7 and deck.draw('celtic_cross', 7)[1] == first
+    assert [c.position for c in first] == list(deck.SPREADS['celtic_cross'])
+    assert len({c.card.index for c in first}) == 10
+    assert all(c.card is deck.CARDS[c.card.index] for c in first)
+    assert deck.draw('three')[0] != deck.draw('three')[0]  # fresh seed per unseeded draw
+
+
+def test_concurrent_draws_do_not_share_state():
+    readings = {}
+
+    def work(seed):
+        readings[seed] = [deck.as_dict(c) for c in deck.draw('five', seed)[1]]
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert all(readings[seed] == [deck.as_dict(c) for c in deck.draw('five', seed)[1]] for seed in range(50))
+
+
+def test_batch_draws_sample_without_replacement(monkeypatch):
+    seed, indices, reversed_ = deck.draw_batch('three', 20000, seed=3)
+    assert indices.shape == reversed_.shape == (20000, 3)
+    assert (indices[:, 0] != indices[:, 1]).all() and (indices[:, 1] != indices[:, 2]).all()
+    assert (indices[:, 0] != indices[:, 2]).all()
+    assert (deck.draw_batch('three', 20000, seed=3)[1] == indices).all()
+    counts = deck.frequencies(indices)
+    assert sum(counts) == 60000 and min(counts) > 600 and max(counts) < 950  # ~769 each
+    assert 0.3 < reversed_.mean() < 0.37
+
+    # without NumPy the same call returns nested lists
+    monkeypatch.setattr(deck, 'np', None)
+    _, rows, flags = deck.draw_batch('five', 100, seed=3)
+    assert len(rows) == 100 and all(len(set(row)) == 5 for row in rows)
+    assert deck.to_lists(rows) is rows and sum(deck.frequencies(rows)) == 500 and len(flags[0]) == 5
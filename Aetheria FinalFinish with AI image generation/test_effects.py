@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import effects
+from app import PILImageGenerator
+
+
+def test_over_uses_real_alpha():
+    layer = effects.canvas(4, 4)
+    effects.over(layer, 'white', np.full((4, 4), 0.5))
+    effects.over(layer, (255, 0, 0), np.full((4, 4), 0.5))
+    r, g, b, a = effects.to_image(layer).getpixel((1, 1))
+    assert a == 191  # 1 - (1 - .5) * (1 - .5)
+    assert r == 255 and g == b == 85
+
+
+def test_gradient_fades_outward_and_clips_to_radius():
+    layer = effects.canvas(41, 41)
+    effects.radial_gradient(layer, (20, 20), 15, '#8A2BE2', inner_alpha=0.8, outer_alpha=0.2)
+    alpha = effects.to_image(layer).getchannel('A')
+    assert alpha.getpixel((20, 20)) > alpha.getpixel((30, 20)) > 0
+    assert alpha.getpixel((0, 0)) == 0
+
+
+def test_overlapping_spots_combine_like_stacked_layers():
+    layer = effects.canvas(20, 20)
+    effects.starfield(layer, [(10, 10), (10, 10)], 3, 'white', alpha=0.5)
+    assert effects.to_image(layer).getpixel((10, 10))[3] == 191
+    # spots hanging over the edge are clipped, not wrapped
+    edge = effects.canvas(20, 20)
+    effects.glow(edge, [(0, 0), (25, 25)], 4, 'white', 1.0)
+    assert effects.to_image(edge).getpixel((0, 0))[3] >= 254
+
+
+def test_crystal_ball_is_translucent():
+    gen = PILImageGenerator()
+    gen._image_to_base64 = lambda image: image
+    image = gen.generate_crystal_ball_image('a vision', 256, 256)
+    colors = {image.getpixel((x, 128)) for x in range(96, 160)}
+    assert len(colors) > 10  # a gradient, not five flat discs
@@ -0,0 +1,27 @@
+from PIL import Image, ImageDraw
+
+import fonts
+from app import PILImageGenerator
+
+
+def test_fonts_are_resolved_once():
+    first = fonts.get_font(fonts.SYMBOL_FONTS, 60)
+    misses = fonts.get_font.cache_info().misses
+    assert fonts.get_font(fonts.SYMBOL_FONTS, 60) is first
+    assert fonts.get_font.cache_info().misses == misses
+
+
+def test_text_bbox_matches_draw_and_is_cached():
+    font = fonts.get_font(fonts.TEXT_FONTS, 16)
+    draw = ImageDraw.Draw(Image.new('RGB', (64, 64)))
+    assert fonts.text_bbox('The Fool', font) == draw.textbbox((0, 0), 'The Fool', font=font)
+    hits = fonts.text_bbox.cache_info().hits
+    fonts.text_bbox('The Fool', font)
+    assert fonts.text_bbox.cache_info().hits == hits + 1
+
+
+def test_wrap_text_keeps_three_lines():
+    font = fonts.get_font(fonts.TEXT_FONTS, 16)
+    lines = PILImageGenerator()._wrap_text('stars ' * 200, font, 120)
+    assert len(lines) == 3
+    assert all(fonts.text_size(line, font)[0] <= 120 for line in lines)
@@ -0,0 +1,37 @@
+import random
+
+from PIL import Image, ImageDraw
+
+from app import PILImageGenerator
+from layers import LayerCache
+
+
+def test_cached_layers_match_direct_drawing():
+    gen = PILImageGenerator()
+    for draw_fn in (gen._draw_border, gen._draw_glow_effects):
+        direct = Image.new('RGB', (512, 768), '#6A0DAD')
+        draw_fn(ImageDraw.Draw(direct), 512, 768)
+        composited = Image.new('RGB', (512, 768), '#6A0DAD')
+        gen.layers.composite(composited, draw_fn.__name__, draw_fn)
+        assert composited.tobytes() == direct.tobytes()
+
+
+def test_layers_are_drawn_once_per_size():
+    calls = []
+    cache = LayerCache(max_layers=2)
+    draw_fn = lambda draw, w, h: calls.append((w, h))
+    for _ in range(3):
+        cache.get('ring', (64, 64), draw_fn)
+    cache.get('ring', (32, 32), draw_fn)
+    assert calls == [(64, 64), (32, 32)]
+    assert cache.info() == {'layers': 2, 'hits': 2, 'misses': 2}
+    cache.get('ring', (16, 16), draw_fn)
+    cache.get('ring', (64, 64), draw_fn)  # least recently used, evicted
+    assert len(calls) == 4
+
+
+def test_seeded_tarot_render_is_reproducible():
+    gen = PILImageGenerator()
+    a = gen.render_tarot_image('The Star', 'Hope.', 256, 384, rng=random.Random('The Star'))
+    b = gen.render_tarot_image('The Star', 'Hope.', 256, 384, rng=random.Random('The Star'))
+    assert a.tobytes() == b.tobytes()
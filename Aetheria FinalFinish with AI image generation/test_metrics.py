@@ -0,0 +1,40 @@
+import pytest
+
+from metrics import Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    hist = registry.histogram('stage_seconds', 'Stage time.', ('stage',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        hist.observe(value, stage='submit')
+    with hist.time(stage='wait'):
+        pass
+    text = registry.render()
+    assert '# TYPE stage_seconds histogram' in text
+    assert 'stage_seconds_bucket{stage="submit",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="submit",le="1.0"} 3' in text
+    assert 'stage_seconds_bucket{stage="submit",le="+Inf"} 4' in text
+    assert 'stage_seconds_sum{stage="submit"} 4.05' in text
+    assert 'stage_seconds_count{stage="wait"} 1' in text
+    assert hist.snapshot(stage='submit') == {'count': 4, 'sum': 4.05}
+
+
+def test_counters_gauges_and_registration():
+    registry = Registry()
+    total = registry.counter('jobs_total', 'Jobs.', ('result',))
+    total.inc(result='success')
+    total.inc(2, result='fail"ed')
+    in_flight = registry.gauge('in_flight', 'Running.')
+    assert 'in_flight 0' in registry.render()
+    with in_flight.track_inprogress():
+        assert in_flight.value() == 1
+    text = registry.render()
+    assert 'jobs_total{result="success"} 1' in text
+    assert 'jobs_total{result="fail\\"ed"} 2' in text
+    assert 'in_flight 0' in text
+    assert registry.counter('jobs_total', 'Jobs.', ('result',)) is total
+    with pytest.raises(ValueError):
+        registry.gauge('jobs_total', 'Jobs.')
+    with pytest.raises(ValueError):
+        total.inc(kind='x')
@@ -0,0 +1,87 @@
+import json
+import threading
+
+import pytest
+
+from workflow import WorkflowError, WorkflowRegistry, WorkflowTemplate
+
+BASE = 'base_workflow.json'
+
+
+def test_slots_are_found_by_class_type():
+    template = WorkflowTemplate.from_file('base', BASE)
+    assert template.slots == {
+        'prompt': [('6', 'text')],
+        'negative': [('7', 'text')],
+        'seed': [('3', 'seed')],
+        'steps': [('3', 'steps')],
+        'width': [('5', 'width')],
+        'height': [('5', 'height')],
+        'batch_size': [('5', 'batch_size')],
+    }
+
+
+def test_slots_follow_links_not_node_ids():
+    with open(BASE, encoding='utf-8') as f:
+        graph = json.load(f)
+    # renumber every node; links have to be followed to find the slots again
+    ids = {old: str(int(old) + 100) for old in graph}
+    renumbered = {}
+    for old, node in graph.items():
+        inputs = {k: [ids[v[0]], v[1]] if isinstance(v, list) else v for k, v in node['inputs'].items()}
+        renumbered[ids[old]] = dict(node, inputs=inputs)
+    template = WorkflowTemplate('renumbered', renumbered)
+    assert template.slots['prompt'] == [('106', 'text')]
+    assert template.slots['width'] == [('105', 'width')]
+
+
+def test_render_copies_only_touched_nodes():
+    template = WorkflowTemplate.from_file('base', BASE)
+    before = json.dumps(template._graph, sort_keys=True)
+    graph = template.render(prompt='the moon', width=768, height=None)
+    assert graph['6']['inputs']['text'] == 'the moon'
+    assert graph['5']['inputs']['width'] == 768
+    assert graph['5']['inputs']['height'] == 512
+    assert json.dumps(template._graph, sort_keys=True) == before
+    assert graph['4'] is template._graph['4']
+    assert graph['6'] is not template._graph['6']
+
+
+def test_unknown_parameters_and_workflows_raise(tmp_path):
+    template = WorkflowTemplate.from_file('base', BASE)
+    with pytest.raises(WorkflowError):
+        template.render(cfg=7)
+    with pytest.raises(WorkflowError):
+        WorkflowTemplate('empty', {'1': {'class_type': 'SaveImage', 'inputs': {}}})
+    with pytest.raises(WorkflowError):
+        WorkflowRegistry(BASE, str(tmp_path)).get('missing')
+
+
+def test_concurrent_renders_are_independent():
+    template = WorkflowTemplate.from_file('base', BASE)
+    results = {}
+
+    def render(i):
+        results[i] = template.render(prompt=f'prompt {i}', seed=i)
+
+    threads = [threading.Thread(target=render, args=(i,)) for i in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, graph in results.items():
+        assert graph['6']['inputs']['text'] == f'prompt {i}'
+        assert graph['3']['inputs']['seed'] == i
+
+
+def test_named_workflows_load_from_directory(tmp_path):
+    with open(BASE, encoding='utf-8') as f:
+        graph = json.load(f)
+    graph['3']['inputs']['steps'] = 30
+    (tmp_path / 'detailed.json').write_text(json.dumps(graph), encoding='utf-8')
+    registry = WorkflowRegistry(BASE, str(tmp_path))
+    assert registry.names() == ['base', 'detailed']
+    detailed = registry.get('detailed')
+    assert detailed is registry.get('detailed')
+    assert detailed.defaults()['steps'] == 30
+    assert detailed.fingerprint != registry.get('base').fingerprint
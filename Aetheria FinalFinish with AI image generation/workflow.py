@@ -0,0 +1,130 @@
+"""Precompiled ComfyUI workflow templates.
+
+A workflow exported in API format is parsed once. Its parameter slots are
+located by ``class_type`` and by following the sampler's links, not by
+hard-coded node ids:
+
+- ``prompt`` / ``negative``: ``text`` of the CLIPTextEncode nodes wired to
+  the sampler's ``positive`` / ``negative`` inputs
+- ``width`` / ``height`` / ``batch_size``: the EmptyLatentImage node
+- ``seed`` / ``steps``: the KSampler (``noise_seed`` on KSamplerAdvanced)
+
+:meth:`WorkflowTemplate.render` returns a per-request graph. Only the nodes
+it changes are copied, and the shared template is never mutated, so
+concurrent requests cannot see each other's prompts.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+
+SAMPLERS = ('KSampler', 'KSamplerAdvanced')
+TEXT_ENCODERS = ('CLIPTextEncode',)
+LATENTS = ('EmptyLatentImage', 'EmptySD3LatentImage')
+
+PARAMS = ('prompt', 'negative', 'width', 'height', 'batch_size', 'seed', 'steps')
+
+
+class WorkflowError(Exception):
+    pass
+
+
+class WorkflowTemplate:
+    def __init__(self, name: str, graph: dict):
+        self.name = name
+        self._graph = graph
+        self.fingerprint = hashlib.sha256(json.dumps(graph, sort_keys=True).encode('utf-8')).hexdigest()
+        self.slots = self._locate_slots(graph)
+
+    @classmethod
+    def from_file(cls, name: str, path: str) -> 'WorkflowTemplate':
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(name, json.load(f))
+
+    def render(self, **params) -> dict:
+        """Graph with ``params`` (see ``PARAMS``; ``None`` keeps the template value) filled in."""
+        unknown = set(params) - set(PARAMS)
+        if unknown:
+            raise WorkflowError(f'unknown workflow parameters: {sorted(unknown)}')
+        graph = dict(self._graph)
+        copied = set()
+        for param, value in params.items():
+            if value is None:
+                continue
+            slots = self.slots.get(param)
+            if not slots:
+                raise WorkflowError(f'workflow {self.name!r} has no {param!r} slot')
+            for node_id, field in slots:
+                if node_id not in copied:
+                    node = graph[node_id]
+                    graph[node_id] = dict(node, inputs=dict(node['inputs']))
+                    copied.add(node_id)
+                graph[node_id]['inputs'][field] = value
+        return graph
+
+    def defaults(self) -> dict:
+        """Current template value of every slot."""
+        return {param: self._graph[slots[0][0]]['inputs'][slots[0][1]] for param, slots in self.slots.items()}
+
+    @staticmethod
+    def _locate_slots(graph: dict) -> dict:
+        def linked(node, field, class_types):
+            link = node['inputs'].get(field)
+            if isinstance(link, list) and link and str(link[0]) in graph \
+                    and graph[str(link[0])].get('class_type') in class_types:
+                return str(link[0])
+            return None
+
+        slots = {}
+        samplers = [(nid, n) for nid, n in graph.items() if n.get('class_type') in SAMPLERS]
+        for nid, node in samplers:
+            for param, field in (('prompt', 'positive'), ('negative', 'negative')):
+                encoder = linked(node, field, TEXT_ENCODERS)
+                if encoder:
+                    slots.setdefault(param, []).append((encoder, 'text'))
+            seed_field = 'noise_seed' if 'noise_seed' in node['inputs'] else 'seed'
+            if seed_field in node['inputs']:
+                slots.setdefault('seed', []).append((nid, seed_field))
+            if 'steps' in node['inputs']:
+                slots.setdefault('steps', []).append((nid, 'steps'))
+            latent = linked(node, 'latent_image', LATENTS)
+            if latent:
+                for param in ('width', 'height', 'batch_size'):
+                    if param in graph[latent]['inputs']:
+                        slots.setdefault(param, []).append((latent, param))
+        if 'prompt' not in slots:
+            raise WorkflowError('workflow has no CLIPTextEncode prompt wired to a sampler')
+        # one entry per (node, field), in discovery order
+        return {param: list(dict.fromkeys(found)) for param, found in slots.items()}
+
+
+class WorkflowRegistry:
+    """Named templates: ``base`` plus every ``*.json`` in ``workflow_dir`` (by file stem)."""
+
+    def __init__(self, base_path: str, workflow_dir: str = None):
+        self.base_path = base_path
+        self.workflow_dir = workflow_dir
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def names(self) -> list:
+        names = ['base']
+        if self.workflow_dir and os.path.isdir(self.workflow_dir):
+            names += sorted(os.path.splitext(os.path.basename(p))[0]
+                            for p in glob.glob(os.path.join(self.workflow_dir, '*.json')))
+        return names
+
+    def get(self, name: str = 'base') -> WorkflowTemplate:
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None:
+                template = self._templates[name] = WorkflowTemplate.from_file(name, self._path(name))
+            return template
+
+    def _path(self, name):
+        if name == 'base':
+            return self.base_path
+        if self.workflow_dir and name in self.names():
+            return os.path.join(self.workflow_dir, f'{name}.json')
+        raise WorkflowError(f'unknown workflow {name!r}; available: {self.names()}')
@@ -1,8 +1,30 @@
+import asyncio
 import os
-import random
-from flask import Flask, render_template, jsonify, request
-import sqlite3
-from datetime import datetime
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template, jsonify, request, send_from_directory
+from werkzeug.http import is_resource_modified
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from asgi_bridge import AsgiApp, StreamingBody
+from async_http import HTTPStatusError, get_async_client
+from backend_pool import BackendPool, urls_from_env
+from chat_replies import IntentMatcher, ReplyCache, load_intents
+from chat_stream import completion_tokens, completion_tokens_async, relay, relay_async, replay
+from db import Database
+import deck
+from gen_cache import GenerationCache, cache_key, is_deterministic
+from http_client import get_client
+import metrics
+from metrics import BACKEND_DOWNLOAD, BACKEND_SUBMIT, DISK_WRITE, GENERATE_TOTAL, GENERATIONS_IN_FLIGHT
+from response_adapters import ImageRef, extract
+from thumbnails import ThumbnailStore
+import tracing
+from tracing import span
+from storage import Reconciler, Unlinker
+from stream_json import SpilledBase64, iter_spilled, jsonable, parse_response
 
 try:
     import openai
@@ -10,177 +32,705 @@ except Exception:
     openai = None
 
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__, template_folder='templates', static_folder='static')
     # Database path for generated image metadata
-    app.config.setdefault('DATABASE', os.path.join(app.root_path, 'generated.db'))
+    app.config.setdefault('DATABASE', os.environ.get('DATABASE', os.path.join(app.root_path, 'generated.db')))
+    # Directory of generated images and their thumbnails (still served under /static/generated/)
+    app.config.setdefault('GENERATED_DIR', os.environ.get('GENERATED_DIR',
+                                                          os.path.join(app.static_folder, 'generated')))
+    # Reuse saved images for repeated deterministic (fixed-seed) generate requests
+    app.config.setdefault('GENERATION_CACHE', os.environ.get('GENERATION_CACHE', 'true').lower() == 'true')
+    app.config.setdefault('GENERATION_CACHE_MAX_ENTRIES', int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', 1000)))
+    app.config.setdefault('GENERATION_CACHE_MAX_AGE', float(os.environ.get('GENERATION_CACHE_MAX_AGE', 7 * 24 * 3600)))
+    # Stream SD responses and decode images chunk by chunk instead of loading the whole JSON body
+    app.config.setdefault('SD_STREAM_RESPONSES', os.environ.get('SD_STREAM_RESPONSES', 'false').lower() == 'true')
+    # Response schema of the SD backends (a1111, comfyui, stability); empty detects it per response
+    app.config.setdefault('SD_RESPONSE_ADAPTER', os.environ.get('SD_RESPONSE_ADAPTER', '') or None)
+    # Build gallery thumbnails in the background right after an image is saved
+    app.config.setdefault('THUMBNAILS_ON_SAVE', os.environ.get('THUMBNAILS_ON_SAVE', 'true').lower() == 'true')
+    # Generated images and thumbnails never change once written (uuid names): browser cache lifetime in seconds
+    app.config.setdefault('GENERATED_MAX_AGE', int(os.environ.get('GENERATED_MAX_AGE', 365 * 24 * 3600)))
+    # At most this many requests in flight per SD backend; batch prompts are sent concurrently up to it
+    app.config.setdefault('SD_MAX_CONCURRENCY', int(os.environ.get('SD_MAX_CONCURRENCY', 4)))
+    # Send repeated (unseeded) batch prompts as one txt2img call with batch_size, up to SD_MAX_BATCH_SIZE images
+    app.config.setdefault('SD_NATIVE_BATCH', os.environ.get('SD_NATIVE_BATCH', 'true').lower() == 'true')
+    app.config.setdefault('SD_MAX_BATCH_SIZE', int(os.environ.get('SD_MAX_BATCH_SIZE', 8)))
+    # SD backends: LOCAL_SD_URLS is a comma-separated list of txt2img urls (one per GPU box)
+    app.config.setdefault('SD_BACKENDS', urls_from_env(
+        os.environ.get('LOCAL_SD_URLS'), os.environ.get('LOCAL_SD_URL', 'http://127.0.0.1:7860/sdapi/v1/txt2img')))
+    # health probe path on each backend (empty disables probes), its interval and the circuit breaker settings
+    app.config.setdefault('SD_HEALTH_PATH', os.environ.get('SD_HEALTH_PATH', '/sdapi/v1/progress'))
+    app.config.setdefault('SD_PROBE_INTERVAL', float(os.environ.get('SD_PROBE_INTERVAL', 10)))
+    app.config.setdefault('SD_FAILURE_THRESHOLD', int(os.environ.get('SD_FAILURE_THRESHOLD', 3)))
+    app.config.setdefault('SD_RESET_TIMEOUT', float(os.environ.get('SD_RESET_TIMEOUT', 30)))
+    # Largest number of spreads one /api/cards/batch call may draw
+    app.config.setdefault('CARDS_BATCH_MAX', int(os.environ.get('CARDS_BATCH_MAX', 10000)))
+    # Deadlines for completion calls (seconds): connecting, first token / gap between tokens, whole reply
+    app.config.setdefault('CHAT_CONNECT_TIMEOUT', float(os.environ.get('CHAT_CONNECT_TIMEOUT', 3)))
+    app.config.setdefault('CHAT_READ_TIMEOUT', float(os.environ.get('CHAT_READ_TIMEOUT', 10)))
+    app.config.setdefault('CHAT_DEADLINE', float(os.environ.get('CHAT_DEADLINE', 30)))
+    # Cache of upstream chat replies (in memory, per process)
+    app.config.setdefault('CHAT_CACHE', os.environ.get('CHAT_CACHE', 'true').lower() == 'true')
+    app.config.setdefault('CHAT_CACHE_MAX_ENTRIES', int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', 1000)))
+    app.config.setdefault('CHAT_CACHE_MAX_AGE', float(os.environ.get('CHAT_CACHE_MAX_AGE', 3600)))
+    # Optional JSON list of extra intents for the local responder (see chat_replies.py)
+    app.config.setdefault('CHAT_INTENTS_FILE', os.environ.get('CHAT_INTENTS_FILE') or None)
+    # Largest number of ids one bulk delete may remove
+    app.config.setdefault('GENERATED_DELETE_MAX', int(os.environ.get('GENERATED_DELETE_MAX', 500)))
+    # Storage reconciler: check one chunk every RECONCILE_INTERVAL seconds (0 disables the background loop),
+    # repairing what it finds when RECONCILE_REPAIR is set; files younger than RECONCILE_MIN_AGE are left alone
+    app.config.setdefault('RECONCILE_INTERVAL', float(os.environ.get('RECONCILE_INTERVAL', 0)))
+    app.config.setdefault('RECONCILE_REPAIR', os.environ.get('RECONCILE_REPAIR', 'false').lower() == 'true')
+    app.config.setdefault('RECONCILE_MIN_AGE', float(os.environ.get('RECONCILE_MIN_AGE', 3600)))
+    if test_config:
+        app.config.update(test_config)
+
+    db = Database(app.config['DATABASE'])
+    app.extensions['db'] = db
+    # request ids, span logs, optional Server-Timing header and request profiling (tracing.py)
+    tracing.init_app(app)
 
     def init_db():
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS generated (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                prompt TEXT,
-                crystal TEXT,
-                created_at TEXT
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        with db.transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS generated (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    prompt TEXT,
+                    crystal TEXT,
+                    created_at TEXT
+                )
+            ''')
+            # indexes backing the paginated / filtered gallery listing
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_crystal_id ON generated (crystal, id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_created_at ON generated (created_at)')
+            # file name lookups of the storage reconciler
+            c.execute('CREATE INDEX IF NOT EXISTS idx_generated_filename ON generated (filename)')
 
     init_db()
+    gen_cache = GenerationCache(db,
+                                max_entries=app.config['GENERATION_CACHE_MAX_ENTRIES'],
+                                max_age_s=app.config['GENERATION_CACHE_MAX_AGE'])
+
+    # make sure the generated images directory exists
+    generated_dir = app.config['GENERATED_DIR']
+    os.makedirs(generated_dir, exist_ok=True)
+    thumbs = ThumbnailStore(db, generated_dir)
+    # version counters behind the gallery API's ETag / Last-Modified
+    db.track_versions('generated', 'generated_thumbs')
+
+    # image files of deleted rows are removed on a background thread
+    unlinker = Unlinker()
+    app.extensions['unlinker'] = unlinker
+
+    def delete_generated_ids(ids):
+        """Delete gallery images in one transaction; returns (deleted ids, future of the file removal)."""
+        rows = db.delete_generated(ids)
+        deleted = [gid for gid, _ in rows]
+        if not deleted:
+            return [], None
+        gen_cache.forget_generated(*deleted)
+        paths = thumbs.delete_many(deleted) + [os.path.join(generated_dir, fname) for _, fname in rows]
+        return deleted, unlinker.submit(paths)
+
+    reconciler = Reconciler(db, generated_dir, delete_generated_ids, unlinker,
+                            min_age_s=app.config['RECONCILE_MIN_AGE'])
+    app.extensions['reconciler'] = reconciler
+    if app.config['RECONCILE_INTERVAL'] > 0:
+        reconciler.start(app.config['RECONCILE_INTERVAL'], repair=app.config['RECONCILE_REPAIR'])
 
-    # Minimal in-memory deck (major arcana subset for demo)
-    DECK = [
-        {"name": "The Fool", "meaning": "New beginnings, spontaneity, a leap of faith.", "image": "/static/images/cards/the_fool.svg"},
-        {"name": "The Magician", "meaning": "Skill, resourcefulness, the power to manifest.", "image": "/static/images/cards/the_magician.svg"},
-        {"name": "The High Priestess", "meaning": "Intuition, inner knowledge, mystery.", "image": "/static/images/cards/the_high_priestess.svg"},
-        {"name": "The Empress", "meaning": "Fertility, creativity, abundance.", "image": "/static/images/cards/the_empress.svg"},
-        {"name": "The Emperor", "meaning": "Structure, authority, leadership.", "image": "/static/images/cards/the_emperor.svg"},
-        {"name": "The Hierophant", "meaning": "Tradition, learning, spiritual guidance."},
-        {"name": "The Lovers", "meaning": "Relationships, choices, harmony."},
-        {"name": "The Chariot", "meaning": "Willpower, success through determination."},
-        {"name": "Strength", "meaning": "Courage, patience, inner strength."},
-        {"name": "The Hermit", "meaning": "Solitude, inner search, wisdom."},
-        {"name": "Wheel of Fortune", "meaning": "Cycles, destiny, turning points."},
-        {"name": "Justice", "meaning": "Fairness, truth, law."},
-        {"name": "The Hanged Man", "meaning": "Surrender, new perspective."},
-        {"name": "Death", "meaning": "Transformation, endings and beginnings."},
-        {"name": "Temperance", "meaning": "Balance, moderation, healing."},
-        {"name": "The Devil", "meaning": "Attachments, shadow, temptation."},
-        {"name": "The Tower", "meaning": "Disruption, sudden change, revelation."},
-        {"name": "The Star", "meaning": "Hope, inspiration, renewal."},
-        {"name": "The Moon", "meaning": "Illusion, subconscious, emotions."},
-        {"name": "The Sun", "meaning": "Joy, success, vitality."},
-        {"name": "Judgement", "meaning": "Awakening, rebirth, evaluation."},
-        {"name": "The World", "meaning": "Completion, wholeness, travel."},
-    ]
+    sd_pool = BackendPool(app.config['SD_BACKENDS'],
+                          health_path=app.config['SD_HEALTH_PATH'] or None,
+                          depth_fn=lambda j: (j.get('state') or {}).get('job_count'),
+                          probe_interval_s=app.config['SD_PROBE_INTERVAL'],
+                          failure_threshold=app.config['SD_FAILURE_THRESHOLD'],
+                          reset_timeout_s=app.config['SD_RESET_TIMEOUT'])
+    app.extensions['sd_pool'] = sd_pool
 
+    # one semaphore per SD backend url, shared by every request
+    backend_slots = {}
+    backend_slots_lock = threading.Lock()
+
+    def backend_slot(url):
+        with backend_slots_lock:
+            if url not in backend_slots:
+                backend_slots[url] = threading.BoundedSemaphore(app.config['SD_MAX_CONCURRENCY'])
+            return backend_slots[url]
 
     @app.route('/')
     def index():
         return render_template('index.html')
 
 
+    def draw_seed(data):
+        """The optional integer "seed" of a draw request; raises ValueError otherwise."""
+        seed = data.get('seed')
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or seed < 0):
+            raise ValueError('seed must be a non-negative integer')
+        return seed
+
     @app.route('/api/cards', methods=['POST'])
     def cards():
+        """Draw a spread. Pass the returned "seed" back to get the same reading again."""
         data = request.json or {}
         reading = data.get('reading', 'single')
         crystal = data.get('crystal')
+        try:
+            seed = draw_seed(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        counts = {'single': 1, 'three': 3, 'five': 5}
-        num = counts.get(reading, 1)
-        picked = random.sample(DECK, k=num)
-
-        # add reversed randomly for flavor
-        for c in picked:
-            c['reversed'] = random.choice([False, False, True])
+        # the deck is immutable: each card in the reading is a per-request view
+        seed, picked = deck.draw(reading if reading in deck.SPREADS else 'single', seed)
 
         response = {
             'crystal': crystal,
             'reading': reading,
-            'cards': picked,
+            'seed': seed,
+            'cards': [deck.as_dict(c) for c in picked],
             'message': f'A {reading} card reading using {crystal or "your chosen crystal"}.'
         }
         return jsonify(response)
 
+    @app.route('/api/cards/batch', methods=['POST'])
+    def cards_batch():
+        """Draw many spreads at once for simulations and analytics.
+
+        Body: {"reading": "three", "count": 1000, "seed": 42}. Returns the card
+        indices ("draws", one row per spread, into "deck") and reversed flags
+        per spread, plus how often each card came up.
+        """
+        data = request.json or {}
+        reading = data.get('reading', 'single')
+        count = data.get('count', 1)
+        if reading not in deck.SPREADS:
+            return jsonify({'error': 'unknown reading', 'readings': list(deck.SPREADS)}), 400
+        if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= app.config['CARDS_BATCH_MAX']:
+            return jsonify({'error': f"count must be an integer from 1 to {app.config['CARDS_BATCH_MAX']}"}), 400
+        try:
+            seed = draw_seed(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        with span('cards.draw_batch', count=count):
+            seed, indices, reversed_ = deck.draw_batch(reading, count, seed)
+        return jsonify({
+            'reading': reading,
+            'count': count,
+            'seed': seed,
+            'positions': list(deck.SPREADS[reading]),
+            'deck': [c.name for c in deck.CARDS],
+            'draws': deck.to_lists(indices),
+            'reversed': deck.to_lists(reversed_),
+            'frequencies': deck.frequencies(indices),
+        })
+
 
     @app.route('/generated')
     def gallery():
         return render_template('generated.html')
 
 
+    def generated_filters(args):
+        """Build the WHERE clause shared by the gallery listing and count.
+
+        Supported query args: crystal, since, until (ISO timestamps, compared
+        against created_at). Raises ValueError on malformed input.
+        """
+        clauses, params = [], []
+        crystal = args.get('crystal')
+        if crystal:
+            clauses.append('crystal = ?')
+            params.append(crystal)
+        for arg, op in (('since', '>='), ('until', '<')):
+            value = args.get(arg)
+            if value:
+                datetime.fromisoformat(value)
+                clauses.append(f'created_at {op} ?')
+                params.append(value)
+        return clauses, params
+
+
+    def gallery_validators():
+        """ETag and Last-Modified of the gallery API, from the table version counters."""
+        versions = db.versions('generated', 'generated_thumbs')
+        etag = 'gallery-%d-%d' % (versions['generated'][0], versions['generated_thumbs'][0])
+        last_modified = datetime.fromtimestamp(int(max(v[1] for v in versions.values())), timezone.utc)
+        return etag, last_modified
+
+
+    def revalidate(response, etag, last_modified):
+        """Let clients keep the response but check it with a conditional GET (304 when unchanged)."""
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+
+    @app.route('/static/generated/<path:filename>')
+    def generated_file(filename):
+        """Serve generated images and thumbnails from GENERATED_DIR (their URLs are unchanged)."""
+        return send_from_directory(generated_dir, filename)
+
+    @app.after_request
+    def cache_generated_assets(response):
+        # generated images and thumbnails carry a uuid in their name and ids are never reused
+        if response.status_code in (200, 304) and (request.path.startswith('/static/generated/')
+                                                    or request.endpoint == 'generated_thumb'):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['GENERATED_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+
+
     @app.route('/api/generated', methods=['GET'])
     def list_generated():
-        # return list of generated images from DB
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT id, filename, prompt, crystal, created_at FROM generated ORDER BY id DESC')
-        rows = c.fetchall()
-        conn.close()
+        """Keyset-paginated list of generated images, newest first.
+
+        ?limit=N (default 50, max 200) and ?cursor=<next_cursor from the previous page>,
+        plus the crystal/since/until filters. Answers 304 to a conditional GET while the
+        gallery tables are unchanged.
+        """
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+            cursor = request.args.get('cursor', type=int)
+            clauses, params = generated_filters(request.args)
+        except ValueError as e:
+            return jsonify({'error': f'invalid query: {e}'}), 400
+        etag, last_modified = gallery_validators()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return revalidate(app.response_class(status=304), etag, last_modified)
+        if cursor is not None:
+            clauses.append('id < ?')
+            params.append(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        # fetch one extra row to know whether another page exists
+        rows = db.query(f'SELECT id, filename, prompt, crystal, created_at FROM generated {where} ORDER BY id DESC LIMIT ?',
+                        params + [limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        thumb_urls = thumbs.urls_for(r[0] for r in rows)
         items = []
         for r in rows:
-            items.append({'id': r[0], 'image': '/static/generated/' + r[1], 'prompt': r[2], 'crystal': r[3], 'created_at': r[4]})
-        return jsonify({'items': items})
+            items.append({'id': r[0], 'image': '/static/generated/' + r[1], 'prompt': r[2], 'crystal': r[3], 'created_at': r[4],
+                          'thumbnails': thumb_urls[r[0]]})
+        return revalidate(jsonify({'items': items, 'next_cursor': rows[-1][0] if has_more else None}),
+                          etag, last_modified)
 
 
-    @app.route('/api/generated/<int:gid>', methods=['DELETE'])
-    def delete_generated(gid):
-        db_path = app.config['DATABASE']
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-        c.execute('SELECT filename FROM generated WHERE id=?', (gid,))
-        row = c.fetchone()
+    @app.route('/api/generated/count', methods=['GET'])
+    def count_generated():
+        try:
+            clauses, params = generated_filters(request.args)
+        except ValueError as e:
+            return jsonify({'error': f'invalid query: {e}'}), 400
+        etag, last_modified = gallery_validators()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return revalidate(app.response_class(status=304), etag, last_modified)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        count = db.query_one(f'SELECT COUNT(*) FROM generated {where}', params)[0]
+        return revalidate(jsonify({'count': count}), etag, last_modified)
+
+
+    @app.route('/api/generated/<int:gid>/thumb/<int:width>', methods=['GET'])
+    def generated_thumb(gid, width):
+        """Serve a gallery thumbnail, creating it on first request."""
+        if width not in thumbs.sizes:
+            return jsonify({'error': 'unsupported size', 'sizes': list(thumbs.sizes)}), 404
+        row = db.query_one('SELECT filename FROM generated WHERE id=?', (gid,))
         if not row:
-            conn.close()
             return jsonify({'error': 'not found'}), 404
-        filename = row[0]
-        c.execute('DELETE FROM generated WHERE id=?', (gid,))
-        conn.commit()
-        conn.close()
-        # remove file
-        path = os.path.join(app.static_folder, 'generated', filename)
         try:
-            if os.path.exists(path):
-                os.remove(path)
-        except Exception:
-            pass
+            fname = thumbs.ensure(gid, row[0]).get(width)
+        except OSError:
+            fname = None
+        if not fname:
+            return jsonify({'error': 'image file missing'}), 404
+        return send_from_directory(thumbs.thumbs_dir, fname)
+
+
+    @app.route('/api/generated/<int:gid>', methods=['DELETE'])
+    def delete_generated(gid):
+        deleted, removal = delete_generated_ids([gid])
+        if not deleted:
+            return jsonify({'error': 'not found'}), 404
+        # a single delete answers once its files are gone
+        removal.result()
         return jsonify({'deleted': gid})
 
+    @app.route('/api/generated/delete', methods=['POST'])
+    def delete_generated_bulk():
+        """Delete many gallery images at once.
+
+        Body: {"ids": [1, 2, 3]}. The rows go in one transaction and the files
+        are removed in the background. Returns the ids that were deleted and
+        those that did not exist.
+        """
+        ids = (request.json or {}).get('ids')
+        if (not isinstance(ids, list) or len(ids) > app.config['GENERATED_DELETE_MAX']
+                or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+            return jsonify({'error': f"ids must be a list of at most {app.config['GENERATED_DELETE_MAX']} integers"}), 400
+        with span('generated.delete_bulk', count=len(ids)):
+            deleted, _ = delete_generated_ids(set(ids))
+        return jsonify({'deleted': sorted(deleted), 'missing': sorted(set(ids) - set(deleted))})
+
+    @app.route('/api/generated/reconcile', methods=['POST'])
+    def reconcile_generated():
+        """Report image files without a row and rows without a file; {"repair": true} also removes them."""
+        repair = (request.get_json(silent=True) or {}).get('repair') is True
+        with span('generated.reconcile', repair=repair):
+            return jsonify(reconciler.run(repair=repair))
+
+
+    @app.route('/api/db/stats', methods=['GET'])
+    def db_stats():
+        """Per-statement SQLite timings (count / total / avg / max in ms)."""
+        return jsonify({'statements': db.stats()})
+
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Prometheus text format: generate stage histograms, SQLite timings, generation counters."""
+        return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+    @app.route('/api/backends', methods=['GET'])
+    def backends():
+        """Per-node state of the SD backend pool (health, breaker, in flight, latency)."""
+        return jsonify({'sd': sd_pool.stats()})
+
+
+    # Local rule-based replies when there is no API key (or the API call fails): the intent
+    # table is compiled once into a single matcher (chat_replies.py)
+    intents = IntentMatcher(load_intents(app.config['CHAT_INTENTS_FILE']))
+    # Upstream replies to repeated questions, keyed on the normalised (message, crystal)
+    chat_cache = ReplyCache(max_entries=app.config['CHAT_CACHE_MAX_ENTRIES'] if app.config['CHAT_CACHE'] else 0,
+                            max_age_s=app.config['CHAT_CACHE_MAX_AGE'])
+    app.extensions['chat_cache'] = chat_cache
+
+    def chat_prompt(msg):
+        # small prompt that keeps things light and mystical
+        return (
+            "You are a friendly fortune-teller bot. Respond helpfully and briefly. "
+            f"User message: {msg}"
+        )
+
+    def fallback_reply(msg):
+        return intents.reply(msg)
+
+
+    def completions_url():
+        return os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/') + '/completions'
+
+    def completion_payload(msg):
+        return {
+            'model': os.environ.get('OPENAI_ENGINE', 'text-davinci-003'),
+            'prompt': chat_prompt(msg),
+            'max_tokens': 150,
+            'temperature': 0.9,
+        }
+
+    def event_stream(events):
+        # no-cache / X-Accel-Buffering keep proxies from holding tokens back
+        return Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     @app.route('/api/chat', methods=['POST'])
     def chat():
+        """Reply to a chat message. With "stream": true the reply is sent as Server-Sent Events (see chat_stream.py)."""
         data = request.json or {}
         msg = data.get('message', '')
         crystal = data.get('crystal')
+        openai_key = os.environ.get('OPENAI_API_KEY')
+
+        if data.get('stream'):
+            tokens = None
+            if openai_key:
+                cached = chat_cache.get(msg, crystal)
+                if cached is not None:
+                    return event_stream(replay(cached))
+                tokens = completion_tokens(get_client(), completions_url(), openai_key, completion_payload(msg),
+                                           connect_timeout=app.config['CHAT_CONNECT_TIMEOUT'],
+                                           read_timeout=app.config['CHAT_READ_TIMEOUT'],
+                                           deadline=app.config['CHAT_DEADLINE'])
+            return event_stream(relay(tokens, lambda: fallback_reply(msg),
+                                      on_reply=lambda reply: chat_cache.put(msg, crystal, reply)))
 
         # If OpenAI key is available and openai package is installed, use it.
-        openai_key = os.environ.get('OPENAI_API_KEY')
         if openai and openai_key:
+            cached = chat_cache.get(msg, crystal)
+            if cached is not None:
+                return jsonify({'reply': cached})
             try:
                 openai.api_key = openai_key
-                # small prompt that keeps things light and mystical
-                prompt = (
-                    "You are a friendly fortune-teller bot. Respond helpfully and briefly. "
-                    f"User message: {msg}"
-                )
                 completion = openai.Completion.create(
                     engine=os.environ.get('OPENAI_ENGINE', 'text-davinci-003'),
-                    prompt=prompt,
+                    prompt=chat_prompt(msg),
                     max_tokens=150,
                     temperature=0.9,
+                    request_timeout=(app.config['CHAT_CONNECT_TIMEOUT'], app.config['CHAT_DEADLINE']),
                 )
                 text = completion.choices[0].text.strip()
+                chat_cache.put(msg, crystal, text)
                 return jsonify({'reply': text})
             except Exception as e:
                 # fall through to local responder
                 print('OpenAI call failed:', e)
 
-        # Local simple rule-based reply when no API key
-        fallback_replies = [
-            "I sense a change approaching — be open and stay curious.",
-            "Follow your intuition today; a small choice will lead somewhere meaningful.",
-            "The crystal's glow points to new connections shortly.",
-            "Take a breath. A clear head will reveal the right next step.",
-            "Trust the small signals — they add up to big answers.",
-        ]
-
-        # sprinkle in parts of the user's message for perceived relevance
-        if msg:
-            if 'love' in msg.lower():
-                reply = "Love is in flux — honest communication will guide you."
-            elif 'work' in msg.lower() or 'career' in msg.lower():
-                reply = "At work, steady focus wins. Consider which task needs your clarity." 
+        return jsonify({'reply': fallback_reply(msg)})
+
+
+    # /api/generate building blocks, shared by the Flask view and the async handler below
+
+    def save_base64_image(b64data, prompt, crystal, prefix='gen', backend=None):
+        """Save a base64 string, raw image bytes, a SpilledBase64 already decoded to disk by the
+        streaming parser, an image already downloaded to a temp file, or an ImageRef fetched from
+        ``backend`` (the txt2img url that returned it)."""
+        import base64, uuid
+        fname = f"{prefix}-{uuid.uuid4().hex[:12]}.png"
+        out_path = os.path.join(generated_dir, fname)
+        with span('save_base64_image', kind=type(b64data).__name__):
+            if isinstance(b64data, SpilledBase64):
+                if not b64data.valid:
+                    return None
+                with DISK_WRITE.time():
+                    b64data.move_to(out_path)
+            elif isinstance(b64data, ImageRef):
+                if not backend or not download_image(b64data, backend, out_path):
+                    return None
+            elif hasattr(b64data, 'read'):
+                with span('disk_write'), DISK_WRITE.time(), b64data, open(out_path, 'wb') as f:
+                    shutil.copyfileobj(b64data, f, 64 * 1024)
+            elif isinstance(b64data, bytes):
+                with span('disk_write'), DISK_WRITE.time(), open(out_path, 'wb') as f:
+                    f.write(b64data)
+            else:
+                header = ''
+                if b64data.startswith('data:'):
+                    header, b64data = b64data.split(',', 1)
+                try:
+                    data = base64.b64decode(b64data)
+                except Exception:
+                    return None
+                with span('disk_write'), DISK_WRITE.time(), open(out_path, 'wb') as f:
+                    f.write(data)
+            # insert metadata into DB
+            try:
+                with span('db.insert'):
+                    gid = db.insert_generated(fname, prompt, crystal, datetime.utcnow().isoformat())
+                if app.config['THUMBNAILS_ON_SAVE']:
+                    thumbs.schedule(gid, fname)
+            except Exception:
+                pass
+        return f'/static/generated/{fname}'
+
+    def download_image(ref, backend, out_path):
+        """Stream an image the backend only referenced (ComfyUI schema) into ``out_path``, chunk by chunk.
+
+        The download is a call on that backend: it holds one of its slots and is
+        counted by the pool. Returns False when the backend has no such image.
+        """
+        origin = '{0.scheme}://{0.netloc}'.format(urlsplit(backend))
+        with span('sd.fetch_image'), BACKEND_DOWNLOAD.time(backend='sd'), \
+                sd_pool.attempt(url=backend) as lease, backend_slot(backend), \
+                get_client().get(ref.view_url(origin), stream=True, timeout=30) as r:
+            if r.status_code != 200:
+                if r.status_code >= 500:
+                    lease.failed(f'status {r.status_code}')
+                return False
+            try:
+                with span('disk_write'), DISK_WRITE.time(), open(out_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            except BaseException:
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+                raise
+        return True
+
+    def save_debug_response(obj, prefix='sd_debug'):
+        """Save SD response (JSON or text) to static/sd_debug and return the public path."""
+        import json, uuid
+        try:
+            debug_dir = os.path.join(app.static_folder, 'sd_debug')
+            os.makedirs(debug_dir, exist_ok=True)
+            fname = f"{prefix}-{uuid.uuid4().hex[:10]}.json"
+            out_path = os.path.join(debug_dir, fname)
+            # try to dump JSON nicely, fall back to str()
+            try:
+                with open(out_path, 'w', encoding='utf-8') as f:
+                    json.dump(obj, f, indent=2, ensure_ascii=False)
+            except Exception:
+                with open(out_path, 'w', encoding='utf-8') as f:
+                    f.write(str(obj))
+            return f'/static/sd_debug/{fname}'
+        except Exception:
+            return None
+
+    def sd_headers():
+        # support an optional local SD API key (set LOCAL_SD_KEY) and header name (LOCAL_SD_KEY_HEADER)
+        headers = {'Content-Type': 'application/json'}
+        local_key = os.environ.get('LOCAL_SD_KEY')
+        key_header = os.environ.get('LOCAL_SD_KEY_HEADER', 'Authorization')
+        if local_key:
+            # if header is Authorization and key doesn't already start with Bearer, add prefix
+            if key_header.lower() == 'authorization' and not local_key.lower().startswith('bearer '):
+                headers[key_header] = f'Bearer {local_key}'
+            else:
+                headers[key_header] = local_key
+        return headers
+
+    def sd_options(data):
+        """txt2img settings of a generate request, shared by all of its prompts."""
+        # Build a richer payload for common SD REST endpoints (txt2img style).
+        # Accept optional parameters from the incoming request to override defaults.
+        return {
+            'width': int(data.get('width', 512)),
+            'height': int(data.get('height', 768)),
+            'steps': int(data.get('steps', 20)),
+            'sampler': data.get('sampler', None),
+            'cfg_scale': float(data.get('cfg_scale', 7.0)),
+            'samples': int(data.get('samples', 1)),
+            'seed': data.get('seed', None),
+            'negative': data.get('negative_prompt', None),
+        }
+
+    def build_payload(opts, p):
+        payload = {
+            'prompt': p,
+            'width': opts['width'],
+            'height': opts['height'],
+            'steps': opts['steps'],
+            'cfg_scale': opts['cfg_scale'],
+            'samples': opts['samples'],
+        }
+        if opts['sampler']:
+            payload['sampler_name'] = opts['sampler']
+        if opts['seed'] is not None:
+            try:
+                payload['seed'] = int(opts['seed'])
+            except Exception:
+                payload['seed'] = opts['seed']
+        if opts['negative']:
+            payload['negative_prompt'] = opts['negative']
+        return payload
+
+    def cache_lookup(data, payload, take):
+        """``(key, hit)``: key is None unless the payload is deterministic and caching is on."""
+        if not (app.config['GENERATION_CACHE'] and data.get('cache', True) and is_deterministic(payload)):
+            return None, None
+        key = cache_key({'url': app.config['SD_BACKENDS'], 'payload': payload, 'take': take})
+        with span('cache.lookup') as attrs:
+            hit = gen_cache.get(key)
+            attrs['hit'] = bool(hit)
+        return key, hit
+
+    def extract_images(j, take):
+        # images and metadata are read by schema (A1111, ComfyUI, Stability),
+        # with the generic scanner as a fallback (response_adapters.py)
+        with span('extract') as attrs:
+            images, meta, attrs['adapter'] = extract(j, app.config['SD_RESPONSE_ADAPTER'])
+        # A1111 reports where the individual images start (1 when a batch grid comes first)
+        first = meta.pop('index_of_first_image', 0)
+        if take:
+            # extensions (e.g. ControlNet) append extra images after the generated ones
+            first = first if take > 1 and isinstance(first, int) and first > 0 else 0
+            images = images[first:first + take]
+        return images, meta
+
+    def save_images(images, prompt, crystal, take, backend):
+        urls = []
+        for idx, img in enumerate(images):
+            url = save_base64_image(img, prompt, crystal, prefix='sd' if take == 1 else f'sd{idx}', backend=backend)
+            if url:
+                urls.append(url)
+        return urls
+
+    def plan_batch(prompts, opts):
+        """(prompt, [indices into prompts]) jobs; repeated unseeded prompts share one native batch."""
+        jobs, repeated = [], {}
+        for i, p in enumerate(prompts):
+            if app.config['SD_NATIVE_BATCH'] and not is_deterministic(build_payload(opts, p)):
+                repeated.setdefault(p, []).append(i)
             else:
-                reply = random.choice(fallback_replies)
-        else:
-            reply = random.choice(fallback_replies)
+                jobs.append((p, [i]))
+        size = max(app.config['SD_MAX_BATCH_SIZE'], 1)
+        for p, indices in repeated.items():
+            jobs.extend((p, indices[n:n + size]) for n in range(0, len(indices), size))
+        return jobs
+
+    def job_payload(opts, job):
+        p, indices = job
+        payload = build_payload(opts, p)
+        if len(indices) > 1:
+            payload['batch_size'] = len(indices)
+        return payload
+
+    def batch_results(prompts, jobs, outcomes, debug):
+        """One entry per prompt, in order, from the ``(result, error)`` outcome of each job."""
+        results = [None] * len(prompts)
+        for (p, indices), (res, err) in zip(jobs, outcomes):
+            dbg = None
+            if debug and err is None and res['status'] == 200 and len(res['images']) < len(indices):
+                dbg = save_debug_response(res['body'])
+            for n, i in enumerate(indices):
+                if err is not None:
+                    results[i] = {'error': str(err)}
+                elif res['status'] != 200:
+                    results[i] = {'error': f"sd_status_{res['status']}", 'body': res['body']}
+                elif n >= len(res['images']):
+                    results[i] = {'error': 'no_images', 'sd_body': res['body'], 'sd_debug_file': dbg}
+                else:
+                    # one image per prompt
+                    entry = {'prompt': p, 'image': res['images'][n], 'meta': res['meta']}
+                    if res['cached']:
+                        entry['cached'] = True
+                    results[i] = entry
+        return results
 
-        return jsonify({'reply': reply})
+    def single_response(res, prompt, debug):
+        """Response body for a single-prompt txt2img result; None falls back to the placeholder."""
+        if res['status'] != 200:
+            return None
+        if res['images']:
+            result_images = [{'url': url, 'index': idx} for idx, url in enumerate(res['images'])]
+            out = {'images': result_images, 'prompt': prompt, 'meta': res['meta']}
+            if res['cached']:
+                out['cached'] = True
+            if debug and res['body'] is not None:
+                out['sd_response'] = res['body']
+            return out
+        # No images found in response
+        if debug:
+            # save debug file to static for offline inspection
+            dbg_path = save_debug_response(res['body'])
+            out = {'sd_status': res['status'], 'sd_body': res['body']}
+            if dbg_path:
+                out['sd_debug_file'] = dbg_path
+            return out
+        return None
+
+    def error_response(e):
+        dbg_path = save_debug_response({'error': str(e), 'text': str(e)})
+        out = {'error': str(e)}
+        if dbg_path:
+            out['sd_debug_file'] = dbg_path
+        return out
+
+    def fallback_response(data, prompt, crystal):
+        # Also accept direct base64 image in the request body under 'image'
+        incoming_image = data.get('image')
+        if incoming_image:
+            url = save_base64_image(incoming_image, prompt, crystal, prefix='upload')
+            if url:
+                return {'image': url, 'prompt': prompt}
+
+        # Fallback: return a bundled placeholder
+        return {'image': '/static/images/cards/the_fool.svg', 'prompt': prompt}
 
 
     @app.route('/api/generate', methods=['POST'])
@@ -195,322 +745,281 @@ def create_app():
 
         use_sd = os.environ.get('USE_SD', 'false').lower() == 'true'
 
-        def save_base64_image(b64data, prefix='gen'):
-            import base64, uuid
-            header = ''
-            if b64data.startswith('data:'):
-                header, b64data = b64data.split(',', 1)
-            try:
-                data = base64.b64decode(b64data)
-            except Exception:
-                return None
-            fname = f"{prefix}-{uuid.uuid4().hex[:12]}.png"
-            out_path = os.path.join(app.static_folder, 'generated', fname)
-            with open(out_path, 'wb') as f:
-                f.write(data)
-            # insert metadata into DB
+        # If use_sd, attempt to call local SD API and save returned base64 images
+        if use_sd:
             try:
-                conn = sqlite3.connect(app.config['DATABASE'])
-                c = conn.cursor()
-                c.execute('INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)',
-                          (fname, prompt, crystal, datetime.utcnow().isoformat()))
-                conn.commit()
-                conn.close()
-            except Exception:
-                pass
-            return f'/static/generated/{fname}'
+                headers = sd_headers()
+                opts = sd_options(data)
 
-        def save_debug_response(obj, prefix='sd_debug'):
-            """Save SD response (JSON or text) to static/sd_debug and return the public path."""
-            import json, uuid
-            try:
-                debug_dir = os.path.join(app.static_folder, 'sd_debug')
-                os.makedirs(debug_dir, exist_ok=True)
-                fname = f"{prefix}-{uuid.uuid4().hex[:10]}.json"
-                out_path = os.path.join(debug_dir, fname)
-                # try to dump JSON nicely, fall back to str()
+                def txt2img(payload, timeout, take=None):
+                    """Call SD and save the returned images (only the first ``take``, after any batch grid, when given).
+
+                    Deterministic payloads (fixed seed) are served from the generation cache,
+                    and identical concurrent calls share a single backend request.
+                    Returns {'status', 'body', 'images': [url, ...], 'meta', 'cached'}.
+                    """
+                    key, hit = cache_lookup(data, payload, take)
+                    if hit:
+                        return {'status': 200, 'body': None, 'images': hit['images'], 'meta': hit['meta'], 'cached': True}
+
+                    def call_backend():
+                        stream = app.config['SD_STREAM_RESPONSES']
+
+                        def post(lease):
+                            with backend_slot(lease.url):
+                                r = get_client().post(lease.url, json=payload, timeout=timeout, headers=headers,
+                                                      stream=stream)
+                            if r.status_code >= 500:
+                                lease.failed(f'status {r.status_code}')
+                            return lease.url, r
+
+                        # least-loaded healthy backend; a connection error is retried once on another one
+                        with span('sd.submit') as attrs, BACKEND_SUBMIT.time(backend='sd'):
+                            backend, r = sd_pool.call(post)
+                            attrs['status'] = r.status_code
+                        if r.status_code != 200:
+                            return {'status': r.status_code, 'body': r.text, 'images': [], 'meta': {}, 'cached': False}
+                        with span('sd.download', stream=stream), BACKEND_DOWNLOAD.time(backend='sd'):
+                            if stream:
+                                # images are base64-decoded straight into static/generated while the body downloads
+                                with r:
+                                    try:
+                                        j = parse_response(r, spill_dir=generated_dir)
+                                    except ValueError:
+                                        j = {'raw_text': '<unparseable streamed response>'}
+                            else:
+                                try:
+                                    j = r.json()
+                                except Exception:
+                                    j = {'raw_text': r.text}
+                        try:
+                            images, meta = extract_images(j, take)
+                            urls = save_images(images, prompt, crystal, take, backend)
+                        finally:
+                            if stream:
+                                # drop spilled images that were not saved
+                                for spilled in iter_spilled(j):
+                                    spilled.discard()
+                        if stream:
+                            j = jsonable(j)
+                        if key and urls:
+                            gen_cache.put(key, urls, meta)
+                        return {'status': 200, 'body': j, 'images': urls, 'meta': meta, 'cached': False}
+
+                    def generate_counted():
+                        with GENERATIONS_IN_FLIGHT.track_inprogress():
+                            try:
+                                result = call_backend()
+                            except Exception:
+                                GENERATE_TOTAL.inc(result='failure')
+                                raise
+                        GENERATE_TOTAL.inc(result='success' if result['images'] else 'failure')
+                        return result
+
+                    with span('txt2img', take=take) as attrs:
+                        if key is None:
+                            return generate_counted()
+                        result, shared = gen_cache.flight.do(key, generate_counted)
+                        attrs['shared'] = shared
+                        return dict(result, cached=shared) if shared else result
+
+                debug = data.get('debug', False)
+
+                # If a batch of prompts is provided, send them concurrently (bounded per backend)
+                # and return one entry per prompt, in order
+                if prompts and isinstance(prompts, list):
+                    jobs = plan_batch(prompts, opts)
+
+                    def run_job(job):
+                        try:
+                            return txt2img(job_payload(opts, job), timeout=60, take=len(job[1])), None
+                        except Exception as e:
+                            return None, e
+
+                    workers = min(len(jobs), max(app.config['SD_MAX_CONCURRENCY'], 1))
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sd-batch') as pool:
+                        outcomes = list(pool.map(tracing.bind(run_job), jobs))
+                    return jsonify({'results': batch_results(prompts, jobs, outcomes, debug),
+                                    'prompt_batch': len(prompts)})
+
+                out = single_response(txt2img(build_payload(opts, prompt), timeout=30), prompt, debug)
+                if out is not None:
+                    return jsonify(out)
+            except Exception as e:
+                print('SD call failed or not available:', e)
+                if data.get('debug'):
+                    return jsonify(error_response(e))
+
+        return jsonify(fallback_response(data, prompt, crystal))
+
+
+    # Async serving mode (create_asgi_app): /api/generate and /api/chat run as coroutines that
+    # await their backends with the asyncio client; every other route is served by Flask.
+    # Disk, SQLite and image decoding stay synchronous and run on worker threads.
+    asgi = AsgiApp(app)
+    app.extensions['asgi'] = asgi
+    async_backend_slots = {}
+
+    def async_backend_slot(url):
+        if url not in async_backend_slots:
+            async_backend_slots[url] = asyncio.Semaphore(app.config['SD_MAX_CONCURRENCY'])
+        return async_backend_slots[url]
+
+    async def fetch_image(ref, backend):
+        """Download an image the backend only referenced (ComfyUI schema) to a temp file without blocking
+        a thread; like :func:`download_image`, a call on that backend. None if it has no such image."""
+        origin = '{0.scheme}://{0.netloc}'.format(urlsplit(backend))
+        with span('sd.fetch_image'), BACKEND_DOWNLOAD.time(backend='sd'):
+            async with sd_pool.attempt_async(url=backend) as lease, async_backend_slot(backend):
                 try:
-                    with open(out_path, 'w', encoding='utf-8') as f:
-                        json.dump(obj, f, indent=2, ensure_ascii=False)
-                except Exception:
-                    with open(out_path, 'w', encoding='utf-8') as f:
-                        f.write(str(obj))
-                return f'/static/sd_debug/{fname}'
-            except Exception:
-                return None
+                    return await get_async_client().download_to_tempfile(ref.view_url(origin), timeout=30)
+                except HTTPStatusError as e:
+                    if e.status_code >= 500:
+                        lease.failed(f'status {e.status_code}')
+                    return None
+
+    @asgi.route('/api/chat')
+    async def chat_async(req):
+        """Async /api/chat: the completion is requested over the OpenAI REST API with the async client."""
+        data = req.json or {}
+        msg = data.get('message', '')
+        crystal = data.get('crystal')
+        openai_key = os.environ.get('OPENAI_API_KEY')
+        cached = chat_cache.get(msg, crystal) if openai_key else None
+
+        if data.get('stream'):
+            tokens = None
+            if cached is not None:
+                return StreamingBody(replay(cached)), 200
+            if openai_key:
+                tokens = completion_tokens_async(get_async_client(), completions_url(), openai_key,
+                                                 completion_payload(msg),
+                                                 read_timeout=app.config['CHAT_READ_TIMEOUT'],
+                                                 deadline=app.config['CHAT_DEADLINE'])
+            return StreamingBody(relay_async(tokens, lambda: fallback_reply(msg),
+                                             on_reply=lambda reply: chat_cache.put(msg, crystal, reply))), 200
+
+        if cached is not None:
+            return {'reply': cached}, 200
+        if openai_key:
+            try:
+                r = await get_async_client().post(completions_url(), json=completion_payload(msg),
+                                                  headers={'Authorization': f'Bearer {openai_key}'},
+                                                  timeout=app.config['CHAT_DEADLINE'])
+                r.raise_for_status()
+                text = r.json()['choices'][0]['text'].strip()
+                chat_cache.put(msg, crystal, text)
+                return {'reply': text}, 200
+            except Exception as e:
+                # fall through to local responder
+                print('OpenAI call failed:', e)
+
+        return {'reply': fallback_reply(msg)}, 200
+
+    @asgi.route('/api/generate')
+    async def generate_async(req):
+        """Async /api/generate: same request and response JSON as the Flask view.
+
+        SD_STREAM_RESPONSES does not apply here; the response body is read by the async client.
+        """
+        data = req.json or {}
+        prompt = data.get('prompt', '')
+        prompts = data.get('prompts')
+        crystal = data.get('crystal')
+
+        use_sd = os.environ.get('USE_SD', 'false').lower() == 'true'
 
-        # If use_sd, attempt to call local SD API and save returned base64 images
         if use_sd:
-            sd_url = os.environ.get('LOCAL_SD_URL', 'http://127.0.0.1:7860/sdapi/v1/txt2img')
             try:
-                import requests
-                # helper: recursively search JSON-like structure for base64 image strings
-                def extract_base64_images(node):
-                    found = []
-                    if node is None:
-                        return found
-                    if isinstance(node, str):
-                        s = node.strip()
-                        if s.startswith('data:image') and 'base64,' in s:
-                            found.append(s)
-                            return found
-                        if len(s) > 800 and all(c.isalnum() or c in '+/=' for c in s[:200]):
-                            found.append(s)
-                            return found
-                        return found
-                    if isinstance(node, dict):
-                        for k in ('images', 'image', 'result', 'outputs', 'artifacts', 'images_base64'):
-                            if k in node:
-                                return extract_base64_images(node[k])
-                        for v in node.values():
-                            found.extend(extract_base64_images(v))
-                        return found
-                    if isinstance(node, list):
-                        for item in node:
-                            found.extend(extract_base64_images(item))
-                        return found
-                    return found
-
-                # helper to extract metadata (seed/steps/sampler) from response
-                def extract_metadata(node):
-                    md = {}
-                    if not node:
-                        return md
-                    if isinstance(node, dict):
-                        for k in ('seed', 'steps', 'sampler', 'sampler_name', 'seed_value', 'cfg_scale'):
-                            if k in node:
-                                md[k] = node[k]
-                        for v in node.values():
-                            if isinstance(v, (dict, list)):
-                                nested = extract_metadata(v)
-                                for kk, vv in nested.items():
-                                    if kk not in md:
-                                        md[kk] = vv
-                    elif isinstance(node, list):
-                        for item in node:
-                            nested = extract_metadata(item)
-                            for kk, vv in nested.items():
-                                if kk not in md:
-                                    md[kk] = vv
-                    return md
-
-                # If a batch of prompts is provided, handle them sequentially and return array of urls
-                if prompts and isinstance(prompts, list):
-                    results = []
-                    # prepare headers once
-                    headers = {'Content-Type': 'application/json'}
-                    local_key = os.environ.get('LOCAL_SD_KEY')
-                    key_header = os.environ.get('LOCAL_SD_KEY_HEADER', 'Authorization')
-                    if local_key:
-                        if key_header.lower() == 'authorization' and not local_key.lower().startswith('bearer '):
-                            headers[key_header] = f'Bearer {local_key}'
-                        else:
-                            headers[key_header] = local_key
-
-                    # common payload parameters
-                    width = int(data.get('width', 512))
-                    height = int(data.get('height', 768))
-                    steps = int(data.get('steps', 20))
-                    sampler = data.get('sampler', None)
-                    cfg_scale = float(data.get('cfg_scale', 7.0))
-                    samples = int(data.get('samples', 1))
-                    seed = data.get('seed', None)
-                    negative = data.get('negative_prompt', None)
-
-                    for p in prompts:
-                        payload = {
-                            'prompt': p,
-                            'width': width,
-                            'height': height,
-                            'steps': steps,
-                            'cfg_scale': cfg_scale,
-                            'samples': samples,
-                        }
-                        if sampler:
-                            payload['sampler_name'] = sampler
-                        if seed is not None:
+                headers = sd_headers()
+                opts = sd_options(data)
+
+                async def txt2img(payload, timeout, take=None):
+                    key, hit = await asyncio.to_thread(cache_lookup, data, payload, take)
+                    if hit:
+                        return {'status': 200, 'body': None, 'images': hit['images'], 'meta': hit['meta'], 'cached': True}
+
+                    async def call_backend():
+                        async def post(lease):
+                            async with async_backend_slot(lease.url):
+                                r = await get_async_client().post(lease.url, json=payload, timeout=timeout,
+                                                                  headers=headers)
+                            if r.status_code >= 500:
+                                lease.failed(f'status {r.status_code}')
+                            return lease.url, r
+
+                        with span('sd.submit') as attrs, BACKEND_SUBMIT.time(backend='sd'):
+                            backend, r = await sd_pool.call_async(post)
+                            attrs['status'] = r.status_code
+                        if r.status_code != 200:
+                            return {'status': r.status_code, 'body': r.text, 'images': [], 'meta': {}, 'cached': False}
+                        with span('sd.download', stream=False), BACKEND_DOWNLOAD.time(backend='sd'):
+                            try:
+                                j = await asyncio.to_thread(r.json)
+                            except Exception:
+                                j = {'raw_text': r.text}
+                        images, meta = await asyncio.to_thread(extract_images, j, take)
+                        images = [await fetch_image(img, backend) if isinstance(img, ImageRef) else img
+                                  for img in images]
+                        urls = await asyncio.to_thread(save_images, [img for img in images if img is not None],
+                                                       prompt, crystal, take, backend)
+                        if key and urls:
+                            await asyncio.to_thread(gen_cache.put, key, urls, meta)
+                        return {'status': 200, 'body': j, 'images': urls, 'meta': meta, 'cached': False}
+
+                    async def generate_counted():
+                        with GENERATIONS_IN_FLIGHT.track_inprogress():
                             try:
-                                payload['seed'] = int(seed)
+                                result = await call_backend()
                             except Exception:
-                                payload['seed'] = seed
-                        if negative:
-                            payload['negative_prompt'] = negative
+                                GENERATE_TOTAL.inc(result='failure')
+                                raise
+                        GENERATE_TOTAL.inc(result='success' if result['images'] else 'failure')
+                        return result
+
+                    with span('txt2img', take=take) as attrs:
+                        if key is None:
+                            return await generate_counted()
+                        result, shared = await gen_cache.async_flight.do(key, generate_counted)
+                        attrs['shared'] = shared
+                        return dict(result, cached=shared) if shared else result
 
+                debug = data.get('debug', False)
+
+                if prompts and isinstance(prompts, list):
+                    jobs = plan_batch(prompts, opts)
+
+                    async def run_job(job):
                         try:
-                            r = requests.post(sd_url, json=payload, timeout=60, headers=headers)
+                            return await txt2img(job_payload(opts, job), timeout=60, take=len(job[1])), None
                         except Exception as e:
-                            results.append({'error': str(e)})
-                            continue
-                        if r.status_code != 200:
-                            results.append({'error': f'sd_status_{r.status_code}', 'body': r.text})
-                            continue
-                        try:
-                            j = r.json()
-                        except Exception:
-                            j = {'raw_text': r.text}
-                        images = extract_base64_images(j)
-                        if not images:
-                            dbg = save_debug_response(j) if data.get('debug') else None
-                            results.append({'error': 'no_images', 'sd_body': j, 'sd_debug_file': dbg})
-                            continue
-                        # save first image for this prompt
-                        url = save_base64_image(images[0], prefix='sd')
-                        results.append({'prompt': p, 'image': url, 'meta': extract_metadata(j)})
-                    return jsonify({'results': results, 'prompt_batch': len(prompts)})
-                # Build a richer payload for common SD REST endpoints (txt2img style).
-                # Accept optional parameters from the incoming request to override defaults.
-                width = int(data.get('width', 512))
-                height = int(data.get('height', 768))
-                steps = int(data.get('steps', 20))
-                sampler = data.get('sampler', None)
-                cfg_scale = float(data.get('cfg_scale', 7.0))
-                samples = int(data.get('samples', 1))
-                seed = data.get('seed', None)
-                negative = data.get('negative_prompt', None)
-
-                payload = {
-                    'prompt': prompt,
-                    'width': width,
-                    'height': height,
-                    'steps': steps,
-                    'cfg_scale': cfg_scale,
-                    'samples': samples,
-                }
-                if sampler:
-                    payload['sampler_name'] = sampler
-                if seed is not None:
-                    try:
-                        payload['seed'] = int(seed)
-                    except Exception:
-                        payload['seed'] = seed
-                if negative:
-                    payload['negative_prompt'] = negative
-                # support an optional local SD API key (set LOCAL_SD_KEY) and header name (LOCAL_SD_KEY_HEADER)
-                headers = {'Content-Type': 'application/json'}
-                local_key = os.environ.get('LOCAL_SD_KEY')
-                key_header = os.environ.get('LOCAL_SD_KEY_HEADER', 'Authorization')
-                if local_key:
-                    # if header is Authorization and key doesn't already start with Bearer, add prefix
-                    if key_header.lower() == 'authorization' and not local_key.lower().startswith('bearer '):
-                        headers[key_header] = f'Bearer {local_key}'
-                    else:
-                        headers[key_header] = local_key
-
-                r = requests.post(sd_url, json=payload, timeout=30, headers=headers)
-                debug = data.get('debug', False)
-                if r.status_code == 200:
-                    try:
-                        j = r.json()
-                    except Exception:
-                        j = {'raw_text': r.text}
-                    # Robust extraction: different SD frontends return images in different shapes.
-                    def extract_base64_images(node):
-                        """Recursively search JSON-like structure for base64 image strings.
-                        Accepts 'data:image/png;base64,...', raw base64, or dict entries like {'b64': '...'}.
-                        Returns list of base64 (possibly with data: header) strings.
-                        """
-                        found = []
-                        if node is None:
-                            return found
-                        if isinstance(node, str):
-                            s = node.strip()
-                            # common header form
-                            if s.startswith('data:image') and 'base64,' in s:
-                                found.append(s)
-                                return found
-                            # raw base64-looking string (heuristic: long and mostly base64 chars)
-                            if len(s) > 800 and all(c.isalnum() or c in '+/=' for c in s[:200]):
-                                # assume it's base64 image - caller will decode
-                                found.append(s)
-                                return found
-                            return found
-                        if isinstance(node, dict):
-                            # common keys
-                            for k in ('images', 'image', 'result', 'outputs', 'artifacts', 'images_base64'):
-                                if k in node:
-                                    return extract_base64_images(node[k])
-                            for v in node.values():
-                                found.extend(extract_base64_images(v))
-                            return found
-                        if isinstance(node, list):
-                            for item in node:
-                                found.extend(extract_base64_images(item))
-                            return found
-                        return found
-
-                    images = extract_base64_images(j)
-                    # helper to extract metadata (seed/steps/sampler) from response
-                    def extract_metadata(node):
-                        md = {}
-                        if not node:
-                            return md
-                        if isinstance(node, dict):
-                            for k in ('seed', 'steps', 'sampler', 'sampler_name', 'seed_value', 'cfg_scale'):
-                                if k in node:
-                                    md[k] = node[k]
-                            # many SD frontends include parameters/info under 'info' or within nested dicts
-                            for v in node.values():
-                                if isinstance(v, (dict, list)):
-                                    nested = extract_metadata(v)
-                                    for kk, vv in nested.items():
-                                        if kk not in md:
-                                            md[kk] = vv
-                        elif isinstance(node, list):
-                            for item in node:
-                                nested = extract_metadata(item)
-                                for kk, vv in nested.items():
-                                    if kk not in md:
-                                        md[kk] = vv
-                        return md
-
-                    if images and len(images) > 0:
-                        result_images = []
-                        meta = extract_metadata(j)
-                        # Save all found images
-                        for idx, img_b64 in enumerate(images):
-                            choice = img_b64
-                            # prefer data:... if present
-                            if isinstance(img_b64, str) and img_b64.startswith('data:'):
-                                choice = img_b64
-                            url = save_base64_image(choice, prefix=f'sd{idx}')
-                            if url:
-                                result_images.append({'url': url, 'index': idx})
-                        out = {'images': result_images, 'prompt': prompt, 'meta': meta}
-                        if debug:
-                            out['sd_response'] = j
-                        return jsonify(out)
-                    else:
-                        # No images found in response
-                        if debug:
-                            # save debug file to static for offline inspection
-                            dbg_path = save_debug_response(j)
-                            out = {'sd_status': r.status_code, 'sd_body': j}
-                            if dbg_path:
-                                out['sd_debug_file'] = dbg_path
-                            return jsonify(out)
+                            return None, e
+
+                    # every job is in flight at once; async_backend_slot bounds each backend
+                    outcomes = await asyncio.gather(*(run_job(job) for job in jobs))
+                    results = await asyncio.to_thread(batch_results, prompts, jobs, outcomes, debug)
+                    return {'results': results, 'prompt_batch': len(prompts)}, 200
+
+                res = await txt2img(build_payload(opts, prompt), timeout=30)
+                out = await asyncio.to_thread(single_response, res, prompt, debug)
+                if out is not None:
+                    return out, 200
             except Exception as e:
                 print('SD call failed or not available:', e)
                 if data.get('debug'):
-                    dbg_path = save_debug_response({'error': str(e), 'text': str(e)})
-                    out = {'error': str(e)}
-                    if dbg_path:
-                        out['sd_debug_file'] = dbg_path
-                    return jsonify(out)
-
-        # Also accept direct base64 image in the request body under 'image'
-        incoming_image = data.get('image')
-        if incoming_image:
-            url = save_base64_image(incoming_image, prefix='upload')
-            if url:
-                return jsonify({'image': url, 'prompt': prompt})
+                    return await asyncio.to_thread(error_response, e), 200
 
-        # Fallback: return a bundled placeholder
-        return jsonify({'image': '/static/images/cards/the_fool.svg', 'prompt': prompt})
+        return await asyncio.to_thread(fallback_response, data, prompt, crystal), 200
 
 
     return app
 
 
+def create_asgi_app(test_config=None):
+    """Async serving mode: ``uvicorn app:create_asgi_app --factory`` (see asgi_bridge.py)."""
+    return create_app(test_config).extensions['asgi']
+
+
 if __name__ == '__main__':
     app = create_app()
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,212 @@
+"""ASGI front for a Flask app: native async handlers for the slow routes.
+
+:class:`AsgiApp` serves the routes registered with :meth:`AsgiApp.route` as
+coroutines on the event loop, so a request waiting on a backend costs a
+suspended task instead of an OS thread. Every other request is handed to
+the Flask (WSGI) app on a small thread pool, so pages, static files and the
+gallery API keep working unchanged. Async handlers take an
+:class:`AsyncRequest` and return ``(body, status)``; the body is serialised
+with the Flask app's JSON provider, so responses match ``jsonify``. A
+:class:`StreamingBody` is sent chunk by chunk as it is produced instead.
+
+Run it with any ASGI server, e.g. ``uvicorn app:create_asgi_app --factory``.
+"""
+import asyncio
+import io
+import json as jsonlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import tracing
+from async_http import aclose_client
+
+
+class AsyncRequest:
+    def __init__(self, method: str, path: str, query_string: bytes, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.args = {k: v[0] for k, v in parse_qs(query_string.decode('latin-1')).items()}
+        self.headers = headers  # lower-case names
+        self.body = body
+
+    @property
+    def json(self):
+        """The body parsed as JSON, or None (like ``request.get_json(silent=True)``)."""
+        try:
+            return jsonlib.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+
+class StreamingBody:
+    """An (async) iterable of ``str``/``bytes`` chunks, sent as they are produced (e.g. Server-Sent Events)."""
+
+    def __init__(self, chunks, content_type: str = 'text/event-stream'):
+        self.chunks = chunks
+        self.content_type = content_type
+
+
+class AsgiApp:
+    def __init__(self, flask_app, wsgi_threads: int = 16):
+        self.flask_app = flask_app
+        self.routes = {}  # (method, path) -> coroutine function
+        self._executor = ThreadPoolExecutor(max_workers=wsgi_threads, thread_name_prefix='wsgi')
+
+    def route(self, path: str, methods=('POST',)):
+        def decorator(fn):
+            for method in methods:
+                self.routes[(method, path)] = fn
+            return fn
+        return decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = await _read_body(receive)
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            status, headers, content = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._call_wsgi, scope, body)
+            await _start(send, status, headers)
+            await send({'type': 'http.response.body', 'body': content})
+        else:
+            await self._call_async(handler, scope, body, send)
+
+    async def _call_async(self, handler, scope, body, send):
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+        request = AsyncRequest(scope['method'], scope['path'], scope.get('query_string', b''), headers, body)
+        with tracing.start(tracing.clean_request_id(headers.get('x-request-id'))) as trace:
+            with tracing.span('request', method=request.method, path=request.path) as attrs:
+                try:
+                    result, status = await handler(request)
+                except Exception as e:
+                    print('Async handler failed:', e)
+                    result, status = {'error': str(e)}, 500
+                attrs['status'] = status
+                if isinstance(result, StreamingBody):
+                    # the span covers the whole stream; Server-Timing cannot (headers go first)
+                    await _start(send, status, [('Content-Type', result.content_type),
+                                                ('Cache-Control', 'no-cache'), ('X-Request-ID', trace.request_id)])
+                    async for chunk in _aiter(result.chunks):
+                        await send({'type': 'http.response.body', 'more_body': True,
+                                    'body': chunk.encode('utf-8') if isinstance(chunk, str) else chunk})
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+        response_headers = [('Content-Type', 'application/json'), ('X-Request-ID', trace.request_id)]
+        if self.flask_app.config.get('SERVER_TIMING'):
+            response_headers.append(('Server-Timing', trace.server_timing()))
+        await _start(send, status, response_headers)
+        await send({'type': 'http.response.body', 'body': (self.flask_app.json.dumps(result) + '\n').encode('utf-8')})
+
+    def _call_wsgi(self, scope, body):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return lambda data: None
+
+        result = self.flask_app(_environ(scope, body), start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], content
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await aclose_client()
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _aiter(chunks):
+    if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+async def _start(send, status, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def _environ(scope, body: bytes) -> dict:
+    """The PEP 3333 environ for an ASGI http scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(client[0]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def request(app, method: str, path: str, json=None, headers: dict = None):
+    """Call an ASGI ``app`` in-process; returns ``(status, headers, body)`` (for tests and scripts)."""
+    body = jsonlib.dumps(json).encode() if json is not None else b''
+    raw_headers = [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in (headers or {}).items()]
+    if json is not None:
+        raw_headers.append((b'content-type', b'application/json'))
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+             'root_path': '', 'query_string': query.encode('latin-1'), 'headers': raw_headers,
+             'server': ('127.0.0.1', 80), 'client': ('127.0.0.1', 0)}
+    sent = {'body': False}
+    messages = []
+
+    async def receive():
+        if sent['body']:
+            await asyncio.Event().wait()  # no disconnect while the handler runs
+        sent['body'] = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    response_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], response_headers, b''.join(m.get('body', b'') for m in messages[1:])
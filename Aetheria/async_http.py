@@ -0,0 +1,301 @@
+"""Asyncio HTTP/1.1 client for the async serving mode (see ``asgi_bridge.py``).
+
+The non-blocking counterpart of ``http_client.py``: a call awaits the
+backend instead of holding a thread, so one event loop can keep hundreds of
+generations in flight. Keep-alive connections are pooled per origin and
+reused; a stale pooled connection is retried once on a fresh one. It covers
+what the backends need and nothing more: JSON or bytes bodies,
+``Content-Length``, chunked and read-until-close responses, http and https.
+
+Clients are bound to an event loop; :func:`get_async_client` returns the one
+for the running loop, configured like the sync client
+(``HTTP_POOL_SIZE``, ``HTTP_CONNECT_TIMEOUT``, ``HTTP_READ_TIMEOUT``).
+Connection failures, timeouts and malformed responses raise ``OSError``
+subclasses, which ``BackendPool`` counts against the node; failing to
+connect at all raises :class:`ConnectError`, the one case it retries on
+another node.
+"""
+import asyncio
+import json as jsonlib
+import os
+import ssl
+import tempfile
+import weakref
+from urllib.parse import urlsplit
+
+
+class ConnectError(ConnectionError):
+    """No connection could be opened (refused, unresolvable, connect timeout): nothing was sent."""
+
+
+class ProtocolError(OSError):
+    """The server sent something that is not a valid HTTP/1.1 response."""
+
+
+class HTTPStatusError(ProtocolError):
+    """The response has an error status (``status_code`` >= 400)."""
+
+    def __init__(self, status_code: int, url: str):
+        super().__init__(f'HTTP {status_code} for {url}')
+        self.status_code = status_code
+
+
+class Response:
+    def __init__(self, url: str, status_code: int, headers: dict, content: bytes):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers  # lower-case names
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPStatusError(self.status_code, self.url)
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPClient:
+    def __init__(self, pool_size: int = 20, connect_timeout: float = 5.0, read_timeout: float = 60.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}  # (scheme, host, port) -> [_Connection]
+        self._ssl = None
+
+    async def request(self, method: str, url: str, json=None, data: bytes = None, headers: dict = None,
+                      timeout: float = None) -> Response:
+        """Send a request and read the whole response; ``timeout`` bounds the entire call."""
+        chunks = []
+        status, resp_headers = await asyncio.wait_for(
+            self._exchange(method, url, json, data, headers, chunks.append), timeout or self.read_timeout)
+        return Response(url, status, resp_headers, b''.join(chunks))
+
+    async def get(self, url: str, **kwargs) -> Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def stream(self, method: str, url: str, json=None, data: bytes = None, headers: dict = None,
+                     timeout: float = None):
+        """Yield the response body in chunks as they arrive (an async generator).
+
+        ``timeout`` bounds the wait for the response head and for each chunk
+        after it; an error status raises :class:`HTTPStatusError` before any chunk.
+        Closing the generator early drops the connection.
+        """
+        timeout = timeout or self.read_timeout
+        chunks = asyncio.Queue()  # (status, headers), then bytes, then None
+        task = asyncio.ensure_future(self._exchange(method, url, json, data, headers, chunks.put_nowait,
+                                                    head=lambda *h: chunks.put_nowait(h)))
+
+        def finished(t):
+            if not t.cancelled():
+                t.exception()  # re-raised below through t.result()
+            chunks.put_nowait(None)
+
+        task.add_done_callback(finished)
+        try:
+            while True:
+                item = await asyncio.wait_for(chunks.get(), timeout)
+                if item is None:
+                    task.result()
+                    return
+                if isinstance(item, tuple):
+                    if item[0] >= 400:
+                        raise HTTPStatusError(item[0], url)
+                    continue
+                yield item
+        finally:
+            task.cancel()
+
+    async def download_to_tempfile(self, url: str, timeout: float = None, **kwargs):
+        """Write the body chunk by chunk to an anonymous temp file and return it rewound
+        (:class:`HTTPStatusError` on an error status)."""
+        f = tempfile.TemporaryFile()
+        try:
+            status, _ = await asyncio.wait_for(self._exchange('GET', url, None, None, kwargs.get('headers'), f.write),
+                                               timeout or self.read_timeout)
+            if status >= 400:
+                raise HTTPStatusError(status, url)
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    async def aclose(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    # connection handling ---------------------------------------------------
+
+    async def _exchange(self, method, url, json, data, headers, sink, head=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'unsupported url: {url}')
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        if json is not None:
+            data = jsonlib.dumps(json).encode()
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        request = self._encode(method, target, parts.netloc, data, headers)
+
+        while True:
+            conn, reused = await self._checkout(origin)
+            received = False
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status_line = await conn.reader.readline()
+                received = bool(status_line)
+                if not status_line:
+                    raise ConnectionResetError('connection closed before the response')
+                status, resp_headers, keep_alive = await self._read_head(conn.reader, status_line)
+                if head is not None:
+                    head(status, resp_headers)
+                keep_alive = await self._read_body(conn.reader, method, status, resp_headers, sink) and keep_alive
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                if reused and not received:
+                    continue  # the server dropped an idle keep-alive connection; retry on a new one
+                raise ConnectionResetError(str(e)) from e
+            except BaseException:
+                conn.close()
+                raise
+            if keep_alive:
+                self._checkin(origin, conn)
+            else:
+                conn.close()
+            return status, resp_headers
+
+    async def _checkout(self, origin):
+        idle = self._idle.get(origin)
+        while idle:
+            conn = idle.pop()
+            if not conn.reader.at_eof() and not conn.writer.is_closing():
+                return conn, True
+            conn.close()
+        scheme, host, port = origin
+        ssl_context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            ssl_context = self._ssl
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl_context),
+                                                    self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectError(f'cannot connect to {host}:{port}: {e or type(e).__name__}') from e
+        return _Connection(reader, writer), False
+
+    def _checkin(self, origin, conn):
+        idle = self._idle.setdefault(origin, [])
+        if len(idle) < self.pool_size:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    @staticmethod
+    def _encode(method, target, host, data, headers) -> bytes:
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {host}', 'Accept-Encoding: identity']
+        names = set()
+        for name, value in (headers or {}).items():
+            names.add(name.lower())
+            lines.append(f'{name}: {value}')
+        if data is not None or method in ('POST', 'PUT', 'PATCH'):
+            lines.append(f'Content-Length: {len(data or b"")}')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b'')
+
+    @staticmethod
+    async def _read_head(reader, status_line):
+        try:
+            version, code = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(code)
+        except ValueError:
+            raise ProtocolError(f'bad status line: {status_line[:100]!r}')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = 'close' not in connection and (version != 'HTTP/1.0' or 'keep-alive' in connection)
+        return status, headers, keep_alive
+
+    @staticmethod
+    async def _read_body(reader, method, status, headers, sink) -> bool:
+        """Feed the body to ``sink``; returns False when the connection cannot be reused."""
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return True
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size_line = await reader.readline()
+                try:
+                    size = int(size_line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ProtocolError(f'bad chunk size: {size_line[:100]!r}')
+                if size == 0:
+                    # trailers, then the blank line that ends the message
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return True
+                sink(await reader.readexactly(size))
+                await reader.readexactly(2)
+        length = headers.get('content-length')
+        if length is not None:
+            remaining = int(length)
+            while remaining:
+                chunk = await reader.read(min(remaining, 64 * 1024))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                sink(chunk)
+                remaining -= len(chunk)
+            return True
+        while True:  # no framing: the body ends when the server closes the connection
+            chunk = await reader.read(64 * 1024)
+            if not chunk:
+                return False
+            sink(chunk)
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> AsyncHTTPClient:
+    """Return the client of the running event loop, creating it from the environment on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncHTTPClient(
+            pool_size=int(os.environ.get('HTTP_POOL_SIZE', 20)),
+            connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5.0)),
+            read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', 60.0)),
+        )
+    return client
+
+
+async def aclose_client():
+    """Close the running loop's client (on server shutdown)."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
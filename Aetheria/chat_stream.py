@@ -0,0 +1,170 @@
+"""Streamed chat replies: completion tokens relayed as Server-Sent Events.
+
+:func:`completion_tokens` (and :func:`completion_tokens_async` for the async
+serving mode) POSTs a ``"stream": true`` request to an OpenAI-compatible
+``/completions`` endpoint and yields the text of each token as it arrives.
+Three deadlines bound a call: ``connect_timeout`` to connect,
+``read_timeout`` for the first token and between any two reads, and
+``deadline`` for the whole reply. Each read waits at most until the
+deadline, so a stalled upstream cannot hold the reply past it.
+
+:func:`relay` turns the tokens into the events the chat frontend reads::
+
+    data: {"token": "The"}
+
+    data: {"token": " stars"}
+
+    event: done
+    data: {"reply": "The stars ...", "source": "openai"}
+
+If the upstream fails or misses a deadline before the first token, the
+local fallback reply is sent instead (``"source": "local"``); after the
+first token the reply ends early with ``"truncated": true``. A reply that is
+already complete (e.g. cached) is sent with :func:`replay`.
+"""
+import asyncio
+import json
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    """The whole reply took longer than its deadline."""
+
+
+_DONE = object()
+
+
+def sse(data: dict, event: str = None) -> str:
+    """One Server-Sent Event carrying ``data`` as JSON."""
+    head = f'event: {event}\n' if event else ''
+    return f'{head}data: {json.dumps(data)}\n\n'
+
+
+def _token(line: str):
+    """Token text of one upstream SSE line; None for other lines, ``_DONE`` at the end of the stream."""
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return _DONE
+    choice = (json.loads(data).get('choices') or [{}])[0]
+    return choice.get('text') or (choice.get('delta') or {}).get('content')
+
+
+def _cap_next_read(response, seconds: float):
+    """Limit the next socket read of a streamed ``requests`` response to ``seconds``."""
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        sock.settimeout(max(seconds, 0.001))
+
+
+def _request(api_key, payload):
+    return {'json': dict(payload, stream=True),
+            'headers': {'Authorization': f'Bearer {api_key}', 'Accept': 'text/event-stream'}}
+
+
+def completion_tokens(client, url: str, api_key: str, payload: dict,
+                      connect_timeout: float = 3.0, read_timeout: float = 10.0, deadline: float = 30.0):
+    """Yield completion tokens from ``url`` through the pooled ``http_client`` client."""
+    ends = time.monotonic() + deadline
+    with client.post(url, stream=True, timeout=(connect_timeout, read_timeout), **_request(api_key, payload)) as r:
+        r.raise_for_status()
+        _cap_next_read(r, min(read_timeout, ends - time.monotonic()))
+        try:
+            for line in r.iter_lines(chunk_size=None):
+                left = ends - time.monotonic()
+                if left < 0:
+                    raise DeadlineExceeded(f'no complete reply within {deadline}s')
+                _cap_next_read(r, min(read_timeout, left))
+                token = _token(line.decode('utf-8', errors='replace'))
+                if token is _DONE:
+                    return
+                if token:
+                    yield token
+        except OSError as e:  # requests' read timeouts included
+            if time.monotonic() >= ends and not isinstance(e, DeadlineExceeded):
+                raise DeadlineExceeded(f'no complete reply within {deadline}s') from e
+            raise
+
+
+async def completion_tokens_async(client, url: str, api_key: str, payload: dict,
+                                  read_timeout: float = 10.0, deadline: float = 30.0):
+    """:func:`completion_tokens` on an ``async_http`` client (its connect timeout applies)."""
+    ends = time.monotonic() + deadline
+    buffer = b''
+    chunks = client.stream('POST', url, timeout=read_timeout, **_request(api_key, payload))
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), max(ends - time.monotonic(), 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as e:
+                if time.monotonic() >= ends:
+                    raise DeadlineExceeded(f'no complete reply within {deadline}s') from e
+                raise
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                token = _token(line.decode('utf-8', errors='replace').rstrip('\r'))
+                if token is _DONE:
+                    return
+                if token:
+                    yield token
+    finally:
+        await chunks.aclose()
+
+
+def replay(reply: str, source: str = 'cache') -> list:
+    """The events of a complete ``reply``: one token, then ``done``."""
+    return [sse({'token': reply}), sse({'reply': reply, 'source': source}, event='done')]
+
+
+def _closing_events(parts, fallback, failed, on_reply):
+    if not parts:
+        return replay(fallback(), 'local')
+    done = {'reply': ''.join(parts).strip(), 'source': 'openai'}
+    if failed:
+        done['truncated'] = True
+    elif on_reply is not None:
+        on_reply(done['reply'])
+    return [sse(done, event='done')]
+
+
+def relay(tokens, fallback, on_reply=None):
+    """SSE events for ``tokens`` (None without an upstream); ``fallback()`` gives the reply when no token arrives.
+
+    ``on_reply(reply)`` is called with a complete upstream reply (e.g. to cache it).
+    """
+    parts = []
+    failed = False
+    try:
+        for token in tokens or ():
+            parts.append(token)
+            yield sse({'token': token})
+    except Exception as e:
+        print('Chat stream failed:', e)
+        failed = True
+    finally:
+        if hasattr(tokens, 'close'):
+            tokens.close()  # drop the upstream connection when the browser goes away
+    yield from _closing_events(parts, fallback, failed, on_reply)
+
+
+async def relay_async(tokens, fallback, on_reply=None):
+    """:func:`relay` for an async iterator of tokens."""
+    parts = []
+    failed = False
+    try:
+        if tokens is not None:
+            async for token in tokens:
+                parts.append(token)
+                yield sse({'token': token})
+    except Exception as e:
+        print('Chat stream failed:', e)
+        failed = True
+    finally:
+        if hasattr(tokens, 'aclose'):
+            await tokens.aclose()
+    for event in _closing_events(parts, fallback, failed, on_reply):
+        yield event
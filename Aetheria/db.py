@@ -0,0 +1,194 @@
+"""Small SQLite data-access layer shared by the routes.
+
+- one connection per thread, opened lazily and reused (no connect/close per query)
+- WAL journal so readers are not blocked by a writer, plus tuned pragmas
+- inserts into ``generated`` are group-committed by a writer thread: concurrent
+  saves are batched into a single transaction
+- per-statement timings, available from :meth:`Database.stats` (and as a
+  ``/metrics`` histogram by statement type)
+- per-table version counters kept by triggers (:meth:`Database.track_versions`),
+  cheap validators for HTTP caching of listings
+"""
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from metrics import SQLITE_STATEMENT
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+)
+
+# current time in unix seconds, with sub-second precision
+_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+class Database:
+    def __init__(self, path: str, busy_timeout_s: float = 5.0, batch_size: int = 64, batch_wait_s: float = 0.005):
+        self.path = path
+        self.busy_timeout_s = busy_timeout_s
+        self.batch_size = batch_size
+        self.batch_wait_s = batch_wait_s
+        self._local = threading.local()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    # connections ---------------------------------------------------------
+
+    def connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_s)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close the calling thread's connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # statements ----------------------------------------------------------
+
+    def execute(self, sql: str, params=(), conn=None) -> sqlite3.Cursor:
+        conn = conn or self.connection()
+        start = time.perf_counter()
+        try:
+            return conn.execute(sql, params)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql: str, seq, conn=None) -> sqlite3.Cursor:
+        conn = conn or self.connection()
+        start = time.perf_counter()
+        try:
+            return conn.executemany(sql, seq)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    def query(self, sql: str, params=()) -> list:
+        return self.execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params=()):
+        return self.execute(sql, params).fetchone()
+
+    @contextmanager
+    def transaction(self):
+        """Run statements in one write transaction; commits on success, rolls back on error."""
+        conn = self.connection()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    # batched inserts -----------------------------------------------------
+
+    def insert_generated(self, filename: str, prompt, crystal, created_at: str) -> int:
+        """Insert one ``generated`` row through the group-commit writer; returns its id."""
+        future = Future()
+        self._writes.put(((filename, prompt, crystal, created_at), future))
+        self._ensure_writer()
+        return future.result()
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name='sqlite-writer', daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.batch_wait_s
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                with self.transaction() as conn:
+                    ids = [self.execute('INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)',
+                                        row, conn=conn).lastrowid
+                           for row, _ in batch]
+            except Exception as e:
+                logger.exception('Batched insert of %d rows failed', len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), row_id in zip(batch, ids):
+                    future.set_result(row_id)
+
+    # bulk deletes --------------------------------------------------------
+
+    def delete_generated(self, ids) -> list:
+        """Delete ``generated`` rows in one transaction; returns ``[(id, filename)]`` of the rows that existed."""
+        ids = list(ids)
+        if not ids:
+            return []
+        marks = ','.join('?' * len(ids))
+        with self.transaction() as conn:
+            rows = self.execute(f'SELECT id, filename FROM generated WHERE id IN ({marks})', ids, conn=conn).fetchall()
+            self.execute(f'DELETE FROM generated WHERE id IN ({marks})', ids, conn=conn)
+        return rows
+
+    # change tracking -----------------------------------------------------
+
+    def track_versions(self, *tables):
+        """Keep a version counter for each of ``tables``, bumped by triggers on every insert/update/delete."""
+        with self.transaction():
+            self.execute('CREATE TABLE IF NOT EXISTS table_versions ('
+                         'name TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL NOT NULL)')
+            for table in tables:
+                self.execute(f'INSERT OR IGNORE INTO table_versions (name, version, updated_at) VALUES (?, 0, {_NOW})',
+                             (table,))
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    self.execute(f'CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} '
+                                 f'AFTER {event} ON {table} BEGIN '
+                                 f"UPDATE table_versions SET version = version + 1, updated_at = {_NOW} "
+                                 f"WHERE name = '{table}'; END")
+
+    def versions(self, *tables) -> dict:
+        """``{table: (version, updated_at)}`` for tables registered with :meth:`track_versions`
+        (``updated_at`` in unix seconds)."""
+        marks = ','.join('?' * len(tables))
+        rows = self.query(f'SELECT name, version, updated_at FROM table_versions WHERE name IN ({marks})', tables)
+        return {name: (version, updated_at) for name, version, updated_at in rows}
+
+    # observability -------------------------------------------------------
+
+    def _record(self, sql: str, elapsed: float):
+        key = re.sub(r'\s+', ' ', sql).strip()
+        SQLITE_STATEMENT.observe(elapsed, op=key.split(' ', 1)[0].lower())
+        with self._stats_lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = self._stats[key] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            ms = elapsed * 1000
+            stat['count'] += 1
+            stat['total_ms'] += ms
+            stat['max_ms'] = max(stat['max_ms'], ms)
+
+    def stats(self) -> dict:
+        """Per-statement ``{count, total_ms, avg_ms, max_ms}``, keyed by normalized SQL."""
+        with self._stats_lock:
+            return {sql: dict(stat, avg_ms=stat['total_ms'] / stat['count'])
+                    for sql, stat in self._stats.items()}
@@ -0,0 +1,216 @@
+"""The tarot deck: 78 immutable cards, spreads and seeded draws.
+
+Cards are built once at import as namedtuples and never modified; a draw
+returns :class:`DrawnCard` views (card, spread position, reversed flag) that
+point at the shared cards, so concurrent readings cannot leak state into
+each other. Every draw takes a seed (a new one is picked when none is
+given) and the same seed always gives the same reading.
+
+:func:`draw_batch` draws thousands of spreads in one call for simulations
+and analytics: the result is two ``(count, cards per spread)`` arrays of
+card indices and reversed flags, sampled with whole-array NumPy operations.
+NumPy is optional; without it the batch is drawn spread by spread and
+returned as nested lists.
+"""
+import random
+import re
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Card = namedtuple('Card', 'index name slug arcana suit rank meaning image')
+DrawnCard = namedtuple('DrawnCard', 'card position reversed')
+
+# Chance that a drawn card comes up reversed
+REVERSED_PROBABILITY = 1 / 3
+
+# Positions of each spread, in draw order
+SPREADS = {
+    'single': ('Guidance',),
+    'three': ('Past', 'Present', 'Future'),
+    'five': ('Present', 'Challenge', 'Past', 'Future', 'Outcome'),
+    'celtic_cross': ('Present', 'Challenge', 'Foundation', 'Recent past', 'Crown', 'Near future',
+                     'Self', 'Environment', 'Hopes and fears', 'Outcome'),
+}
+
+_MAJOR = (
+    ("The Fool", "New beginnings, spontaneity, a leap of faith.", "/static/images/cards/the_fool.svg"),
+    ("The Magician", "Skill, resourcefulness, the power to manifest.", "/static/images/cards/the_magician.svg"),
+    ("The High Priestess", "Intuition, inner knowledge, mystery.", "/static/images/cards/the_high_priestess.svg"),
+    ("The Empress", "Fertility, creativity, abundance.", "/static/images/cards/the_empress.svg"),
+    ("The Emperor", "Structure, authority, leadership.", "/static/images/cards/the_emperor.svg"),
+    ("The Hierophant", "Tradition, learning, spiritual guidance.", None),
+    ("The Lovers", "Relationships, choices, harmony.", None),
+    ("The Chariot", "Willpower, success through determination.", None),
+    ("Strength", "Courage, patience, inner strength.", None),
+    ("The Hermit", "Solitude, inner search, wisdom.", None),
+    ("Wheel of Fortune", "Cycles, destiny, turning points.", None),
+    ("Justice", "Fairness, truth, law.", None),
+    ("The Hanged Man", "Surrender, new perspective.", None),
+    ("Death", "Transformation, endings and beginnings.", None),
+    ("Temperance", "Balance, moderation, healing.", None),
+    ("The Devil", "Attachments, shadow, temptation.", None),
+    ("The Tower", "Disruption, sudden change, revelation.", None),
+    ("The Star", "Hope, inspiration, renewal.", None),
+    ("The Moon", "Illusion, subconscious, emotions.", None),
+    ("The Sun", "Joy, success, vitality.", None),
+    ("Judgement", "Awakening, rebirth, evaluation.", None),
+    ("The World", "Completion, wholeness, travel.", None),
+)
+
+_RANKS = ('Ace', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten',
+          'Page', 'Knight', 'Queen', 'King')
+
+# Meanings of the minor arcana, Ace to King
+_MINOR = {
+    'Wands': (
+        "Inspiration, a spark of new energy.",
+        "Planning, weighing a bold decision.",
+        "Expansion, looking ahead to progress.",
+        "Celebration, homecoming, stability.",
+        "Competition, friction, clashing ideas.",
+        "Victory, recognition, confidence.",
+        "Standing your ground, perseverance.",
+        "Swift movement, news on the way.",
+        "Resilience, one last push.",
+        "Heavy burdens, overcommitment.",
+        "Curiosity, enthusiasm, a free spirit.",
+        "Adventure, impulsive action.",
+        "Warmth, determination, magnetism.",
+        "Vision, bold leadership.",
+    ),
+    'Cups': (
+        "New feelings, an open heart.",
+        "Partnership, mutual attraction.",
+        "Friendship, shared celebration.",
+        "Apathy, reconsidering what is offered.",
+        "Loss, regret, learning to move on.",
+        "Nostalgia, innocent memories.",
+        "Daydreams, too many options.",
+        "Walking away in search of meaning.",
+        "Contentment, a wish fulfilled.",
+        "Harmony, family, lasting happiness.",
+        "A creative message, gentle intuition.",
+        "Romance, following the heart.",
+        "Compassion, emotional security.",
+        "Emotional balance, diplomacy.",
+    ),
+    'Swords': (
+        "Clarity, a breakthrough idea.",
+        "A difficult choice, stalemate.",
+        "Heartbreak, painful truth.",
+        "Rest, recovery, contemplation.",
+        "Conflict, winning at a cost.",
+        "Transition, leaving trouble behind.",
+        "Strategy, acting alone.",
+        "Feeling trapped, self-imposed limits.",
+        "Anxiety, sleepless worry.",
+        "A painful ending, hitting bottom.",
+        "Curiosity, new ideas, vigilance.",
+        "Ambition, fast and direct action.",
+        "Independence, clear boundaries.",
+        "Intellect, truth, authority.",
+    ),
+    'Pentacles': (
+        "A new opportunity, prosperity.",
+        "Juggling priorities, adaptability.",
+        "Teamwork, craftsmanship.",
+        "Security, holding on tightly.",
+        "Hardship, feeling left out in the cold.",
+        "Generosity, giving and receiving.",
+        "Patience, long-term investment.",
+        "Diligence, mastering a skill.",
+        "Self-sufficiency, well-earned comfort.",
+        "Legacy, wealth, family foundations.",
+        "Study, a practical new venture.",
+        "Hard work, routine, reliability.",
+        "Nurturing, practical care.",
+        "Abundance, security, discipline.",
+    ),
+}
+
+
+def slug(name: str) -> str:
+    """'The Hanged Man' -> 'the_hanged_man'"""
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def _build():
+    cards = [Card(i, name, slug(name), 'major', None, i, meaning, image)
+             for i, (name, meaning, image) in enumerate(_MAJOR)]
+    for suit, meanings in _MINOR.items():
+        for rank, (rank_name, meaning) in enumerate(zip(_RANKS, meanings), start=1):
+            name = f'{rank_name} of {suit}'
+            cards.append(Card(len(cards), name, slug(name), 'minor', suit.lower(), rank, meaning, None))
+    return tuple(cards)
+
+
+CARDS = _build()
+BY_SLUG = {card.slug: card for card in CARDS}
+
+
+def as_dict(drawn: DrawnCard) -> dict:
+    """The JSON shape of a drawn card."""
+    card = drawn.card
+    out = {'name': card.name, 'meaning': card.meaning, 'reversed': drawn.reversed,
+           'position': drawn.position, 'arcana': card.arcana, 'suit': card.suit, 'index': card.index}
+    if card.image:
+        out['image'] = card.image
+    return out
+
+
+def new_seed() -> int:
+    return random.SystemRandom().randrange(2 ** 32)
+
+
+def draw(spread: str = 'single', seed: int = None):
+    """Draw one spread; returns ``(seed, [DrawnCard, ...])``."""
+    if seed is None:
+        seed = new_seed()
+    positions = SPREADS[spread]
+    rng = random.Random(seed)
+    picked = rng.sample(range(len(CARDS)), len(positions))
+    return seed, [DrawnCard(CARDS[i], position, rng.random() < REVERSED_PROBABILITY)
+                  for i, position in zip(picked, positions)]
+
+
+def draw_batch(spread: str, count: int, seed: int = None):
+    """Draw ``count`` independent spreads; returns ``(seed, indices, reversed)``.
+
+    With NumPy, ``indices`` is a ``(count, k)`` uint8 array of card indices
+    and ``reversed`` a matching bool array. Each row is a sample without
+    replacement: the k cards with the smallest of 78 random keys, in key order
+    (``argpartition`` keeps this linear in the deck size).
+    """
+    if seed is None:
+        seed = new_seed()
+    k = len(SPREADS[spread])
+    if np is None:
+        rng = random.Random(seed)
+        indices = [rng.sample(range(len(CARDS)), k) for _ in range(count)]
+        return seed, indices, [[rng.random() < REVERSED_PROBABILITY for _ in range(k)] for _ in range(count)]
+    rng = np.random.default_rng(seed)
+    keys = rng.random((count, len(CARDS)))
+    chosen = np.argpartition(keys, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(keys, chosen, axis=1).argsort(axis=1)
+    indices = np.take_along_axis(chosen, order, axis=1).astype(np.uint8)
+    return seed, indices, rng.random((count, k)) < REVERSED_PROBABILITY
+
+
+def frequencies(indices) -> list:
+    """How often each card was drawn, by card index."""
+    if np is not None and isinstance(indices, np.ndarray):
+        return np.bincount(indices.ravel(), minlength=len(CARDS)).tolist()
+    counts = [0] * len(CARDS)
+    for row in indices:
+        for i in row:
+            counts[i] += 1
+    return counts
+
+
+def to_lists(rows) -> list:
+    """Nested lists of a :func:`draw_batch` result, for JSON."""
+    return rows.tolist() if np is not None and isinstance(rows, np.ndarray) else rows
@@ -0,0 +1,133 @@
+"""Closed-loop HTTP load generator and report format for ``bench.py``.
+
+:func:`run_scenario` sends ``requests`` calls from ``concurrency`` worker
+threads (each with its own keep-alive session) and summarizes them:
+p50/p95/p99/max latency, throughput, error count and the process' peak
+RSS so far. Reports are JSON with sorted keys, so two runs can be compared
+with ``diff`` or :func:`compare`.
+"""
+import json
+import math
+import platform
+import sys
+import threading
+import time
+
+import requests
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'throughput_rps', 'errors', 'peak_rss_mb')
+
+
+def percentile(sorted_values, q: float) -> float:
+    """Nearest-rank percentile (``q`` in 0..100) of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = min(max(math.ceil(q / 100 * len(sorted_values)), 1), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (None where ``resource`` is missing)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scenario(call, requests_total: int, concurrency: int) -> dict:
+    """Run ``call(session, i)`` for ``i`` in ``range(requests_total)`` on ``concurrency`` threads.
+
+    ``call`` returns a ``requests.Response``; a 5xx status or an exception counts as an error.
+    """
+    latencies, errors, statuses = [], [], {}
+    lock = threading.Lock()
+    counter = iter(range(requests_total))
+
+    def worker():
+        with requests.Session() as session:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    status = call(session, i).status_code
+                except Exception as e:
+                    status = type(e).__name__
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[str(status)] = statuses.get(str(status), 0) + 1
+                    if not isinstance(status, int) or status >= 500:
+                        errors.append(status)
+
+    threads = [threading.Thread(target=worker, name=f'loadgen-{n}') for n in range(max(concurrency, 1))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(latencies[-1], 2) if latencies else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def report(app_name: str, config: dict, scenarios: dict, backends: dict = None) -> dict:
+    return {
+        'app': app_name,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'scenarios': scenarios,
+        'backends': backends or {},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def dumps(doc: dict) -> str:
+    return json.dumps(doc, indent=2, sort_keys=True)
+
+
+def format_table(doc: dict) -> str:
+    header = f"{'scenario':<12}" + ''.join(f'{m:>16}' for m in METRICS)
+    lines = [header, '-' * len(header)]
+    for name, result in doc['scenarios'].items():
+        lines.append(f'{name:<12}' + ''.join(f"{_fmt(result.get(m)):>16}" for m in METRICS))
+    return '\n'.join(lines)
+
+
+def compare(old: dict, new: dict) -> str:
+    """Side-by-side metrics of two reports with the relative change."""
+    lines = [f"{'scenario':<12}{'metric':<16}{'old':>12}{'new':>12}{'change':>10}"]
+    for name, result in new['scenarios'].items():
+        before = old.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for m in METRICS:
+            a, b = before.get(m), result.get(m)
+            change = f'{(b - a) / a * 100:+.1f}%' if isinstance(a, (int, float)) and a and b is not None else ''
+            lines.append(f'{name:<12}{m:<16}{_fmt(a):>12}{_fmt(b):>12}{change:>10}')
+    return '\n'.join(lines)
+
+
+def _fmt(value):
+    return '-' if value is None else str(value)
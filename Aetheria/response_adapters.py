@@ -0,0 +1,227 @@
+"""Per-backend adapters that pull images and metadata out of txt2img responses.
+
+Each adapter knows one response schema and reads the images and generation
+parameters straight from their documented place:
+
+- ``a1111``: AUTOMATIC1111 / Forge ``{'images': [...], 'parameters': {...}, 'info': '<json>'}``
+- ``comfyui``: ComfyUI history ``{prompt_id: {'prompt': [...], 'outputs': {node: {'images': [...]}}}}``
+- ``stability``: Stability-style ``{'artifacts': [{'base64': ..., 'seed': ..., 'finishReason': ...}]}``
+
+:func:`extract` picks the first adapter whose ``matches`` accepts the body
+(a couple of key lookups). Only when none does, or the matching one finds no
+image, does it fall back to the generic scanner, which walks the whole
+document and guesses which long strings are base64. New backends are added
+with :func:`register` without touching the request path.
+"""
+import json
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from stream_json import SpilledBase64
+
+METADATA_KEYS = ('seed', 'steps', 'sampler', 'sampler_name', 'seed_value', 'cfg_scale', 'index_of_first_image')
+
+Extracted = namedtuple('Extracted', 'images meta adapter')
+
+
+class ImageRef:
+    """An output image the backend kept on disk (ComfyUI); fetch it with :meth:`view_url`."""
+
+    def __init__(self, filename: str, subfolder: str = '', type: str = 'output'):
+        self.filename = filename
+        self.subfolder = subfolder
+        self.type = type
+
+    def view_url(self, origin: str) -> str:
+        query = urlencode({'filename': self.filename, 'subfolder': self.subfolder, 'type': self.type})
+        return f"{origin.rstrip('/')}/view?{query}"
+
+    def __repr__(self):
+        return f'ImageRef({self.filename!r}, {self.subfolder!r}, {self.type!r})'
+
+
+class A1111Adapter:
+    name = 'a1111'
+
+    def matches(self, body) -> bool:
+        return isinstance(body, dict) and isinstance(body.get('images'), list)
+
+    def images(self, body) -> list:
+        return [img for img in body['images'] if _is_image(img)]
+
+    def metadata(self, body) -> dict:
+        # 'info' holds what was actually used (real seed); 'parameters' echoes the request
+        info = body.get('info')
+        if isinstance(info, str):
+            try:
+                info = json.loads(info)
+            except ValueError:
+                info = None
+        meta = _pick(info)
+        for k, v in _pick(body.get('parameters')).items():
+            meta.setdefault(k, v)
+        return meta
+
+
+class ComfyUIAdapter:
+    name = 'comfyui'
+
+    def matches(self, body) -> bool:
+        return bool(self._entries(body))
+
+    def images(self, body) -> list:
+        found = []
+        for entry in self._entries(body):
+            for output in entry['outputs'].values():
+                for img in (output or {}).get('images', ()):
+                    if isinstance(img, dict) and img.get('filename'):
+                        found.append(ImageRef(img['filename'], img.get('subfolder', ''), img.get('type', 'output')))
+                    elif _is_image(img):
+                        found.append(img)
+        return found
+
+    def metadata(self, body) -> dict:
+        # sampler settings live in the queued graph: entry['prompt'] = [number, id, graph, extra, outputs]
+        for entry in self._entries(body):
+            prompt = entry.get('prompt')
+            graph = prompt[2] if isinstance(prompt, list) and len(prompt) > 2 else None
+            for node in (graph or {}).values():
+                if isinstance(node, dict) and str(node.get('class_type', '')).startswith('KSampler'):
+                    inputs = node.get('inputs', {})
+                    meta = {'seed': inputs.get('seed', inputs.get('noise_seed')), 'steps': inputs.get('steps'),
+                            'sampler_name': inputs.get('sampler_name'), 'cfg_scale': inputs.get('cfg')}
+                    return {k: v for k, v in meta.items() if v is not None}
+        return {}
+
+    @staticmethod
+    def _entries(body) -> list:
+        if not isinstance(body, dict):
+            return []
+        if isinstance(body.get('outputs'), dict):
+            return [body]
+        return [v for v in body.values() if isinstance(v, dict) and isinstance(v.get('outputs'), dict)]
+
+
+class StabilityAdapter:
+    name = 'stability'
+
+    def matches(self, body) -> bool:
+        return isinstance(body, dict) and isinstance(body.get('artifacts'), list)
+
+    def images(self, body) -> list:
+        return [a['base64'] for a in self._artifacts(body) if _is_image(a.get('base64'))]
+
+    def metadata(self, body) -> dict:
+        artifacts = self._artifacts(body)
+        if not artifacts or 'seed' not in artifacts[0]:
+            return {}
+        return {'seed': artifacts[0]['seed']}
+
+    @staticmethod
+    def _artifacts(body) -> list:
+        return [a for a in body['artifacts'] if isinstance(a, dict) and a.get('finishReason') != 'ERROR']
+
+
+_adapters = [A1111Adapter(), ComfyUIAdapter(), StabilityAdapter()]
+
+
+def register(adapter, first: bool = False):
+    """Add an adapter (an object with ``name``, ``matches``, ``images`` and ``metadata``)."""
+    if first:
+        _adapters.insert(0, adapter)
+    else:
+        _adapters.append(adapter)
+    return adapter
+
+
+def adapter_names() -> list:
+    return [a.name for a in _adapters]
+
+
+def extract(body, adapter: str = None) -> Extracted:
+    """Images (base64 strings, :class:`SpilledBase64` or :class:`ImageRef`) and metadata of ``body``.
+
+    ``adapter`` forces one schema by name; by default the first matching one is used.
+    """
+    for candidate in _adapters:
+        if adapter and candidate.name != adapter:
+            continue
+        if candidate.matches(body):
+            images = candidate.images(body)
+            if images:
+                return Extracted(images, candidate.metadata(body), candidate.name)
+    return Extracted(scan_images(body), scan_metadata(body), 'generic')
+
+
+def _is_image(value) -> bool:
+    if isinstance(value, SpilledBase64):
+        return value.valid
+    return isinstance(value, str) and bool(value)
+
+
+def _pick(node) -> dict:
+    if not isinstance(node, dict):
+        return {}
+    return {k: node[k] for k in METADATA_KEYS if k in node}
+
+
+# generic fallback ------------------------------------------------------------
+
+def scan_images(node) -> list:
+    """Recursively search a JSON-like structure for base64 image strings.
+
+    Accepts 'data:image/png;base64,...' or raw base64 (heuristic: long and mostly base64 chars).
+    """
+    found = []
+    if node is None:
+        return found
+    if isinstance(node, SpilledBase64):
+        if node.valid:
+            found.append(node)
+        return found
+    if isinstance(node, str):
+        s = node.strip()
+        if s.startswith('data:image') and 'base64,' in s:
+            found.append(s)
+            return found
+        if len(s) > 800 and all(c.isalnum() or c in '+/=' for c in s[:200]):
+            found.append(s)
+            return found
+        return found
+    if isinstance(node, dict):
+        for k in ('images', 'image', 'result', 'outputs', 'artifacts', 'images_base64'):
+            if k in node:
+                return scan_images(node[k])
+        for v in node.values():
+            found.extend(scan_images(v))
+        return found
+    if isinstance(node, list):
+        for item in node:
+            found.extend(scan_images(item))
+        return found
+    return found
+
+
+def scan_metadata(node) -> dict:
+    """Collect seed/steps/sampler keys from anywhere in the response (first occurrence wins)."""
+    md = {}
+    if not node:
+        return md
+    if isinstance(node, dict):
+        for k in METADATA_KEYS:
+            if k in node:
+                md[k] = node[k]
+        # many SD frontends include parameters/info under 'info' or within nested dicts
+        for v in node.values():
+            if isinstance(v, (dict, list)):
+                nested = scan_metadata(v)
+                for kk, vv in nested.items():
+                    if kk not in md:
+                        md[kk] = vv
+    elif isinstance(node, list):
+        for item in node:
+            nested = scan_metadata(item)
+            for kk, vv in nested.items():
+                if kk not in md:
+                    md[kk] = vv
+    return md
@@ -107,6 +107,30 @@ function appendChat(role, text) {
   el.textContent = text
   log.appendChild(el)
   log.scrollTop = log.scrollHeight
+  return el
+}
+
+// Read a text/event-stream response, calling onEvent(name, data) for each event
+async function readEvents(res, onEvent) {
+  const reader = res.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+    let end
+    while ((end = buffer.indexOf('\n\n')) >= 0) {
+      const raw = buffer.slice(0, end)
+      buffer = buffer.slice(end + 2)
+      let name = 'message', data = ''
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) name = line.slice(6).trim()
+        else if (line.startsWith('data:')) data += line.slice(5).trim()
+      }
+      if (data) onEvent(name, JSON.parse(data))
+    }
+  }
 }
 
 async function sendChat(message) {
@@ -116,13 +140,28 @@ async function sendChat(message) {
   try {
     const res = await fetch('/api/chat', {
       method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify({ message, crystal: selectedCrystal })
+      headers: {'Content-Type': 'application/json', 'Accept': 'text/event-stream'},
+      body: JSON.stringify({ message, crystal: selectedCrystal, stream: true })
+    })
+    if (!(res.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+      const data = await res.json()
+      appendChat('bot', data.reply)
+      return
+    }
+    // render tokens as they arrive; the final event carries the whole reply
+    let bubble = null, text = ''
+    const log = document.getElementById('chatLog')
+    await readEvents(res, (name, data) => {
+      if (!bubble) {
+        typing.style.display = 'none'
+        bubble = appendChat('bot', '')
+      }
+      if (name === 'done') text = data.reply
+      else text += data.token
+      bubble.textContent = text
+      log.scrollTop = log.scrollHeight
     })
-    const data = await res.json()
-    // small delay to simulate composition
-    await new Promise(r => setTimeout(r, 350))
-    appendChat('bot', data.reply)
+    if (!bubble) appendChat('bot', 'The fortune teller is momentarily unavailable.')
   } catch (err) {
     appendChat('bot', 'The fortune teller is momentarily unavailable.')
   } finally {
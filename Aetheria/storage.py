@@ -0,0 +1,171 @@
+"""Background file removal and storage reconciliation for generated images.
+
+A gallery image lives in two places: a file in ``static/generated/`` and a
+row in the ``generated`` table. :class:`Unlinker` removes files on a
+background thread, one batch per call, so a request that deletes many
+images only waits for its transaction.
+
+:class:`Reconciler` finds where the two have drifted apart:
+
+- orphan files: images without a row (e.g. the process died between writing
+  the file and inserting its row)
+- missing files: rows whose image is gone
+
+It works in chunks. A pass first walks the directory, looking up each chunk
+of file names with one indexed ``IN`` query, then pages through the table by
+id and checks that each row's file exists. :meth:`Reconciler.step` handles a
+single chunk, so a background loop can spread a pass over time;
+:meth:`Reconciler.run` does a whole pass. Files younger than ``min_age_s``
+are never reported, as they may belong to a save that has not inserted its
+row yet.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Unlinker:
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='unlinker')
+
+    def submit(self, paths):
+        """Remove ``paths`` in the background; the future gives :meth:`unlink`'s counts.
+
+        Batches run one at a time in submission order.
+        """
+        return self._executor.submit(self.unlink, list(paths))
+
+    def unlink(self, paths) -> dict:
+        """Remove ``paths`` now; returns ``{'removed', 'missing', 'failed'}`` counts (failures are logged)."""
+        counts = {'removed': 0, 'missing': 0, 'failed': 0}
+        for path in paths:
+            try:
+                os.remove(path)
+                counts['removed'] += 1
+            except FileNotFoundError:
+                counts['missing'] += 1
+            except OSError:
+                logger.warning('Could not remove %s', path, exc_info=True)
+                counts['failed'] += 1
+        return counts
+
+
+class Reconciler:
+    def __init__(self, db, directory: str, delete_ids, unlinker: Unlinker,
+                 chunk_size: int = 500, min_age_s: float = 3600):
+        """``delete_ids(ids)`` deletes gallery rows (with everything derived from them);
+        ``unlinker`` removes orphan files."""
+        self.db = db
+        self.directory = directory
+        self.delete_ids = delete_ids
+        self.unlinker = unlinker
+        self.chunk_size = chunk_size
+        self.min_age_s = min_age_s
+        self._pass = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def step(self, repair: bool = False) -> dict:
+        """Check the next chunk of the running pass (starting a new pass after the last one).
+
+        Returns the chunk's report: ``phase`` (``files`` or ``rows``),
+        ``checked``, ``orphan_files`` (names), ``missing_files`` (row ids),
+        ``done`` (last chunk of the pass) and ``repaired``.
+        """
+        with self._lock:
+            report = next(self._pass, None) if self._pass is not None else None
+            if report is None:
+                self._pass = self._chunks()
+                report = next(self._pass)
+            if report['done']:
+                self._pass = None
+        return self._finish(report, repair)
+
+    def run(self, repair: bool = False) -> dict:
+        """One whole pass; returns ``files_checked``, ``rows_checked``, ``orphan_files``, ``missing_files``
+        and ``repaired``."""
+        totals = {'files_checked': 0, 'rows_checked': 0, 'orphan_files': [], 'missing_files': []}
+        for report in self._chunks():
+            self._finish(report, repair)
+            totals[report['phase'] + '_checked'] += report['checked']
+            totals['orphan_files'] += report['orphan_files']
+            totals['missing_files'] += report['missing_files']
+        totals['repaired'] = repair
+        return totals
+
+    def start(self, interval_s: float, repair: bool = False):
+        """Check one chunk every ``interval_s`` seconds on a daemon thread."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, args=(interval_s, repair),
+                                                name='storage-reconciler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, interval_s, repair):
+        while not self._stop.wait(interval_s):
+            try:
+                self.step(repair)
+            except Exception:
+                logger.exception('Storage reconciliation step failed')
+
+    def _chunks(self):
+        with os.scandir(self.directory) as entries:
+            batch = []
+            for entry in entries:
+                # skips thumbs/ and the streaming parser's .spill-* temp files
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                batch.append(entry)
+                if len(batch) == self.chunk_size:
+                    yield self._check_files(batch)
+                    batch = []
+            if batch:
+                yield self._check_files(batch)
+        last_id = 0
+        while True:
+            rows = self.db.query('SELECT id, filename FROM generated WHERE id > ? ORDER BY id LIMIT ?',
+                                 (last_id, self.chunk_size))
+            missing = [gid for gid, fname in rows if not os.path.exists(os.path.join(self.directory, fname))]
+            done = len(rows) < self.chunk_size
+            yield {'phase': 'rows', 'checked': len(rows), 'orphan_files': [], 'missing_files': missing, 'done': done}
+            if done:
+                return
+            last_id = rows[-1][0]
+
+    def _check_files(self, entries) -> dict:
+        names = [e.name for e in entries]
+        marks = ','.join('?' * len(names))
+        known = {fname for (fname,) in self.db.query(
+            f'SELECT filename FROM generated WHERE filename IN ({marks})', names)}
+        cutoff = time.time() - self.min_age_s
+        orphans = []
+        for entry in entries:
+            if entry.name in known:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    orphans.append(entry.name)
+            except FileNotFoundError:
+                pass  # removed since the directory was read
+        return {'phase': 'files', 'checked': len(names), 'orphan_files': orphans, 'missing_files': [], 'done': False}
+
+    def _finish(self, report, repair):
+        if report['orphan_files'] or report['missing_files']:
+            logger.info('Storage reconciler: %d orphan files, %d rows without a file%s',
+                        len(report['orphan_files']), len(report['missing_files']), ' (repairing)' if repair else '')
+        if repair:
+            if report['orphan_files']:
+                self.unlinker.submit(os.path.join(self.directory, name) for name in report['orphan_files'])
+            if report['missing_files']:
+                self.delete_ids(report['missing_files'])
+        report['repaired'] = repair
+        return report
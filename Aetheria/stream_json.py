@@ -0,0 +1,242 @@
+"""Incremental JSON parsing for large Stable Diffusion responses.
+
+txt2img responses carry every image as a multi-megabyte base64 string.
+:class:`StreamingJSONParser` consumes the body chunk by chunk and rebuilds
+the JSON document, except that string values longer than
+``spill_threshold`` are base64-decoded on the fly into a temp file and
+replaced by a :class:`SpilledBase64` handle. Peak memory therefore stays
+around one network chunk per image, whatever the resolution or ``samples``.
+
+The parser is lenient about separators (``,`` / ``:``) since it only ever
+reads backend responses; it does not try to validate them.
+"""
+import base64
+import binascii
+import codecs
+import json
+import os
+import re
+import tempfile
+import uuid
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_WHITESPACE = ' \t\r\n'
+_BASE64_JUNK = re.compile(r'\s+')
+
+
+class SpilledBase64:
+    """A large base64 string value, decoded to a temp file while parsing."""
+
+    def __init__(self, spill_dir=None):
+        # created like open() would (0666 less the umask) rather than mkstemp's 0600, as the
+        # file is moved into place as a served image
+        self.path = os.path.join(spill_dir or tempfile.gettempdir(), f'.spill-{uuid.uuid4().hex}.bin')
+        self._file = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), 'wb')
+        self._pending = ''
+        self._started = False
+        self.header = ''
+        self.size = 0
+        self.valid = True
+        self.moved = False
+
+    def feed(self, text: str):
+        if not self.valid:
+            return
+        if not self._started:
+            text = self._pending + text
+            if text.startswith('data:') and ',' not in text:
+                self._pending = text  # header split across chunks
+                return
+            self._started = True
+            self._pending = ''
+            if text.startswith('data:'):
+                self.header, text = text.split(',', 1)
+                self.header += ','
+        text = self._pending + _BASE64_JUNK.sub('', text)
+        usable = len(text) - len(text) % 4
+        try:
+            data = base64.b64decode(text[:usable], validate=True)
+        except binascii.Error:
+            # not an image after all (e.g. a long text field); drop its content
+            self.discard()
+            return
+        self._file.write(data)
+        self.size += len(data)
+        self._pending = text[usable:]
+
+    def close(self):
+        if not self.valid:
+            return
+        if self._pending:
+            self.discard()  # truncated base64, or a data: header without payload
+            return
+        self._file.close()
+
+    def move_to(self, dest: str):
+        """Rename the decoded file to ``dest`` (same filesystem, so no copy)."""
+        os.replace(self.path, dest)
+        self.path, self.moved = dest, True
+
+    def discard(self):
+        """Delete the temp file unless it was moved into place."""
+        if self.moved:
+            return
+        self.valid = False
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return f'<SpilledBase64 {self.size} bytes{"" if self.valid else " (discarded)"}>'
+
+
+class StreamingJSONParser:
+    def __init__(self, spill_threshold: int = 64 * 1024, spill_dir=None):
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self._stack = []            # frames: [container, pending_key]
+        self._root = None
+        self._done = False
+        self._carry = ''            # incomplete escape sequence
+        self._in_string = False
+        self._parts = []
+        self._length = 0
+        self._spill = None
+        self._literal = None
+
+    def feed(self, text: str):
+        text = self._carry + text
+        self._carry = ''
+        pos, end = 0, len(text)
+        while pos < end:
+            if self._in_string:
+                pos = self._read_string(text, pos)
+                continue
+            ch = text[pos]
+            if self._literal is not None:
+                if ch in ',]}' or ch in _WHITESPACE:
+                    literal, self._literal = self._literal, None
+                    self._emit(json.loads(literal))
+                    continue
+                self._literal += ch
+            elif ch == '"':
+                self._in_string = True
+                self._parts, self._length, self._spill = [], 0, None
+            elif ch == '{':
+                self._open({})
+            elif ch == '[':
+                self._open([])
+            elif ch in '}]':
+                container, _ = self._stack.pop()
+                self._emit(container, opened=True)
+            elif ch in _WHITESPACE or ch in ',:':
+                pass
+            else:
+                self._literal = ch
+            pos += 1
+
+    def close(self):
+        if self._literal is not None:
+            literal, self._literal = self._literal, None
+            self._emit(json.loads(literal))
+        if self._in_string or self._stack or self._carry or not self._done:
+            for spilled in iter_spilled(self._root):
+                spilled.discard()
+            raise ValueError('truncated JSON document')
+        return self._root
+
+    def _read_string(self, text, pos):
+        match = _STRING_SPECIAL.search(text, pos)
+        stop = match.start() if match else len(text)
+        if stop > pos:
+            self._append(text[pos:stop])
+        if not match:
+            return len(text)
+        if text[stop] == '"':
+            self._finish_string()
+            return stop + 1
+        # escape sequence
+        size = 6 if text[stop + 1:stop + 2] == 'u' else 2
+        if size == 6 and text[stop + 2:stop + 4].lower() in ('d8', 'd9', 'da', 'db'):
+            size = 12  # surrogate pair
+        if stop + size > len(text):
+            self._carry = text[stop:]
+            return len(text)
+        self._append(json.loads('"' + text[stop:stop + size] + '"'))
+        return stop + size
+
+    def _append(self, segment):
+        if self._spill is not None:
+            self._spill.feed(segment)
+            return
+        self._parts.append(segment)
+        self._length += len(segment)
+        if self._length > self.spill_threshold and not self._is_key():
+            self._spill = SpilledBase64(self.spill_dir)
+            self._spill.feed(''.join(self._parts))
+            self._parts = []
+
+    def _finish_string(self):
+        self._in_string = False
+        if self._spill is not None:
+            self._spill.close()
+            value, self._spill = self._spill, None
+        else:
+            value = ''.join(self._parts)
+        self._parts = []
+        self._emit(value)
+
+    def _is_key(self):
+        return bool(self._stack) and isinstance(self._stack[-1][0], dict) and self._stack[-1][1] is None
+
+    def _open(self, container):
+        self._stack.append([container, None])
+
+    def _emit(self, value, opened=False):
+        if not self._stack:
+            self._root, self._done = value, True
+            return
+        frame = self._stack[-1]
+        if isinstance(frame[0], list):
+            frame[0].append(value)
+        elif frame[1] is None and not opened and isinstance(value, str):
+            frame[1] = value
+        else:
+            frame[0][frame[1]] = value
+            frame[1] = None
+
+
+def parse_response(response, chunk_size: int = 64 * 1024, **kwargs):
+    """Parse a ``stream=True`` requests response with :class:`StreamingJSONParser`."""
+    parser = StreamingJSONParser(**kwargs)
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    return parser.close()
+
+
+def iter_spilled(node):
+    """Yield every :class:`SpilledBase64` in a parsed document."""
+    if isinstance(node, SpilledBase64):
+        yield node
+    elif isinstance(node, dict):
+        for v in node.values():
+            yield from iter_spilled(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from iter_spilled(v)
+
+
+def jsonable(node):
+    """Copy of a parsed document with spilled strings replaced by a short description."""
+    if isinstance(node, SpilledBase64):
+        return f'<base64 image, {node.size} bytes>' if node.valid else '<omitted large string>'
+    if isinstance(node, dict):
+        return {k: jsonable(v) for k, v in node.items()}
+    if isinstance(node, list):
+        return [jsonable(v) for v in node]
+    return node
@@ -1,5 +1,7 @@
 import json
+import os
 from app import create_app
+from fake_backends import FakeSD
 
 
 def test_cards_endpoint():
@@ -21,3 +23,592 @@ def test_chat_endpoint():
     assert resp.status_code == 200
     data = resp.get_json()
     assert 'reply' in data
+
+
+def _generated_path(app, url):
+    """Where a ``/static/generated/...`` url is stored (GENERATED_DIR, a tmp dir under the tests)."""
+    return os.path.join(app.config['GENERATED_DIR'], url.split('/static/generated/', 1)[1])
+
+
+def test_generate_caches_fixed_seed_requests(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    sd = FakeSD(latency_s=0.2)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    try:
+        body = {'prompt': 'a silver moon', 'seed': 42}
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: app.test_client().post('/api/generate', json=body).get_json(), range(4)))
+        # concurrent identical requests collapse into one backend call
+        assert len(sd.payloads) == 1
+        assert len({r['images'][0]['url'] for r in results}) == 1
+        assert results[0]['meta']['seed'] == 42
+
+        client = app.test_client()
+        again = client.post('/api/generate', json=body).get_json()
+        assert again['cached'] is True and len(sd.payloads) == 1
+
+        # without a fixed seed every request goes to the backend
+        client.post('/api/generate', json={'prompt': 'a silver moon'})
+        assert len(sd.payloads) == 2
+    finally:
+        sd.close()
+
+
+def test_generated_listing_is_cursor_paginated(tmp_path):
+    import sqlite3
+
+    db_path = str(tmp_path / 'test.db')
+    app = create_app({'DATABASE': db_path})
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)',
+                     [(f'img-{i}.png', f'p{i}', 'ruby' if i % 2 else 'jade', f'2025-01-{i + 1:02d}T00:00:00')
+                      for i in range(7)])
+    conn.commit()
+    conn.close()
+    client = app.test_client()
+
+    page = client.get('/api/generated?limit=3').get_json()
+    assert [it['id'] for it in page['items']] == [7, 6, 5]
+    page = client.get(f"/api/generated?limit=3&cursor={page['next_cursor']}").get_json()
+    assert [it['id'] for it in page['items']] == [4, 3, 2]
+    page = client.get(f"/api/generated?limit=3&cursor={page['next_cursor']}").get_json()
+    assert [it['id'] for it in page['items']] == [1]
+    assert page['next_cursor'] is None
+
+    ruby = client.get('/api/generated?crystal=ruby&since=2025-01-03').get_json()
+    assert [it['id'] for it in ruby['items']] == [6, 4]
+    assert client.get('/api/generated/count?crystal=ruby').get_json() == {'count': 3}
+    assert client.get('/api/generated?since=yesterday').status_code == 400
+
+
+def test_database_batches_concurrent_inserts(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    db = app.extensions['db']
+    with ThreadPoolExecutor(8) as pool:
+        ids = list(pool.map(lambda i: db.insert_generated(f'img-{i}.png', 'p', 'ruby', '2025-01-01T00:00:00'),
+                            range(40)))
+    assert sorted(ids) == list(range(1, 41))
+    assert db.query_one('PRAGMA journal_mode')[0] == 'wal'
+
+    client = app.test_client()
+    assert client.get('/api/generated/count').get_json() == {'count': 40}
+    stats = client.get('/api/db/stats').get_json()['statements']
+    insert = stats['INSERT INTO generated (filename, prompt, crystal, created_at) VALUES (?,?,?,?)']
+    assert insert['count'] == 40
+
+
+def test_generate_streams_large_sd_responses(tmp_path, monkeypatch):
+    import os
+
+    sd = FakeSD(images=3, image_bytes=300 * 1024)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'SD_STREAM_RESPONSES': True})
+    client = app.test_client()
+    generated_dir = app.config['GENERATED_DIR']
+    try:
+        out = client.post('/api/generate', json={'prompt': 'stars', 'debug': True}).get_json()
+        assert len(out['images']) == 3
+        for img in out['images']:
+            with open(_generated_path(app, img['url']), 'rb') as f:
+                assert f.read() == sd.png
+        assert out['sd_response']['images'][0].startswith('<base64 image')
+
+        # batch mode keeps only the first image; the other spilled files are removed
+        client.post('/api/generate', json={'prompts': ['moon']})
+        assert not [f for f in os.listdir(generated_dir) if f.startswith('.spill-')]
+        assert client.get('/api/generated/count').get_json() == {'count': 4}
+    finally:
+        sd.close()
+
+
+def test_gallery_thumbnails(tmp_path):
+    import io
+    import os
+    import uuid
+    from PIL import Image
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    fname = f'test-{uuid.uuid4().hex}.png'
+    Image.new('RGB', (800, 1200), (90, 40, 160)).save(os.path.join(app.config['GENERATED_DIR'], fname))
+    gid = app.extensions['db'].insert_generated(fname, 'p', 'ruby', '2025-01-01T00:00:00')
+
+    item = client.get('/api/generated').get_json()['items'][0]
+    assert [t['url'] for t in item['thumbnails']] == [f'/api/generated/{gid}/thumb/{w}' for w in (160, 320, 640)]
+
+    # first request builds every size, later listings point at the static files
+    resp = client.get(f'/api/generated/{gid}/thumb/320')
+    assert resp.status_code == 200
+    assert Image.open(io.BytesIO(resp.data)).size == (320, 480)
+    assert client.get(f'/api/generated/{gid}/thumb/100').status_code == 404
+    urls = [t['url'] for t in client.get('/api/generated').get_json()['items'][0]['thumbnails']]
+    assert all(u.startswith('/static/generated/thumbs/') for u in urls)
+    paths = [_generated_path(app, u) for u in urls]
+    assert all(os.path.exists(p) for p in paths)
+
+    client.delete(f'/api/generated/{gid}')
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_gallery_api_is_revalidated_with_etags(tmp_path):
+    import os
+    import uuid
+    from PIL import Image
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    first = client.get('/api/generated')
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'no-cache' and first.headers['Last-Modified']
+    assert client.get('/api/generated', headers={'If-None-Match': etag}).status_code == 304
+    count_etag = client.get('/api/generated/count').headers['ETag']
+    assert client.get('/api/generated/count', headers={'If-None-Match': count_etag}).status_code == 304
+
+    fname = f'test-{uuid.uuid4().hex}.png'
+    Image.new('RGB', (200, 300), (90, 40, 160)).save(os.path.join(app.config['GENERATED_DIR'], fname))
+    gid = app.extensions['db'].insert_generated(fname, 'p', 'ruby', '2025-01-01T00:00:00')
+    changed = client.get('/api/generated', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.get_json()['items'][0]['id'] == gid
+
+    # generated files are immutable; building thumbnails changes the listing again
+    thumb = client.get(f'/api/generated/{gid}/thumb/160')
+    assert thumb.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert client.get('/api/generated', headers={'If-None-Match': changed.headers['ETag']}).status_code == 200
+    image = client.get(f'/static/generated/{fname}')
+    assert image.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    thumb.close()
+    image.close()
+    client.delete(f'/api/generated/{gid}')
+
+
+def test_batch_prompts_fan_out_concurrently(tmp_path, monkeypatch):
+    import time
+
+    sd = FakeSD(latency_s=0.3)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'SD_MAX_CONCURRENCY': 3})
+    client = app.test_client()
+    try:
+        prompts = ['moon', 'sun', 'moon', 'star', 'moon', 'tower']
+        start = time.monotonic()
+        out = client.post('/api/generate', json={'prompts': prompts}).get_json()
+        elapsed = time.monotonic() - start
+
+        assert [r['prompt'] for r in out['results']] == prompts
+        assert len({r['image'] for r in out['results']}) == len(prompts)
+        # the three 'moon' prompts became one native batch: 4 backend calls, at most 3 at a time
+        assert sorted(r.get('batch_size', 1) for r in sd.payloads) == [1, 1, 1, 3]
+        assert sd.max_in_flight == 3
+        assert elapsed < 0.9  # two waves of 0.3s instead of six
+
+        # fixed seeds are not batched (each prompt stays individually cacheable)
+        client.post('/api/generate', json={'prompts': ['moon', 'moon'], 'seed': 7})
+        assert [r.get('batch_size', 1) for r in sd.payloads[4:]] == [1]
+    finally:
+        sd.close()
+
+
+def test_batch_jobs_save_the_generated_images_not_grids_or_extras(tmp_path, monkeypatch):
+    import os
+
+    sd = FakeSD(grid=True, extras=1, image_bytes=32)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    try:
+        out = client.post('/api/generate', json={'prompts': ['moon', 'moon', 'sun']}).get_json()
+        # 'moon' was one native batch (grid first, detect map last); 'sun' a single image plus its map
+        assert sorted(r.get('batch_size', 1) for r in sd.payloads) == [1, 2]
+        for r in out['results']:
+            with open(_generated_path(app, r['image']), 'rb') as f:
+                assert f.read() == sd.png
+        assert 'index_of_first_image' not in out['results'][0]['meta']
+    finally:
+        sd.close()
+
+
+def test_sd_requests_are_balanced_across_backends(tmp_path, monkeypatch):
+    import socket
+
+    nodes = [FakeSD(latency_s=0.2), FakeSD(latency_s=0.2)]
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        dead = f'http://127.0.0.1:{sock.getsockname()[1]}/sdapi/v1/txt2img'  # nothing listens here
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URLS', ','.join([nodes[0].url, dead, nodes[1].url]))
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'SD_FAILURE_THRESHOLD': 1, 'SD_PROBE_INTERVAL': 0})
+    client = app.test_client()
+    try:
+        out = client.post('/api/generate', json={'prompts': ['a', 'b', 'c', 'd', 'e', 'f']}).get_json()
+        assert all('image' in r for r in out['results'])
+        # least-outstanding routing spreads the batch; the dead node is retried elsewhere and ejected
+        assert len(nodes[0].payloads) == len(nodes[1].payloads) == 3
+        stats = {n['url']: n for n in client.get('/api/backends').get_json()['sd']['nodes']}
+        assert stats[dead]['state'] == 'open' and stats[dead]['errors'] == 1
+        assert stats[nodes[0].url]['requests'] == 3 and stats[nodes[0].url]['outstanding'] == 0
+
+        app.extensions['sd_pool'].probe_once()
+        stats = {n['url']: n for n in client.get('/api/backends').get_json()['sd']['nodes']}
+        assert stats[dead]['healthy'] is False and stats[nodes[1].url]['queue_depth'] == 0
+    finally:
+        for node in nodes:
+            node.close()
+
+
+def test_metrics_cover_generate_stages(tmp_path, monkeypatch):
+    from metrics import BACKEND_SUBMIT, GENERATE_TOTAL
+
+    sd = FakeSD()
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = app.test_client()
+    succeeded = GENERATE_TOTAL.value(result='success')
+    submitted = BACKEND_SUBMIT.snapshot(backend='sd')['count']
+    try:
+        assert client.post('/api/generate', json={'prompt': 'metrics'}).get_json()['images']
+        resp = client.get('/metrics')
+        assert resp.content_type == 'text/plain; version=0.0.4; charset=utf-8'
+        text = resp.get_data(as_text=True)
+        for sample in ('aetheria_backend_download_seconds_count{backend="sd"}', 'aetheria_disk_write_seconds_count',
+                       'aetheria_sqlite_statement_seconds_count{op="insert"}', 'aetheria_generations_in_flight 0'):
+            assert sample in text
+        assert GENERATE_TOTAL.value(result='success') == succeeded + 1
+        assert BACKEND_SUBMIT.snapshot(backend='sd')['count'] == submitted + 1
+    finally:
+        sd.close()
+
+
+def test_generate_reports_stage_spans(tmp_path, monkeypatch):
+    sd = FakeSD()
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'SERVER_TIMING': True,
+                      'PROFILE_REQUESTS': 'header', 'PROFILE_DIR': str(tmp_path / 'profiles')})
+    client = app.test_client()
+    try:
+        resp = client.post('/api/generate', json={'prompt': 'spans'}, headers={'X-Profile': '1'})
+        assert resp.get_json()['images']
+        stages = [entry.split(';')[0] for entry in resp.headers['Server-Timing'].split(', ')]
+        for stage in ('sd.submit', 'sd.download', 'extract', 'save_base64_image', 'txt2img', 'request'):
+            assert stage in stages
+        assert (tmp_path / 'profiles' / f"{resp.headers['X-Request-ID']}.prof").exists()
+    finally:
+        sd.close()
+
+
+def test_async_generate_keeps_the_json_contract(tmp_path, monkeypatch):
+    import asyncio
+    import time
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from async_http import aclose_client
+
+    sd = FakeSD(latency_s=0.3)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db'), 'SD_MAX_CONCURRENCY': 3})
+    sync_body = asgi.flask_app.test_client().post('/api/generate', json={'prompt': 'moon', 'seed': 5}).get_json()
+
+    async def run():
+        try:
+            single = await request(asgi, 'POST', '/api/generate', json={'prompt': 'moon', 'seed': 6})
+            cached = await request(asgi, 'POST', '/api/generate', json={'prompt': 'moon', 'seed': 6})
+            start = time.perf_counter()
+            batch = await request(asgi, 'POST', '/api/generate',
+                                  json={'prompts': ['a', 'b', 'c', 'd', 'e', 'f'], 'seed': 1})
+            elapsed = time.perf_counter() - start
+            listing = await request(asgi, 'GET', '/api/generated/count')  # served by Flask
+            return single, cached, batch, elapsed, listing
+        finally:
+            await aclose_client()
+
+    try:
+        single, cached, batch, elapsed, listing = asyncio.run(run())
+        status, headers, body = single
+        body = json.loads(body)
+        assert status == 200 and headers['content-type'] == 'application/json' and 'x-request-id' in headers
+        assert sorted(body) == sorted(sync_body) and body['images'][0]['url'].startswith('/static/generated/sd0-')
+        assert json.loads(cached[2])['cached'] is True and len(sd.payloads) == 2 + 6
+        # six prompts in flight on the event loop, at most three at a time on the backend
+        results = json.loads(batch[2])['results']
+        assert [r['prompt'] for r in results] == ['a', 'b', 'c', 'd', 'e', 'f']
+        assert sd.max_in_flight == 3 and elapsed < 0.9
+        assert json.loads(listing[2])['count'] == 8
+    finally:
+        sd.close()
+
+
+def test_async_chat_awaits_the_completion_api(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from app import create_asgi_app
+    from asgi_bridge import request
+
+    calls = []
+
+    class Completions(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            calls.append((self.path, self.headers['Authorization'],
+                          json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+            body = json.dumps({'choices': [{'text': '  The stars lean your way.  '}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Completions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_BASE', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db')})
+    try:
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'Will I travel?'}))
+        assert status == 200 and json.loads(body) == {'reply': 'The stars lean your way.'}
+        path, auth, payload = calls[0]
+        assert path == '/v1/completions' and auth == 'Bearer sk-test' and 'Will I travel?' in payload['prompt']
+    finally:
+        server.shutdown()
+        server.server_close()
+    # unreachable API: the local responder answers
+    monkeypatch.setenv('OPENAI_API_BASE', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'love?'}))
+    assert json.loads(body) == {'reply': 'Love is in flux — honest communication will guide you.'}
+
+
+def test_card_readings_are_seeded_and_batched(tmp_path):
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'CARDS_BATCH_MAX': 5000})
+    client = app.test_client()
+
+    first = client.post('/api/cards', json={'reading': 'three', 'seed': 11}).get_json()
+    again = client.post('/api/cards', json={'reading': 'three', 'seed': 11}).get_json()
+    assert first['seed'] == 11 and first['cards'] == again['cards']
+    assert [c['position'] for c in first['cards']] == ['Past', 'Present', 'Future']
+    assert client.post('/api/cards', json={'seed': 'x'}).status_code == 400
+
+    resp = client.post('/api/cards/batch', json={'reading': 'five', 'count': 5000, 'seed': 1})
+    body = resp.get_json()
+    assert resp.status_code == 200 and len(body['draws']) == 5000 and len(body['reversed'][0]) == 5
+    assert len(body['deck']) == 78 and sum(body['frequencies']) == 25000
+    assert client.post('/api/cards/batch', json={'reading': 'five', 'count': 5001}).status_code == 400
+    assert client.post('/api/cards/batch', json={'reading': 'nope'}).status_code == 400
+
+
+def _sse_events(body):
+    events = []
+    for raw in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in raw.split('\n'))
+        events.append((lines.get('event', 'message'), json.loads(lines['data'])))
+    return events
+
+
+def test_chat_streams_tokens_with_deadlines(tmp_path, monkeypatch):
+    import asyncio
+    import time
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from fake_backends import FakeCompletions
+
+    slow_tokens = FakeCompletions(token_delay_s=0.1)
+    no_first_token = FakeCompletions(latency_s=2.0)
+    stalls = FakeCompletions(stall_after=2, stall_s=2.0)
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db'), 'CHAT_READ_TIMEOUT': 0.3})
+    client = asgi.flask_app.test_client()
+    try:
+        # the first token is sent before the rest of the completion exists
+        monkeypatch.setenv('OPENAI_API_BASE', slow_tokens.url)
+        start = time.perf_counter()
+        resp = client.post('/api/chat', json={'message': 'Will I travel?', 'stream': True}, buffered=False)
+        chunks = resp.response
+        first = next(chunks)
+        first_byte = time.perf_counter() - start
+        body = (first + b''.join(chunks)).decode()
+        total = time.perf_counter() - start
+        assert resp.mimetype == 'text/event-stream'
+        assert first_byte < 0.1 < 0.4 < total
+        events = _sse_events(body)
+        assert ''.join(e['token'] for _, e in events[:-1]) == 'The stars lean your way tonight.'
+        assert events[-1] == ('done', {'reply': 'The stars lean your way tonight.', 'source': 'openai'})
+        assert slow_tokens.payloads[0]['stream'] is True and slow_tokens.payloads[0]['authorization'] == 'Bearer sk-test'
+
+        # no first token within CHAT_READ_TIMEOUT: the local responder answers
+        monkeypatch.setenv('OPENAI_API_BASE', no_first_token.url)
+        start = time.perf_counter()
+        events = _sse_events(client.post('/api/chat', json={'message': 'love?', 'stream': True}).get_data(as_text=True))
+        assert time.perf_counter() - start < 1.0
+        assert events[-1] == ('done', {'reply': 'Love is in flux — honest communication will guide you.',
+                                       'source': 'local'})
+
+        # the upstream stalls mid-reply: what arrived is kept and marked truncated
+        monkeypatch.setenv('OPENAI_API_BASE', stalls.url)
+        events = _sse_events(client.post('/api/chat', json={'message': 'x', 'stream': True}).get_data(as_text=True))
+        assert events[-1] == ('done', {'reply': 'The stars', 'source': 'openai', 'truncated': True})
+
+        # async serving mode streams the same events
+        monkeypatch.setenv('OPENAI_API_BASE', slow_tokens.url)
+        status, headers, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'x', 'stream': True}))
+        assert status == 200 and headers['content-type'] == 'text/event-stream'
+        assert _sse_events(body.decode())[-1] == ('done', {'reply': 'The stars lean your way tonight.',
+                                                           'source': 'openai'})
+        monkeypatch.setenv('OPENAI_API_BASE', no_first_token.url)
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'love?', 'stream': True}))
+        assert _sse_events(body.decode())[-1][1]['source'] == 'local'
+    finally:
+        for fake in (slow_tokens, no_first_token, stalls):
+            fake.close()
+
+
+def test_chat_deadline_cuts_a_stalled_stream_short(monkeypatch):
+    import asyncio
+    import time
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from fake_backends import FakeCompletions
+
+    stalls = FakeCompletions(stall_after=2, stall_s=3.0)
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_BASE', stalls.url)
+    # the stall is well within the read timeout; only the whole-reply deadline can end it
+    asgi = create_asgi_app({'CHAT_READ_TIMEOUT': 5, 'CHAT_DEADLINE': 0.5, 'CHAT_CACHE': False})
+    truncated = ('done', {'reply': 'The stars', 'source': 'openai', 'truncated': True})
+    try:
+        start = time.perf_counter()
+        body = asgi.flask_app.test_client().post('/api/chat', json={'message': 'x', 'stream': True})
+        assert _sse_events(body.get_data(as_text=True))[-1] == truncated
+        assert time.perf_counter() - start < 1.5
+
+        start = time.perf_counter()
+        _, _, body = asyncio.run(request(asgi, 'POST', '/api/chat', json={'message': 'x', 'stream': True}))
+        assert _sse_events(body.decode())[-1] == truncated
+        assert time.perf_counter() - start < 1.5
+    finally:
+        stalls.close()
+
+
+def test_repeated_questions_are_served_from_the_reply_cache(tmp_path, monkeypatch):
+    import asyncio
+    from app import create_asgi_app
+    from asgi_bridge import request
+    from fake_backends import FakeCompletions
+
+    fake = FakeCompletions()
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_API_BASE', fake.url)
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db')})
+    client = asgi.flask_app.test_client()
+    try:
+        first = client.post('/api/chat', json={'message': 'Will I travel?', 'crystal': 'Amethyst', 'stream': True})
+        assert _sse_events(first.get_data(as_text=True))[-1][1]['source'] == 'openai'
+        # cached once the stream has completed
+        again = client.post('/api/chat', json={'message': 'will i TRAVEL', 'crystal': 'amethyst', 'stream': True})
+        assert _sse_events(again.get_data(as_text=True))[-1] == (
+            'done', {'reply': 'The stars lean your way tonight.', 'source': 'cache'})
+        # the async handlers share the cache
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/chat',
+                                              json={'message': 'Will I travel', 'crystal': 'amethyst'}))
+        assert json.loads(body) == {'reply': 'The stars lean your way tonight.'}
+        assert fake.requests == 1
+        # another crystal is another question
+        client.post('/api/chat', json={'message': 'Will I travel?', 'crystal': 'rose', 'stream': True}).get_data()
+        assert fake.requests == 2
+        assert asgi.flask_app.extensions['chat_cache'].info()['entries'] == 2
+    finally:
+        fake.close()
+
+
+def test_generated_images_are_deleted_in_bulk_and_reconciled(tmp_path):
+    import os
+    import time
+    import uuid
+    from PIL import Image
+
+    app = create_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False})
+    client = app.test_client()
+    db = app.extensions['db']
+    generated_dir = app.config['GENERATED_DIR']
+    assert generated_dir.startswith(str(tmp_path))  # not the tracked static/generated
+    paths, ids = [], []
+    for _ in range(3):
+        fname = f'test-{uuid.uuid4().hex}.png'
+        paths.append(os.path.join(generated_dir, fname))
+        Image.new('RGB', (200, 300), (90, 40, 160)).save(paths[-1])
+        ids.append(db.insert_generated(fname, 'p', 'ruby', '2025-01-01T00:00:00'))
+    assert client.get(f'/api/generated/{ids[0]}/thumb/160').status_code == 200
+    thumb_paths = [os.path.join(generated_dir, 'thumbs', f) for (f,) in db.query('SELECT filename FROM generated_thumbs')]
+
+    assert client.post('/api/generated/delete', json={'ids': 'all'}).status_code == 400
+    resp = client.post('/api/generated/delete', json={'ids': [ids[0], ids[1], 424242]})
+    assert resp.get_json() == {'deleted': [ids[0], ids[1]], 'missing': [424242]}
+    app.extensions['unlinker'].submit(()).result()  # batches run in order
+    assert [os.path.exists(p) for p in paths] == [False, False, True]
+    assert thumb_paths and not any(os.path.exists(p) for p in thumb_paths)
+
+    # an image whose row was never written (old enough not to be a save in progress) and a row without its image
+    orphan = os.path.join(generated_dir, f'test-{uuid.uuid4().hex}.png')
+    Image.new('RGB', (8, 8)).save(orphan)
+    os.utime(orphan, (time.time() - 7200,) * 2)
+    os.remove(paths[2])
+    report = client.post('/api/generated/reconcile').get_json()
+    assert report['orphan_files'] == [os.path.basename(orphan)] and report['missing_files'] == [ids[2]]
+    assert report['repaired'] is False and os.path.exists(orphan)
+    assert client.delete(f'/api/generated/{ids[2]}').get_json() == {'deleted': ids[2]}
+
+
+def test_referenced_images_are_streamed_from_their_backend(tmp_path, monkeypatch):
+    import asyncio
+    import os
+    from app import create_asgi_app
+    from asgi_bridge import request
+
+    sd = FakeSD(comfyui=True, image_bytes=256 * 1024)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    asgi = create_asgi_app({'DATABASE': str(tmp_path / 'test.db'), 'THUMBNAILS_ON_SAVE': False,
+                            'GENERATION_CACHE': False})
+    app = asgi.flask_app
+    try:
+        urls = [app.test_client().post('/api/generate', json={'prompt': 'moon'}).get_json()['images'][0]['url']]
+        status, _, body = asyncio.run(request(asgi, 'POST', '/api/generate', json={'prompt': 'moon'}))
+        urls.append(json.loads(body)['images'][0]['url'])
+        assert sd.views == 2
+        for url in urls:
+            with open(_generated_path(app, url), 'rb') as f:
+                assert f.read() == sd.png
+        # the downloads ran as calls on the backend that rendered the images
+        assert app.extensions['sd_pool'].stats()['nodes'][0]['requests'] == 4
+    finally:
+        sd.close()
+
+
+def test_failed_image_fetches_count_against_the_backend(tmp_path, monkeypatch):
+    import asyncio
+    from app import create_asgi_app
+    from asgi_bridge import request
+
+    sd = FakeSD(comfyui=True, image_bytes=32, view_status=503)
+    monkeypatch.setenv('USE_SD', 'true')
+    monkeypatch.setenv('LOCAL_SD_URL', sd.url)
+    asgi = create_asgi_app({'THUMBNAILS_ON_SAVE': False, 'GENERATION_CACHE': False, 'SD_FAILURE_THRESHOLD': 10})
+    pool = asgi.flask_app.extensions['sd_pool']
+    try:
+        assert not asgi.flask_app.test_client().post('/api/generate', json={'prompt': 'moon'}).get_json().get('images')
+        assert pool.stats()['nodes'][0]['errors'] == 1
+        _, _, body = asyncio.run(request(asgi, 'POST', '/api/generate', json={'prompt': 'moon'}))
+        assert not json.loads(body).get('images')
+        # the async fetch marks the lease failed like the sync one
+        assert sd.views == 2 and pool.stats()['nodes'][0]['errors'] == 2
+    finally:
+        sd.close()
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from async_http import AsyncHTTPClient, ConnectError, HTTPStatusError
+
+
+@pytest.fixture
+def server():
+    connections = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_GET(self):
+            if self.path == '/chunked':
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for part in (b'hello ', b'chunked ', b'world'):
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+                self.wfile.write(b'0\r\n\r\n')
+            elif self.path == '/gone':
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif self.path == '/slow':
+                import time
+                time.sleep(0.5)
+                self.send_response(204)
+                self.end_headers()
+            else:
+                body = json.dumps({'path': self.path}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(201)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Content-Type', self.headers['Content-Type'])
+            self.end_headers()
+            self.wfile.write(body)
+
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    srv.connections = connections
+    srv.origin = f'http://127.0.0.1:{srv.server_address[1]}'
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_requests_reuse_keep_alive_connections(server):
+    async def run():
+        client = AsyncHTTPClient()
+        try:
+            first = await client.get(f'{server.origin}/a?x=1')
+            echoed = await client.post(f'{server.origin}/b', json={'moon': 'full'})
+            chunked = await client.get(f'{server.origin}/chunked')
+            with await client.download_to_tempfile(f'{server.origin}/chunked') as f:
+                downloaded = f.read()
+            return first, echoed, chunked, downloaded
+        finally:
+            await client.aclose()
+
+    first, echoed, chunked, downloaded = asyncio.run(run())
+    assert first.status_code == 200 and first.json() == {'path': '/a?x=1'}
+    assert echoed.status_code == 201 and echoed.json() == {'moon': 'full'}
+    assert echoed.headers['content-type'] == 'application/json'
+    assert chunked.text == downloaded.decode() == 'hello chunked world'
+    assert len(server.connections) == 1
+
+
+def test_concurrent_requests_and_errors(server):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        dead = f'http://127.0.0.1:{sock.getsockname()[1]}/'
+
+    async def run():
+        client = AsyncHTTPClient()
+        try:
+            responses = await asyncio.gather(*(client.get(f'{server.origin}/{n}') for n in range(20)))
+            assert [r.json()['path'] for r in responses] == [f'/{n}' for n in range(20)]
+            with pytest.raises(ConnectError):
+                await client.get(dead)
+            # a read timeout is not a connect error: the request was sent
+            with pytest.raises(TimeoutError) as timeout:
+                await client.get(f'{server.origin}/slow', timeout=0.1)
+            assert not isinstance(timeout.value, ConnectError)
+            # the timed-out connection is dropped, not reused
+            assert (await client.get(f'{server.origin}/after')).json() == {'path': '/after'}
+            with pytest.raises(HTTPStatusError) as status:
+                await client.download_to_tempfile(f'{server.origin}/gone')
+            assert status.value.status_code == 503
+        finally:
+            await client.aclose()
+
+    asyncio.run(run())
+
+
+def test_stream_yields_chunks_as_they_arrive(server):
+    import time
+
+    async def run():
+        client = AsyncHTTPClient()
+        try:
+            chunks = [chunk async for chunk in client.stream('GET', f'{server.origin}/chunked')]
+            with pytest.raises(TimeoutError):
+                async for _ in client.stream('GET', f'{server.origin}/slow', timeout=0.1):
+                    pass
+            start = time.perf_counter()
+            async for _ in client.stream('GET', f'{server.origin}/chunked'):
+                break  # closing early drops the connection instead of reading on
+            return chunks, time.perf_counter() - start
+        finally:
+            await client.aclose()
+
+    chunks, elapsed = asyncio.run(run())
+    assert b''.join(chunks) == b'hello chunked world' and len(chunks) >= 1
+    assert elapsed < 0.5
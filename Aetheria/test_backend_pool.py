@@ -0,0 +1,122 @@
+import pytest
+
+from backend_pool import BackendPool, NoBackendAvailable
+
+
+def test_least_outstanding_routing():
+    pool = BackendPool(['a', 'b', 'c'])
+    leases = [pool.acquire() for _ in range(3)]
+    assert sorted(lease.url for lease in leases) == ['a', 'b', 'c']
+    pool.release(leases[1], 0.01)
+    assert pool.acquire().url == leases[1].url
+
+
+def test_breaker_ejects_and_readmits_after_trial(monkeypatch):
+    import backend_pool
+    now = [1000.0]
+    monkeypatch.setattr(backend_pool.time, 'monotonic', lambda: now[0])
+    pool = BackendPool(['a'], failure_threshold=2, reset_timeout_s=30)
+
+    def fail(lease):
+        raise ConnectionError('refused')
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.call(fail)
+    assert pool.stats()['nodes'][0]['state'] == 'open'
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire()
+
+    now[0] += 31
+    trial = pool.acquire()
+    assert trial.node.state == 'half_open'
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire()  # one trial at a time
+    pool.release(trial, 0.05)
+    assert pool.stats()['nodes'][0]['state'] == 'closed'
+
+
+def test_only_the_trial_lease_reopens_a_half_open_node(monkeypatch):
+    import backend_pool
+    now = [1000.0]
+    monkeypatch.setattr(backend_pool.time, 'monotonic', lambda: now[0])
+    pool = BackendPool(['a'], failure_threshold=1, reset_timeout_s=30)
+    older = pool.acquire()
+    with pytest.raises(TimeoutError):
+        with pool.attempt():
+            raise TimeoutError()
+    now[0] += 31
+    trial = pool.acquire()
+    assert trial.trial and not older.trial
+    pool.release(older, 0.05, neutral=True)
+    with pytest.raises(NoBackendAvailable):
+        pool.acquire()  # the trial is still in flight
+    pool.release(trial, 0.05)
+    assert not pool.acquire().trial
+
+
+def test_5xx_and_timeouts_count_but_caller_errors_do_not():
+    pool = BackendPool(['a'], failure_threshold=2)
+    with pool.attempt() as lease:
+        lease.failed('status 503')
+    with pytest.raises(ValueError):
+        with pool.attempt():
+            raise ValueError('bad payload')
+    node = pool.stats()['nodes'][0]
+    assert node['consecutive_failures'] == 1 and node['state'] == 'closed'
+    with pytest.raises(TimeoutError):
+        with pool.attempt():
+            raise TimeoutError()
+    assert pool.stats()['nodes'][0]['state'] == 'open'
+
+
+def test_call_retries_on_another_node():
+    pool = BackendPool(['a', 'b'])
+    seen = []
+
+    def flaky(lease):
+        seen.append(lease.url)
+        if len(seen) == 1:
+            raise ConnectionRefusedError('refused')
+        return lease.url
+
+    assert pool.call(flaky) == seen[1] != seen[0]
+
+
+def test_timeouts_after_submit_are_counted_but_not_resubmitted():
+    import requests
+    from fake_backends import FakeSD
+    from http_client import get_client
+
+    nodes = [FakeSD(latency_s=1), FakeSD(latency_s=1)]
+    pool = BackendPool([n.url for n in nodes])
+    try:
+        with pytest.raises(requests.ReadTimeout):
+            pool.call(lambda lease: get_client().post(lease.url, json={'prompt': 'p'}, timeout=(1, 0.3)))
+        assert sum(n.requests for n in nodes) == 1
+        assert sum(n['errors'] for n in pool.stats()['nodes']) == 1
+    finally:
+        for n in nodes:
+            n.close()
+
+
+def test_async_calls_retry_only_connect_errors():
+    import asyncio
+    from async_http import ConnectError
+
+    pool = BackendPool(['a', 'b'])
+    seen = []
+
+    async def run(error):
+        async def fn(lease):
+            seen.append(lease.url)
+            if len(seen) == 1:
+                raise error
+            return lease.url
+        return await pool.call_async(fn)
+
+    assert asyncio.run(run(ConnectError('refused'))) == seen[1] != seen[0]
+    seen.clear()
+    with pytest.raises(TimeoutError):
+        asyncio.run(run(TimeoutError('render still running')))
+    assert len(seen) == 1
@@ -0,0 +1,65 @@
+import random
+import time
+
+from chat_replies import DEFAULT_REPLIES, IntentMatcher, ReplyCache, load_intents, normalize
+
+
+def test_intents_match_whole_words_by_priority(tmp_path):
+    matcher = IntentMatcher(load_intents())
+    assert matcher.match('Tell me about my LOVE life!')['name'] == 'love'
+    assert matcher.match('Will my career take off?')['name'] == 'work'
+    assert matcher.match('I love my job')['name'] == 'love'  # earlier intents win
+    assert matcher.match('my homework and network') is None  # no partial words
+    assert matcher.reply('hello', rng=random.Random(1)) in DEFAULT_REPLIES
+
+    extra = tmp_path / 'intents.json'
+    extra.write_text('[{"name": "travel", "phrases": ["trip", "travel abroad"], "replies": ["Pack light."]}]')
+    matcher = IntentMatcher(load_intents(str(extra)))
+    assert matcher.reply('Should I travel abroad soon?') == 'Pack light.'
+    assert matcher.match('I travel') is None  # multi-word phrases match in full
+
+
+def test_matcher_agrees_with_a_brute_force_scan():
+    rng = random.Random(0)
+    vocab = [f'w{i}' for i in range(500)]
+    intents = [{'name': str(i), 'replies': ['r'],
+                'phrases': [' '.join(rng.sample(vocab, rng.randint(1, 3))) for _ in range(3)]}
+               for i in range(2000)]
+    matcher = IntentMatcher(intents)
+    for _ in range(200):
+        text = ' '.join(rng.choice(vocab) for _ in range(30))
+        padded = f' {text} '
+        expected = next((i for i, intent in enumerate(intents)
+                         if any(f' {p} ' in padded for p in intent['phrases'])), None)
+        found = matcher.match(text)
+        assert (found and int(found['name'])) == expected
+
+
+def test_reply_cache_is_lru_with_ttl(monkeypatch):
+    cache = ReplyCache(max_entries=2, max_age_s=60)
+    cache.put('Will I travel?', 'Amethyst', 'Yes.')
+    assert normalize('  will i TRAVEL ') == 'will i travel'
+    assert cache.get('will i  travel', 'amethyst') == 'Yes.'
+    assert cache.get('Will I travel?', 'rose') is None
+    cache.put('a', None, '1')
+    cache.get('will i travel', 'amethyst')
+    cache.put('b', None, '2')  # evicts 'a', the least recently used
+    assert cache.get('a') is None and cache.get('b') == '2'
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 61)
+    assert cache.get('b') is None
+    assert cache.info() == {'entries': 1, 'hits': 3, 'misses': 3}
+    disabled = ReplyCache(max_entries=0)
+    disabled.put('a', None, '1')
+    assert disabled.get('a') is None
+
+
+def test_reply_cache_keys_words_in_any_script():
+    cache = ReplyCache()
+    cache.put('我的爱情怎么样？', None, 'A')
+    assert cache.get('我的工作会顺利吗？') is None
+    assert cache.get('我的爱情怎么样') == 'A'
+    assert normalize('Café AU LAIT, señor!') == 'café au lait señor'
+    cache.put('?!', None, 'B')  # no words: never cached, never served
+    assert cache.get('…') is None and cache.info()['entries'] == 1
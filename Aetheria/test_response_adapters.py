@@ -0,0 +1,63 @@
+import json
+
+import response_adapters
+from response_adapters import ImageRef, extract, register, scan_images
+
+PNG = 'iVBORw0KGgo' + 'A' * 1000
+
+
+def test_a1111_reads_images_and_info():
+    body = {'images': [PNG, PNG],
+            'parameters': {'prompt': 'x' * 2000, 'seed': -1, 'steps': 20, 'sampler_name': 'Euler a'},
+            'info': json.dumps({'seed': 7, 'all_seeds': [7, 8], 'cfg_scale': 7.5})}
+    images, meta, adapter = extract(body)
+    assert adapter == 'a1111'
+    assert images == [PNG, PNG]
+    # the real seed from 'info' wins over the requested -1
+    assert meta == {'seed': 7, 'cfg_scale': 7.5, 'steps': 20, 'sampler_name': 'Euler a'}
+
+
+def test_comfyui_history_outputs():
+    graph = {'3': {'class_type': 'KSampler', 'inputs': {'seed': 5, 'steps': 20, 'cfg': 8, 'sampler_name': 'euler'}}}
+    body = {'abc': {'prompt': [0, 'abc', graph, {}, ['9']],
+                    'outputs': {'9': {'images': [{'filename': 'a.png', 'subfolder': '', 'type': 'output'}]}}}}
+    images, meta, adapter = extract(body)
+    assert adapter == 'comfyui'
+    ref, = images
+    assert isinstance(ref, ImageRef)
+    assert ref.view_url('http://gpu:8188/') == 'http://gpu:8188/view?filename=a.png&subfolder=&type=output'
+    assert meta == {'seed': 5, 'steps': 20, 'sampler_name': 'euler', 'cfg_scale': 8}
+
+
+def test_stability_artifacts_skip_errors():
+    body = {'artifacts': [{'base64': PNG, 'seed': 11, 'finishReason': 'SUCCESS'},
+                          {'base64': '', 'seed': 12, 'finishReason': 'ERROR'}]}
+    assert extract(body) == ([PNG], {'seed': 11}, 'stability')
+
+
+def test_unknown_shapes_fall_back_to_scanner():
+    body = {'data': [{'b64_json': PNG, 'seed': 3}]}
+    assert extract(body) == ([PNG], {'seed': 3}, 'generic')
+    # a schema match without images also falls back
+    assert extract({'images': [], 'result': {'image': PNG}}).adapter == 'generic'
+    assert scan_images({'log': 'not base64! ' * 100}) == []
+
+
+def test_registered_and_forced_adapters(monkeypatch):
+    monkeypatch.setattr(response_adapters, '_adapters', list(response_adapters._adapters))
+
+    class Custom:
+        name = 'custom'
+
+        def matches(self, body):
+            return 'pictures' in body
+
+        def images(self, body):
+            return body['pictures']
+
+        def metadata(self, body):
+            return {}
+
+    register(Custom())
+    assert extract({'pictures': [PNG]}).adapter == 'custom'
+    assert extract({'images': [PNG]}, adapter='custom').adapter == 'generic'
@@ -0,0 +1,70 @@
+import os
+import time
+
+from db import Database
+from storage import Reconciler, Unlinker
+
+
+def _setup(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    with db.transaction():
+        db.execute('CREATE TABLE generated (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT NOT NULL, '
+                   'prompt TEXT, crystal TEXT, created_at TEXT)')
+        db.execute('CREATE INDEX idx_generated_filename ON generated (filename)')
+    directory = tmp_path / 'generated'
+    (directory / 'thumbs').mkdir(parents=True)
+    return db, directory
+
+
+def _file(directory, name, age_s=0):
+    path = directory / name
+    path.write_bytes(b'png')
+    then = time.time() - age_s
+    os.utime(path, (then, then))
+    return str(path)
+
+
+def test_bulk_delete_is_one_transaction_and_unlinks_in_the_background(tmp_path):
+    db, directory = _setup(tmp_path)
+    paths = [_file(directory, f'img-{i}.png') for i in range(3)]
+    ids = [db.insert_generated(os.path.basename(p), 'p', 'ruby', '2025-01-01') for p in paths]
+    rows = db.delete_generated([ids[0], ids[2], 999])
+    assert sorted(rows) == [(ids[0], 'img-0.png'), (ids[2], 'img-2.png')]
+    assert db.query('SELECT id FROM generated') == [(ids[1],)]
+    assert db.delete_generated([]) == []
+
+    counts = Unlinker().submit([paths[0], paths[2], str(directory / 'gone.png')]).result()
+    assert counts == {'removed': 2, 'missing': 1, 'failed': 0}
+    assert [os.path.exists(p) for p in paths] == [False, True, False]
+
+
+def test_reconciler_finds_orphans_in_chunks(tmp_path):
+    db, directory = _setup(tmp_path)
+    for i in range(5):
+        name = f'kept-{i}.png'
+        _file(directory, name, age_s=7200)
+        db.insert_generated(name, 'p', 'ruby', '2025-01-01')
+    _file(directory, 'orphan.png', age_s=7200)
+    _file(directory, 'saving.png')  # no row yet, but too recent to call an orphan
+    _file(directory, '.spill-abc')
+    missing = db.insert_generated('missing.png', 'p', 'ruby', '2025-01-01')
+    deleted = []
+    reconciler = Reconciler(db, str(directory), deleted.extend, Unlinker(), chunk_size=2)
+
+    # 7 files in chunks of 2, then 6 rows in pages of 2 (the last one empty)
+    reports = [reconciler.step() for _ in range(8)]
+    assert [(r['phase'], r['checked'], r['done']) for r in reports] == [
+        ('files', 2, False), ('files', 2, False), ('files', 2, False), ('files', 1, False),
+        ('rows', 2, False), ('rows', 2, False), ('rows', 2, False), ('rows', 0, True)]
+    assert sum((r['orphan_files'] for r in reports), []) == ['orphan.png']
+    assert sum((r['missing_files'] for r in reports), []) == [missing]
+    assert reconciler.step()['phase'] == 'files'  # a new pass
+    assert os.path.exists(directory / 'orphan.png') and not deleted
+
+    report = reconciler.run(repair=True)
+    assert report == {'files_checked': 7, 'rows_checked': 6, 'orphan_files': ['orphan.png'],
+                      'missing_files': [missing], 'repaired': True}
+    reconciler.unlinker.submit(()).result()  # batches run in order
+    assert not os.path.exists(directory / 'orphan.png') and os.path.exists(directory / 'saving.png')
+    assert deleted == [missing]
+
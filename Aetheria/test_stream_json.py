@@ -0,0 +1,50 @@
+import base64
+import json
+import os
+
+from stream_json import StreamingJSONParser, jsonable
+
+
+def _parse(text, chunk_size, **kwargs):
+    parser = StreamingJSONParser(**kwargs)
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return parser.close()
+
+
+def test_large_strings_are_decoded_to_disk_across_chunk_boundaries(tmp_path):
+    raw = os.urandom(50000)
+    b64 = base64.b64encode(raw).decode()
+    doc = {'images': ['data:image/png;base64,' + b64, b64],
+           'info': json.dumps({'seed': 7, 'sampler_name': 'Euler a'}),
+           'parameters': {'steps': 20, 'cfg_scale': 7.5, 'restore_faces': False, 'tiling': None,
+                          'prompt': 'café \\"moon\\" \U0001f319'}}
+    for text in (json.dumps(doc), json.dumps(doc).replace('/', '\\/')):
+        for chunk_size in (1, 13, 4096):
+            result = _parse(text, chunk_size, spill_threshold=1000, spill_dir=str(tmp_path))
+            assert result['info'] == doc['info']
+            assert result['parameters'] == doc['parameters']
+            first, second = result['images']
+            assert first.header == 'data:image/png;base64,' and second.header == ''
+            for spilled in (first, second):
+                with open(spilled.path, 'rb') as f:
+                    assert f.read() == raw
+                spilled.discard()
+    assert os.listdir(tmp_path) == []
+
+
+def test_long_non_base64_strings_are_dropped(tmp_path):
+    result = _parse(json.dumps({'log': 'not an image! ' * 200, 'n': 1}), 64,
+                    spill_threshold=100, spill_dir=str(tmp_path))
+    assert jsonable(result) == {'log': '<omitted large string>', 'n': 1}
+    assert os.listdir(tmp_path) == []
+
+
+def test_moved_files_get_the_usual_mode_not_the_temp_file_mode(tmp_path):
+    result = _parse(json.dumps({'images': [base64.b64encode(os.urandom(3000)).decode()]}), 512,
+                    spill_threshold=100, spill_dir=str(tmp_path))
+    spilled = result['images'][0]
+    plain = tmp_path / 'plain.png'
+    plain.write_bytes(b'png')
+    spilled.move_to(str(tmp_path / 'image.png'))
+    assert os.stat(tmp_path / 'image.png').st_mode & 0o777 == os.stat(plain).st_mode & 0o777
@@ -0,0 +1,105 @@
+import json
+import logging
+import threading
+
+import pytest
+from flask import Flask
+
+import tracing
+
+
+def test_spans_nest_and_are_logged_with_request_id(caplog):
+    caplog.set_level(logging.INFO, logger='aetheria.trace')
+    with tracing.start('req-1') as trace:
+        with tracing.span('generate', prompt='moon'):
+            with tracing.span('backend.submit') as attrs:
+                attrs['status'] = 200
+        with pytest.raises(ValueError):
+            with tracing.span('save'):
+                raise ValueError('disk full')
+    records = [json.loads(r.getMessage()) for r in caplog.records]
+    assert [r['span'] for r in records] == ['backend.submit', 'generate', 'save']
+    assert {r['request_id'] for r in records} == {'req-1'}
+    assert records[0]['parent'] == 'generate' and records[0]['status'] == 200
+    assert records[1]['parent'] is None and records[1]['prompt'] == 'moon'
+    assert records[2]['error'] == 'ValueError'
+    assert list(trace.durations()) == ['backend.submit', 'generate', 'save']
+    assert tracing.current() is None
+
+
+def test_span_outside_a_trace_is_a_no_op(caplog):
+    caplog.set_level(logging.INFO, logger='aetheria.trace')
+    with tracing.span('idle') as attrs:
+        attrs['x'] = 1
+    assert not caplog.records
+
+
+def test_bind_carries_the_trace_to_other_threads():
+    seen = []
+
+    @tracing.traced('worker')
+    def work():
+        seen.append(tracing.request_id())
+
+    with tracing.start('req-2') as trace:
+        with tracing.span('parent'):
+            t = threading.Thread(target=tracing.bind(work))
+            t.start()
+            t.join()
+    assert seen == ['req-2']
+    worker = next(r for r in trace.spans if r['span'] == 'worker')
+    assert worker['parent'] == 'parent'
+
+
+def _app(tmp_path, **config):
+    app = Flask(__name__)
+    app.config.update(config, PROFILE_DIR=str(tmp_path / 'profiles'))
+    tracing.init_app(app)
+
+    @app.route('/work')
+    def work():
+        with tracing.span('stage.one'):
+            pass
+        return tracing.request_id()
+
+    return app
+
+
+def test_request_id_and_server_timing_headers(tmp_path):
+    client = _app(tmp_path, SERVER_TIMING=True).test_client()
+    resp = client.get('/work', headers={'X-Request-ID': 'abc-123'})
+    assert resp.get_data(as_text=True) == 'abc-123'
+    assert resp.headers['X-Request-ID'] == 'abc-123'
+    assert resp.headers['Server-Timing'].startswith('stage.one;dur=')
+    # ids that are not short and alphanumeric are replaced
+    resp = client.get('/work', headers={'X-Request-ID': '../etc/passwd'})
+    assert resp.headers['X-Request-ID'] != '../etc/passwd' and len(resp.headers['X-Request-ID']) == 16
+    assert 'Server-Timing' not in _app(tmp_path).test_client().get('/work').headers
+
+
+def test_profile_is_written_only_when_requested(tmp_path):
+    import pstats
+
+    client = _app(tmp_path, PROFILE_REQUESTS='header').test_client()
+    assert 'X-Profile-File' not in client.get('/work').headers
+    resp = client.get('/work', headers={'X-Profile': '1'})
+    path = tmp_path / 'profiles' / resp.headers['X-Profile-File']
+    assert path.name == resp.headers['X-Request-ID'] + '.prof'
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+def test_traced_coroutines_time_the_awaited_work():
+    import asyncio
+
+    @tracing.traced('backend.wait')
+    async def wait():
+        await asyncio.sleep(0.05)
+
+    async def run():
+        with tracing.start('req-3') as trace:
+            await asyncio.gather(wait(), wait())
+        return trace
+
+    trace = asyncio.run(run())
+    assert [r['span'] for r in trace.spans] == ['backend.wait', 'backend.wait']
+    assert all(r['ms'] >= 45 for r in trace.spans)
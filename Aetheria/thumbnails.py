@@ -0,0 +1,137 @@
+"""Gallery thumbnails: small WebP derivatives of generated images.
+
+Derivatives are written to ``static/generated/thumbs/`` and recorded in the
+``generated_thumbs`` table. They are produced in the background right after
+an image is saved, or lazily the first time a thumbnail URL is requested
+(images saved before this existed).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# widths in px; the gallery grid shows images 160px wide (320/640 for HiDPI)
+SIZES = (160, 320, 640)
+FORMAT, EXTENSION = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+
+class ThumbnailStore:
+    def __init__(self, db, generated_dir: str, sizes=SIZES, quality: int = 80):
+        """``db`` is the app's :class:`db.Database`; ``generated_dir`` holds the originals."""
+        self.db = db
+        self.generated_dir = generated_dir
+        self.thumbs_dir = os.path.join(generated_dir, 'thumbs')
+        self.sizes = tuple(sizes)
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+        self._lock = threading.Lock()
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        self.init_db()
+
+    def init_db(self):
+        with self.db.transaction():
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS generated_thumbs (
+                    generated_id INTEGER NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    PRIMARY KEY (generated_id, width)
+                )
+            ''')
+
+    def schedule(self, generated_id: int, filename: str):
+        """Build the derivatives in the background (called right after saving)."""
+        self._executor.submit(self._create_logged, generated_id, filename)
+
+    def ensure(self, generated_id: int, filename: str) -> dict:
+        """Return ``{width: thumb filename}``, creating missing derivatives synchronously."""
+        existing = self._recorded(generated_id)
+        if len(existing) == len(self.sizes):
+            return existing
+        with self._lock:
+            return self.create(generated_id, filename)
+
+    def create(self, generated_id: int, filename: str) -> dict:
+        stem = os.path.splitext(filename)[0]
+        rows = []
+        options = {'quality': self.quality}
+        options.update({'method': 4} if FORMAT == 'WEBP' else {'optimize': True})
+        with Image.open(os.path.join(self.generated_dir, filename)) as original:
+            original.load()
+            for width in self.sizes:
+                thumb = original.copy()
+                thumb.thumbnail((width, width * 4), Image.LANCZOS)
+                if FORMAT == 'JPEG' and thumb.mode != 'RGB':
+                    thumb = thumb.convert('RGB')
+                thumb_name = f'{stem}.w{width}.{EXTENSION}'
+                path = os.path.join(self.thumbs_dir, thumb_name)
+                thumb.save(path, format=FORMAT, **options)
+                rows.append((generated_id, width, thumb.height, thumb_name, os.path.getsize(path)))
+        with self.db.transaction():
+            if self.db.query_one('SELECT 1 FROM generated WHERE id = ?', (generated_id,)) is None:
+                # the image was deleted from the gallery while we were resizing it
+                for row in rows:
+                    os.remove(os.path.join(self.thumbs_dir, row[3]))
+                return {}
+            self.db.executemany('INSERT OR REPLACE INTO generated_thumbs (generated_id, width, height, filename, bytes) '
+                                'VALUES (?,?,?,?,?)', rows)
+        return {r[1]: r[3] for r in rows}
+
+    def urls_for(self, generated_ids) -> dict:
+        """``{generated_id: [{'width', 'url'}, ...]}`` for a page of gallery items.
+
+        Recorded derivatives point at the static file; missing ones at the lazy
+        ``/api/generated/<id>/thumb/<width>`` route that builds them on first request.
+        """
+        ids = list(generated_ids)
+        recorded = {}
+        if ids:
+            marks = ','.join('?' * len(ids))
+            for gid, width, fname in self.db.query(
+                    f'SELECT generated_id, width, filename FROM generated_thumbs WHERE generated_id IN ({marks})', ids):
+                recorded[(gid, width)] = fname
+        out = {}
+        for gid in ids:
+            out[gid] = [{'width': width,
+                         'url': (f'/static/generated/thumbs/{recorded[(gid, width)]}' if (gid, width) in recorded
+                                 else f'/api/generated/{gid}/thumb/{width}')}
+                        for width in self.sizes]
+        return out
+
+    def delete_many(self, generated_ids) -> list:
+        """Drop the derivatives of deleted images (rows in one transaction).
+
+        Returns the paths of their files for the caller to remove (e.g. in the
+        background). Holds the creation lock, so a background job that already
+        read an image either finishes and is cleaned up here, or sees its row
+        gone and removes its own files.
+        """
+        ids = list(generated_ids)
+        if not ids:
+            return []
+        marks = ','.join('?' * len(ids))
+        with self._lock:
+            with self.db.transaction():
+                fnames = self.db.query(f'SELECT filename FROM generated_thumbs WHERE generated_id IN ({marks})', ids)
+                self.db.execute(f'DELETE FROM generated_thumbs WHERE generated_id IN ({marks})', ids)
+        return [os.path.join(self.thumbs_dir, fname) for (fname,) in fnames]
+
+    def _recorded(self, generated_id):
+        return {width: fname for width, fname in self.db.query(
+            'SELECT width, filename FROM generated_thumbs WHERE generated_id = ?', (generated_id,))
+            if os.path.exists(os.path.join(self.thumbs_dir, fname))}
+
+    def _create_logged(self, generated_id, filename):
+        try:
+            with self._lock:
+                self.create(generated_id, filename)
+        except FileNotFoundError:
+            pass  # deleted before we got to it
+        except Exception:
+            logger.exception('Thumbnail generation failed for %s', filename)
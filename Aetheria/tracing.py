@@ -0,0 +1,216 @@
+"""Per-request span tracing and opt-in request profiling.
+
+Every request gets a :class:`Trace` with a request id (the incoming
+``X-Request-ID`` header, or a new one) that is echoed back in the response.
+Code marks its stages with :func:`span`; each finished span is logged as one
+JSON line on the ``aetheria.trace`` logger::
+
+    {"event": "span", "request_id": "...", "span": "comfyui.wait", "parent": "generate", "ms": 812.4, ...}
+
+:func:`init_app` wires this into a Flask app:
+
+- ``TRACE_LOG``: log the spans (on by default; a stderr handler is added when
+  logging is not configured)
+- ``SERVER_TIMING``: also return the span durations (summed per name) in a
+  ``Server-Timing`` header
+- ``PROFILE_REQUESTS``: ``header`` profiles requests sent with
+  ``X-Profile: 1``, ``all`` profiles every request; the cProfile stats are
+  written to ``PROFILE_DIR/<request id>.prof`` (open with ``pstats`` or
+  snakeviz) and the file name is returned in ``X-Profile-File``
+
+The current trace lives in a context variable. Work handed to other threads
+keeps its request id when wrapped with :func:`bind`.
+"""
+import contextvars
+import cProfile
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger('aetheria.trace')
+
+_current = contextvars.ContextVar('aetheria_trace', default=None)
+_span_stack = contextvars.ContextVar('aetheria_span', default=None)
+# only one cProfile profiler can be active in the process at a time
+_profile_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, request_id: str = None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self._lock:
+            self.spans.append(record)
+
+    def durations(self) -> dict:
+        """Total milliseconds per span name, in first-seen order."""
+        totals = {}
+        with self._lock:
+            for record in self.spans:
+                totals[record['span']] = totals.get(record['span'], 0.0) + record['ms']
+        return totals
+
+    def server_timing(self) -> str:
+        return ', '.join(f'{name};dur={ms:.1f}' for name, ms in self.durations().items())
+
+
+def clean_request_id(value: str):
+    """A caller's ``X-Request-ID`` if it is short and alphanumeric (it ends up in logs and file names)."""
+    if value and len(value) <= 64 and value.replace('-', '').isalnum():
+        return value
+    return None
+
+
+def current() -> Trace:
+    return _current.get()
+
+
+def request_id() -> str:
+    trace = _current.get()
+    return trace.request_id if trace else None
+
+
+@contextmanager
+def start(request_id: str = None):
+    """Make a new :class:`Trace` current for the ``with`` block."""
+    trace = Trace(request_id)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time a stage of the current request; a no-op outside a trace.
+
+    Extra keyword arguments are logged with the span; more can be added by
+    updating the yielded dict.
+    """
+    trace = _current.get()
+    if trace is None:
+        yield attrs
+        return
+    parent = _span_stack.get()
+    token = _span_stack.set(name)
+    start_ts = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _span_stack.reset(token)
+        end_ts = time.perf_counter()
+        record = {'event': 'span', 'request_id': trace.request_id, 'span': name, 'parent': parent,
+                  'start_ms': round((start_ts - trace.started) * 1000, 2),
+                  'ms': round((end_ts - start_ts) * 1000, 2), 'thread': threading.current_thread().name}
+        if error:
+            record['error'] = error
+        record.update(attrs)
+        trace.add(record)
+        logger.info(json.dumps(record, default=str))
+
+
+def traced(name: str):
+    """Decorator form of :func:`span` (for plain and ``async`` functions)."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(fn):
+    """Run ``fn`` later (on another thread) inside the current trace and span."""
+    ctx = contextvars.copy_context()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    """Trace every request of ``app`` (see the module docstring for the config keys)."""
+    from flask import g, request
+
+    app.config.setdefault('TRACE_LOG', os.environ.get('TRACE_LOG', 'true').lower() == 'true')
+    app.config.setdefault('SERVER_TIMING', os.environ.get('SERVER_TIMING', 'false').lower() == 'true')
+    app.config.setdefault('PROFILE_REQUESTS', os.environ.get('PROFILE_REQUESTS', 'off').lower())
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', os.path.join(app.root_path, 'profiles')))
+
+    if app.config['TRACE_LOG']:
+        logger.setLevel(logging.INFO)
+        if not logger.handlers and not logging.getLogger().handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+    else:
+        logger.setLevel(logging.WARNING)
+
+    @app.before_request
+    def _start_trace():
+        g._trace_cm = start(clean_request_id(request.headers.get('X-Request-ID')))
+        g._trace = g._trace_cm.__enter__()
+        g._root_cm = span('request', method=request.method, path=request.path)
+        g._root_attrs = g._root_cm.__enter__()
+        mode = app.config['PROFILE_REQUESTS']
+        if mode == 'all' or (mode == 'header' and request.headers.get('X-Profile') == '1'):
+            if _profile_lock.acquire(blocking=False):
+                g._profiler = cProfile.Profile()
+                g._profiler.enable()
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = g.get('_trace')
+        if trace is None:
+            return response
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+            os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            fname = f'{trace.request_id}.prof'
+            profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], fname))
+            response.headers['X-Profile-File'] = fname
+        g._root_attrs['status'] = response.status_code
+        g.pop('_root_cm').__exit__(None, None, None)
+        response.headers['X-Request-ID'] = trace.request_id
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = trace.server_timing()
+        return response
+
+    @app.teardown_request
+    def _end_trace(exc=None):
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:  # the view raised before after_request ran
+            profiler.disable()
+            _profile_lock.release()
+        root = g.pop('_root_cm', None)
+        if root is not None:
+            root.__exit__(None, None, None)
+        cm = g.pop('_trace_cm', None)
+        if cm is not None:
+            cm.__exit__(None, None, None)